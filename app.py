@@ -1,14 +1,43 @@
 import os
-from flask import Flask, render_template, request, jsonify
+import re
+from flask import Flask, Response, render_template, request, jsonify, send_from_directory
+from flask_sock import Sock
+from simple_websocket import ConnectionClosed
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 import threading
 import time
 import uuid # uuidモジュールを追加
+import logging
+import gc
+import cv2
 
 # 修正: 絶対インポートに戻し、flask run で実行することで解決を図る
-from services.routes import api_bp 
-from services.ai_service import load_models, run_detection_and_analyze # AIモデルの初期ロード関数と推論関数をインポート
+from services.routes import api_bp, init_api
+from services.ingest_service import IngestQueue, FileReadinessTracker, FILE_MISSING, FILE_WRITING, PRIORITY_BACKLOG
+from services.spool_service import Spool, IMAGE_EXTENSIONS
+from services.stream_service import StreamHub, STREAM_FRAME_INTERVAL_MS
+from services.job_service import InferenceJob, JobStore
+from services.batch_service import MicroBatcher
+from services.result_service import ResultWriter
+from services.cache_service import ResultCache
+from services.gate_service import SceneChangeGate
+from services.model_watch_service import start_model_dir_watcher
+from services.lock_service import ProcessLock, run_as_leader
+from services.render_service import AnnotatedFrame, RenderCache
+from services.log_service import get_logger, log_event, dropped_log_count, LOG_DETECTION_DETAILS
+from services.metrics_service import (
+    metrics, observe_stage_timings, JOBS_TOTAL, INFERENCE_SKIPPED_TOTAL, DETECTIONS_TOTAL,
+    QUEUE_DEPTH, MODELS_LOADED, MODELS_REGISTERED, RESIDENT_MEMORY
+)
+# AIモデルの初期ロード関数と推論関数をインポート
+from services.ai_service import (
+    start_background_model_loading, load_models, warmup_models, wait_for_models, get_model_status,
+    run_detection_batch, FrameInput,
+    get_model_signature, decode_image_bytes, model_registry, cascade_policy, get_rss_bytes,
+    get_model_input_sizes, limit_torch_threads, DEFAULT_INPUT_SIZE
+)
+from services.capture_service import build_capture_profile, validate_capture_profile
 
 # --- 設定 ---
 # UPLOAD_FOLDERは routes.py 側で定義されるが、ここでは省略
@@ -16,108 +45,305 @@ UPLOAD_FOLDER = os.path.abspath(os.path.join(os.path.dirname(__file__), 'uploads
 
 # Flaskアプリケーションの初期化
 app = Flask(__name__)
+# WebSocket (/stream) のルートを登録できるようにする
+sock = Sock(app)
 
-# --- AIモデルの初期ロード ---
-# サーバー起動時に、モデルをメモリにロードする
-try:
-    load_models() 
-except ConnectionError as e:
-    # モデルロード失敗は致命的なので、ログに出力
-    print(f"致命的エラー: {e}")
-    # アプリケーションは起動するが、APIリクエストはエラーを返すようになる
+# 推論処理のログはキュー経由で非同期に出力する (コンソール + logs/events.jsonl)
+logger = get_logger("pipeline")
+
+# /upload-image で受け取った画像の取り込み方法
+#   "memory" ... ディスクに書かず、メモリ上のバイト列をそのまま推論キューに渡す (デフォルト)
+#   "folder" ... 従来どおり img/ フォルダに保存し、ファイル監視経由で処理する
+UPLOAD_INGEST_MODE = os.environ.get("UPLOAD_INGEST_MODE", "memory")
 
 # --- ファイル監視ロジック ---
+# img/ フォルダは外部カメラやスクリプトからの取り込み口として引き続き利用できる
 IMG_FOLDER = os.path.abspath(os.path.join(os.path.dirname(__file__), 'img')) # 絶対パスで指定
+# img/ の画像のカメラID は、ファイル名のこの区切り文字より前の部分にする (シーン変化ゲートをカメラごとに分けるため)
+# 例: "greenhouse1__20240101_120000.jpg" -> "greenhouse1"。区切り文字を含まないファイルは "folder"
+FOLDER_CAMERA_SEPARATOR = os.environ.get("FOLDER_CAMERA_SEPARATOR", "__")
+
+def analyze_job(job, stage_timings):
+    """
+    キャッシュ → シーン変化ゲート → バッチ推論 の順に、推論を省略できるか確認しながら結果を得る。
+    推論を省略した場合、描画用のフレームは None (保存が必要になった時点でデコードして作る)。
+    """
+    original_filename = os.path.basename(job.path or job.filename)
+    if not wait_for_models():
+        raise ConnectionError("YOLOv8モデルがロードされていません。")
+
+    # 同じ画像を同じモデル構成で推論済みなら、結果を再利用する
+    model_signature = get_model_signature()
+    cache_key = result_cache.make_key(job.data, model_signature)
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        log_event(logger, "inference_skipped", logging.DEBUG, reason="cache", image=original_filename)
+        INFERENCE_SKIPPED_TOTAL.inc(reason="cache")
+        return (*cached, None, original_filename)
+
+    # 同じカメラの前回の画像からほとんど変化していなければ、前回の結果を再利用する
+    # (モデルの再読み込み後は、前回の結果が古いモデルのものなので再利用しない)
+    decoded = None
+    thumbnail = None
+    if scene_gate.enabled:
+        decode_start = time.perf_counter()
+        decoded = decode_image_bytes(job.data)
+        stage_timings["decode"] = time.perf_counter() - decode_start
+        if decoded is not None:
+            thumbnail = scene_gate.thumbnail(decoded)
+            skip, previous, difference = scene_gate.check(job.camera_id, thumbnail, model_signature)
+            if skip:
+                log_event(logger, "inference_skipped", logging.DEBUG, reason="scene_gate", image=original_filename,
+                          camera_id=job.camera_id, difference=round(difference, 2))
+                INFERENCE_SKIPPED_TOTAL.inc(reason="scene_gate")
+                return (*previous, None, original_filename)
+
+    # 他のワーカーの画像とまとめてバッチ推論される
+    result = micro_batcher.infer(
+        FrameInput(job.path or job.filename, image=decoded, image_bytes=job.data, timings=stage_timings)
+    )
+    result_disease, result_confidence, all_detections, annotated_frame, _ = result
+    if annotated_frame is not None: # 読み込みエラーの結果は再利用しない
+        result_cache.put(cache_key, (result_disease, result_confidence, all_detections))
+        if thumbnail is not None:
+            scene_gate.update(job.camera_id, thumbnail, (result_disease, result_confidence, all_detections), model_signature)
+    return result
+
+def process_job(job):
+    """推論ワーカーで1枚の画像を処理する (推論 → 結果保存 → spool の状態を done/再試行/failed に進める)"""
+    job_store.add(job)
+    image_path = job.path
+    if image_path is not None:
+        # ファイルが完全に書き込まれるのを待つ (close_write/リネーム済みなら即座に処理。最悪でも数秒)
+        # 処理中の画像は processing/ に移す (同じ画像を他のワーカーが二重に処理しない)
+        try:
+            readiness = file_readiness.wait_until_ready(image_path)
+            if readiness == FILE_MISSING:
+                raise FileNotFoundError(image_path)
+            if readiness == FILE_WRITING:
+                # 書き込み途中の画像は処理せず、しばらくしてから判定し直す (img/ に置いたまま)
+                schedule_retry(job, file_readiness.max_timeout)
+                return
+            claimed_path = spool.claim(image_path)
+            # 判定後に届いた close_write の通知が残らないようにする
+            file_readiness.forget(image_path)
+            image_path = job.path = claimed_path
+        except FileNotFoundError:
+            log_event(logger, "file_missing", logging.WARNING, job_id=job.job_id, image=image_path)
+            job_store.mark_failed(job, "ファイルが見つかりません")
+            JOBS_TOTAL.inc(status="missing")
+            return
+    log_event(logger, "job_started", logging.DEBUG, job_id=job.job_id, image=job.filename, source=job.source)
+    job_store.mark_processing(job)
+    try:
+        stage_timings = {}
+        if job.data is None:
+            # ファイルは1回だけ読み込み、ハッシュ計算とデコードの両方に使う
+            with open(image_path, 'rb') as f:
+                job.data = f.read()
+
+        result_disease, result_confidence, all_detections, annotated_frame, original_filename = analyze_job(job, stage_timings)
+        render_pid = None
+        if annotated_frame is not None:
+            # 描画はせず元画像への参照だけを保持する (/jobs/<job_id>/image で要求されたときに描画する)
+            render_cache.remember(job.job_id, annotated_frame)
+            render_pid = os.getpid() # 保持しているのはこのプロセスの RenderCache だけ
+        observe_stage_timings(stage_timings)
+        for category, count in all_detections.category_counts().items():
+            DETECTIONS_TOTAL.inc(count, model_category=category)
+
+        # 判定率0.75以上の検出結果のみをフィルタリング (配列のまま絞り込む)
+        filtered_detections = all_detections.at_least(0.75)
+        saved_filename = None
+        saved_image = None
+        if all_detections: # 検出結果がある場合 (フィルタリング後)
+            if filtered_detections: # フィルタリング後に検出結果がある場合のみ処理
+                # 検出されたカテゴリごとに result/カテゴリ/ へ保存する
+                # (描画とエンコードは1回だけ。保存スレッドで描画するので、推論ワーカーは描画を待たない)
+                unique_output_filename = f"detected_{uuid.uuid4()}_{original_filename}"
+                def render_for_save(frame=annotated_frame, data=job.data, detections=all_detections):
+                    if frame is None:
+                        # キャッシュ/ゲートで推論を省略した画像は、保存するときに (保存スレッドで) デコードする
+                        frame = AnnotatedFrame(decode_image_bytes(data), detections)
+                    return render_cache.render(frame)
+                categories = filtered_detections.categories()
+                result_writer.submit(render_for_save, unique_output_filename, categories)
+                saved_filename = unique_output_filename
+                # result/ からの相対パス。どのワーカープロセスでも /jobs/<job_id>/image でこのファイルを返せる
+                saved_image = f"{categories[0]}/{unique_output_filename}"
+
+        # 1枚につき1件の構造化ログにまとめる (検出ごとの詳細は LOG_DETECTION_DETAILS=0 で省略できる)
+        event_fields = {
+            "job_id": job.job_id,
+            "image": original_filename,
+            "source": job.source,
+            "camera_id": job.camera_id,
+            "disease": result_disease,
+            "confidence": result_confidence,
+            "detections": len(all_detections),
+            "detections_over_threshold": len(filtered_detections),
+            "categories": all_detections.category_counts(),
+            "models": [name.split(":", 1)[1] for name in stage_timings if name.startswith("inference:")],
+            "saved_as": saved_filename,
+            "timings_ms": {name: round(seconds * 1000, 1) for name, seconds in stage_timings.items()},
+        }
+        if LOG_DETECTION_DETAILS and filtered_detections:
+            event_fields["detection_details"] = filtered_detections.to_dicts()
+        log_event(logger, "job_done", **event_fields)
+
+        job_store.mark_done(job, {
+            "disease": result_disease,
+            "confidence": result_confidence,
+            "detections": all_detections.to_dicts(), # API応答用に従来の形式へ変換する
+            "timings_ms": {name: round(seconds * 1000, 1) for name, seconds in stage_timings.items()},
+            "render_pid": render_pid,
+            "saved_image": saved_image,
+        })
+        JOBS_TOTAL.inc(status="done")
+
+    except Exception as e:
+        log_event(logger, "job_failed", logging.ERROR, job_id=job.job_id, image=job.filename, error=str(e))
+        JOBS_TOTAL.inc(status="failed")
+        # 失敗した画像は削除せず、上限回数まで時間をおいて再試行する (上限に達したら spool/failed/ に残す)
+        retry_delay = spool.fail(image_path, str(e)) if image_path is not None else None
+        if retry_delay is not None:
+            job_store.mark_retrying(job, str(e))
+            schedule_retry(job, retry_delay)
+        else:
+            job_store.mark_failed(job, str(e))
+    else:
+        # 推論処理が完了したら、元の画像を spool/done/ に移す
+        if image_path is not None:
+            spool.complete(image_path)
+            log_event(logger, "source_done", logging.DEBUG, image=image_path)
+
+def schedule_retry(job, delay):
+    """画像を delay 秒後に推論キューへ入れ直す (画像は移動せず spool/processing/ または img/ に置いたまま)"""
+    def resubmit():
+        job_store.mark_queued(job)
+        # 待ってでも必ず入れ直す (入れ直せないまま終了しても、次回の起動時に processing/ から復旧する)
+        ingest_queue.submit(job, key=job.path, block=True)
+    log_event(logger, "job_retry_scheduled", logging.WARNING, job_id=job.job_id, image=job.filename, delay_seconds=delay)
+    timer = threading.Timer(delay, resubmit)
+    timer.daemon = True
+    timer.start()
+
+# 複数ワーカーの画像をまとめてバッチ推論する
+micro_batcher = MicroBatcher(run_detection_batch)
+# 同じ画像の再推論を省くための結果キャッシュ
+result_cache = ResultCache()
+# 変化の小さい画像の推論を省くためのゲート (SCENE_GATE_ENABLED=1 で有効)
+scene_gate = SceneChangeGate()
+# 推論結果画像をバックグラウンドで保存する
+result_writer = ResultWriter()
+# 検出結果の描画は保存/表示するときだけ行い、描画済み画像は少数だけキャッシュする
+render_cache = RenderCache()
+# 推論ワーカーに画像を渡す有界キュー (on_created はパスを投入するだけ)
+ingest_queue = IngestQueue(process_job)
+# 直近のジョブの状態 (ジョブIDで参照できる)
+job_store = JobStore()
+# 新しいファイルの書き込み完了を判定する
+file_readiness = FileReadinessTracker()
+# img/ に届いた画像の処理状態 (processing/done/failed) を管理する
+spool = Spool(IMG_FOLDER)
+
+def submit_stream_job(job):
+    # ストリーミングのフレームはメモリ上のまま推論キューに入れる (満杯なら待たずに諦め、次のフレームで再開する)
+    job_store.add(job)
+    if ingest_queue.submit(job, key=job.job_id, nowait=True):
+        return True
+    job.on_finished = None # 捨てたことは StreamHub が接続に通知する
+    job_store.mark_failed(job, "推論キューが満杯です")
+    return False
+
+# /stream の WebSocket 接続 (カメラごとに最新のフレームだけを推論する)
+stream_hub = StreamHub(submit_stream_job)
+
+def current_capture_profile():
+    # 撮影プロファイルはロード済みモデルから毎回求める (モデルの再読み込みにも追従する)
+    profile = build_capture_profile(get_model_input_sizes(), DEFAULT_INPUT_SIZE)
+    profile["frame_interval_ms"] = STREAM_FRAME_INTERVAL_MS
+    return profile
+
+def check_capture_profile():
+    """モデルのロード完了を待ち、撮影プロファイルが実際のモデルに合っているかを確認してログに出す"""
+    wait_for_models()
+    profile, warnings = validate_capture_profile(get_model_input_sizes(), DEFAULT_INPUT_SIZE)
+    for warning in warnings:
+        log_event(logger, "capture_profile_warning", logging.WARNING, message=warning)
+    log_event(logger, "capture_profile", max_side=profile["max_side"], format=profile["format"],
+              quality=profile["quality"], source=profile["source"], model_input_sizes=profile["model_input_sizes"])
+
+# /metrics の取得時に計算するゲージ
+QUEUE_DEPTH.set_function(ingest_queue.depth)
+MODELS_LOADED.set_function(lambda: model_registry.stats()["resident"])
+MODELS_REGISTERED.set_function(lambda: model_registry.stats()["registered"])
+RESIDENT_MEMORY.set_function(get_rss_bytes)
+
+def folder_camera_id(image_path):
+    """img/ に置かれた画像のファイル名からカメラIDを取り出す"""
+    prefix, separator, _ = os.path.basename(image_path).partition(FOLDER_CAMERA_SEPARATOR)
+    return prefix if separator and prefix else "folder"
+
+def folder_filename(camera_id, filename):
+    """folder_camera_id でカメラIDを取り出せるよう、カメラIDを先頭に付けたファイル名にする"""
+    safe_id = re.sub(r'[^A-Za-z0-9.-]', '-', camera_id)
+    return f"{safe_id}{FOLDER_CAMERA_SEPARATOR}{filename}"
+
+def enqueue_image(image_path):
+    # 監視スレッドでは推論しない。キューが満杯なら空くまで監視スレッドを待たせる (バックプレッシャー)
+    # (タイムアウトで捨てると、同じファイルのイベントは二度と来ないため次回の起動まで img/ に取り残される)
+    job = InferenceJob(os.path.basename(image_path), path=image_path, source="folder", camera_id=folder_camera_id(image_path))
+    if ingest_queue.submit(job, key=image_path, block=True):
+        log_event(logger, "enqueued", logging.DEBUG, image=image_path, queue_depth=ingest_queue.depth())
+
+def drain_backlog(backlog):
+    """
+    起動前から img/ に溜まっていた画像 (ファイル監視では検出されない) を推論キューに入れる。
+    新着の画像より先に取り出されるよう高い優先度で入れ、すべてのワーカーで並列に処理する。
+    """
+    start = time.perf_counter()
+    for image_path in backlog:
+        job = InferenceJob(os.path.basename(image_path), path=image_path, source="backlog", camera_id=folder_camera_id(image_path))
+        # 書き込みはとうに完了しているので、書き込み完了の判定を待たない
+        file_readiness.mark_ready(image_path)
+        # キューが満杯なら空くまで待つ (バックログはタイムアウトで捨てない)
+        ingest_queue.submit(job, key=image_path, priority=PRIORITY_BACKLOG, block=True)
+    log_event(logger, "backlog_enqueued", count=len(backlog), seconds=round(time.perf_counter() - start, 3))
 
 class ImageHandler(FileSystemEventHandler):
     def on_created(self, event):
-        print(f"DEBUG: on_createdイベントがトリガーされました: {event.src_path}, is_directory: {event.is_directory}")
-        if not event.is_directory and event.src_path.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-            # ファイルが完全に書き込まれるのを待つために数秒待機
-            time.sleep(3) # 2秒から3秒に延長
-            print(f"新しくファイルが追加されました: {event.src_path}")
-            try:
-                import shutil # ファイルコピーのために追加
-
-                result_disease, result_confidence, all_detections, drawn_img_data, original_filename = run_detection_and_analyze(event.src_path)
-                print(f"推論結果概要: {result_disease}, 確信度: {result_confidence}, 総検出数: {len(all_detections)}")
-
-                if all_detections: # 検出結果がある場合 (フィルタリング後)
-                    print("--- 各学習データからの推論結果詳細 ---")
-                    # 判定率0.75以上の検出結果のみをフィルタリング
-                    filtered_detections = [d for d in all_detections if d['confidence'] >= 0.75]
-
-                    if filtered_detections: # フィルタリング後に検出結果がある場合のみ処理
-                        for i, detection in enumerate(filtered_detections):
-                            print(f"  検出 {i+1}: (モデル: {detection['model_filename']})") # モデルファイル名も表示
-                            print(f"    病気/害虫: {detection['disease']}")
-                            print(f"    確信度: {detection['confidence']}")
-                            print(f"    モデルカテゴリ: {detection['model_category']}")
-                            print(f"    バウンディングボックス: x_min={detection['box']['x_min']}, y_min={detection['box']['y_min']}, x_max={detection['box']['x_max']}, y_max={detection['box']['y_max']}")
-                        print("----------------------")
-
-                        # 検出されたすべての物体に対して画像を保存するように変更
-                        # 一時フォルダを経由せず、直接resultフォルダに保存
-                        unique_output_filename = f"detected_{uuid.uuid4()}_{original_filename}"
-                        
-                        for detection in filtered_detections:
-                            model_category = detection['model_category']
-                            # model_filename = detection['model_filename'] # 不要になったので削除
-
-                            # モデルファイル名から拡張子を除いた部分をフォルダ名にする (これは不要)
-                            # model_base_name = os.path.splitext(model_filename)[0]
-
-                            # 保存先パスのベースディレクトリを修正
-                            BASE_RESULT_DIR = os.path.join(
-                                os.path.dirname(os.path.abspath(__file__)), 
-                                'result' 
-                            )
-
-                            # 保存先パスの構築: result/カテゴリ/
-                            save_dir = os.path.join(
-                                BASE_RESULT_DIR, model_category
-                            )
-                            os.makedirs(save_dir, exist_ok=True)
-                            
-                            # 描画された画像データを直接resultフォルダに保存
-                            try:
-                                import cv2 # cv2をインポート
-                                output_filepath = os.path.join(save_dir, unique_output_filename)
-                                cv2.imwrite(output_filepath, drawn_img_data)
-                                print(f"✅ 推論画像をresultフォルダに直接保存しました: {output_filepath} (カテゴリ: {model_category})")
-                            except PermissionError:
-                                print(f"❌ ファイル保存エラー: {save_dir} への書き込み権限がありません。")
-                            except Exception as save_e:
-                                print(f"❌ ファイル保存中に予期せぬエラーが発生しました: {save_e}")
-                            
-                            time.sleep(0.5) # 保存後に少し遅延を設ける
-                    else:
-                        print("💡 判定率0.75以上の検出結果がないため、画像を保存しませんでした。")
-                else:
-                    print("💡 検出結果がないため、画像を保存しませんでした。")
-
-            except Exception as e:
-                print(f"推論中にエラーが発生しました: {e}")
-            finally:
-                # 推論処理が完了したら、元の画像をimgフォルダから削除
-                if os.path.exists(event.src_path):
-                    os.remove(event.src_path)
-                    print(f"元の画像ファイル '{event.src_path}' をimgフォルダから削除しました。")
-                # 一時フォルダ内の画像も削除 (このロジックは不要になるので削除)
-                # if os.path.exists(temp_output_path):
-                #     os.remove(temp_output_path)
-                #     print(f"一時推論結果ファイル '{temp_output_path}' を削除しました。")
+        log_event(logger, "fs_event", logging.DEBUG, type="created", path=event.src_path, is_directory=event.is_directory)
+        if not event.is_directory and event.src_path.lower().endswith(IMAGE_EXTENSIONS):
+            enqueue_image(event.src_path)
+
+    def on_closed(self, event):
+        # 書き込み用に開かれたファイルが閉じられた (close_write) = 書き込み完了
+        # キューへの投入は on_created で済んでいるので、待っているワーカーに完了を知らせるだけにする
+        if not event.is_directory and event.src_path.lower().endswith(IMAGE_EXTENSIONS):
+            file_readiness.mark_ready(event.src_path)
 
     def on_moved(self, event):
-        print(f"DEBUG: on_movedイベントがトリガーされました: From {event.src_path} to {event.dest_path}, is_directory: {event.is_directory}")
+        log_event(logger, "fs_event", logging.DEBUG, type="moved", path=event.src_path, dest_path=event.dest_path,
+                  is_directory=event.is_directory)
+        # 一時ファイルからのリネーム (アトミックな書き込み) は、リネーム時点で書き込み完了している
+        # (リネーム先には on_created が来ないため、この場合だけここでキューに入れる)
+        if not event.is_directory and event.dest_path.lower().endswith(IMAGE_EXTENSIONS) \
+                and os.path.dirname(os.path.abspath(event.dest_path)) == IMG_FOLDER:
+            file_readiness.mark_ready(event.dest_path)
+            enqueue_image(event.dest_path)
 
     def on_deleted(self, event):
-        print(f"DEBUG: on_deletedイベントがトリガーされました: {event.src_path}, is_directory: {event.is_directory}")
+        log_event(logger, "fs_event", logging.DEBUG, type="deleted", path=event.src_path, is_directory=event.is_directory)
 
     def on_modified(self, event):
-        print(f"DEBUG: on_modifiedイベントがトリガーされました: {event.src_path}, is_directory: {event.is_directory}")
+        log_event(logger, "fs_event", logging.DEBUG, type="modified", path=event.src_path, is_directory=event.is_directory)
 
 def start_file_watcher():
+    """
+    img/ の監視を開始して Observer を返す。start() から戻った時点で監視が有効になっている
+    (監視はデーモンスレッドで動くため、メインスレッドが終了すれば一緒に終了する)。
+    """
     if not os.path.exists(IMG_FOLDER):
         os.makedirs(IMG_FOLDER) # imgフォルダが存在しない場合は作成
         
@@ -125,17 +351,19 @@ def start_file_watcher():
     observer = Observer()
     observer.schedule(event_handler, IMG_FOLDER, recursive=False)
     observer.start()
-    print(f"--- ファイル監視を開始しました: {IMG_FOLDER} ---") # 監視パスを表示
-    try:
-        while True:
-            time.sleep(1) # 1秒ごとに監視をチェック
-    except KeyboardInterrupt:
-        observer.stop()
-    observer.join()
+    log_event(logger, "folder_watch_started", path=IMG_FOLDER)
+    return observer
 
 # --- ルーティングの登録 ---
 # services/routes.py で定義された Blueprint を登録し、/api/ のプレフィックスを付ける
-# app.register_blueprint(api_bp, url_prefix='/api') 
+# /api/detect-disease は推論を待たずにジョブIDを返し、推論は共有の推論ワーカーで行う
+# (キューが満杯のときもリクエストのスレッドを待たせず、すぐに 503 を返す)
+def submit_api_job(job):
+    job_store.add(job)
+    return ingest_queue.submit(job, key=job.job_id, nowait=True)
+
+init_api(job_store, submit_api_job)
+app.register_blueprint(api_bp, url_prefix='/api')
 
 # --- 静的ページのルート ---
 @app.route('/')
@@ -143,6 +371,69 @@ def index():
     # templatesフォルダ内の index.html を読み込んで表示
     return render_template('index.html')
 
+@app.route('/healthz')
+def healthz():
+    # プロセスが応答できるか (モデルのロード中でも 200 を返す)
+    return jsonify({"status": "ok", "models": get_model_status()}), 200
+
+@app.route('/readyz')
+def readyz():
+    # 推論できる状態か (全モデルのロードとウォームアップが完了していれば 200)
+    status = get_model_status()
+    return jsonify(status), 200 if status["ready"] else 503
+
+@app.route('/status')
+def pipeline_status():
+    # 推論パイプラインの状態 (キュー長など) を返す
+    return jsonify({
+        "ingest": ingest_queue.stats(),
+        "file_ready": file_readiness.stats(),
+        "spool": spool.stats(),
+        "stream": stream_hub.stats(),
+        "capture_profile": current_capture_profile(),
+        "batching": micro_batcher.stats(),
+        "result_writer": result_writer.stats(),
+        "render": render_cache.stats(),
+        "cache": result_cache.stats(),
+        "scene_gate": scene_gate.stats(),
+        "models": model_registry.stats(),
+        "cascade": cascade_policy.stats(),
+        "log": {"dropped": dropped_log_count()},
+    })
+
+@app.route('/metrics')
+def prometheus_metrics():
+    # ステージ別の処理時間・カウンター・ゲージを Prometheus のテキスト形式で返す
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/capture-profile')
+def capture_profile():
+    # カメラクライアントが撮影・エンコードすべき解像度/形式/品質 (モデルの入力サイズから決める)
+    return jsonify(current_capture_profile())
+
+@sock.route('/stream')
+def stream(ws):
+    # ブラウザなどから JPEG のフレームを連続して受け取り (バイナリメッセージ)、結果を JSON で送り返す
+    # 推論が追いつかない間に届いたフレームは、カメラごとに最新の1枚だけを残して捨てる
+    camera_id = request.args.get('camera_id') or request.remote_addr or "stream"
+    camera_stream = stream_hub.open(camera_id, ws.send)
+    camera_stream.send({
+        "type": "hello", "camera_id": camera_id,
+        "frame_interval_ms": STREAM_FRAME_INTERVAL_MS, "capture_profile": current_capture_profile(),
+    })
+    try:
+        while True:
+            message = ws.receive()
+            if message is None:
+                break
+            if isinstance(message, str):
+                continue # テキストメッセージ (ping など) は無視する
+            stream_hub.offer(camera_stream, message)
+    except ConnectionClosed:
+        pass
+    finally:
+        stream_hub.close(camera_stream)
+
 @app.route('/upload-image', methods=['POST'])
 def upload_image():
     if 'file' not in request.files:
@@ -152,24 +443,141 @@ def upload_image():
         return jsonify({"error": "ファイル名が空です"}), 400
     
     original_filename = file.filename
-    # ユニークなファイル名を生成し、IMG_FOLDERに保存
+    # ユニークなファイル名を生成
     unique_filename = f"webcam_capture_{uuid.uuid4()}_{original_filename}"
-    filepath = os.path.join(IMG_FOLDER, unique_filename)
+
+    if UPLOAD_INGEST_MODE == "memory":
+        # ディスクを経由せず、アップロードされたバイト列をそのまま推論キューに渡す
+        camera_id = request.form.get('camera_id') or request.remote_addr or "upload"
+        job = job_store.add(InferenceJob(unique_filename, data=file.read(), source="upload", camera_id=camera_id))
+        job_store.publish(job) # /jobs/<job_id> の問い合わせが別のワーカープロセスに届いても応答できるようにする
+        if not ingest_queue.submit(job, key=job.job_id, nowait=True):
+            job_store.mark_failed(job, "推論キューが満杯です")
+            return jsonify({"error": "推論キューが混雑しています。しばらくしてから再送してください"}), 503
+        log_event(logger, "upload_enqueued", logging.DEBUG, image=original_filename, job_id=job.job_id)
+        return jsonify({"message": "画像を正常にアップロードしました", "filename": unique_filename, "job_id": job.job_id}), 200
+
+    # IMG_FOLDERに保存 (カメラIDはファイル名の先頭に付けて引き継ぐ)
+    camera_id = request.form.get('camera_id') or request.remote_addr or "upload"
+    filepath = os.path.join(IMG_FOLDER, folder_filename(camera_id, unique_filename))
+    # 一時ファイルに書き込んでからリネームする (監視側はリネームを見て即座に処理できる)
+    temp_filepath = filepath + '.part'
     
     try:
-        file.save(filepath)
-        print(f"画像ファイル '{original_filename}' をIMG_FOLDERに保存しました: {filepath}")
+        file.save(temp_filepath)
+        os.replace(temp_filepath, filepath)
+        log_event(logger, "upload_saved", logging.DEBUG, image=original_filename, path=filepath)
         return jsonify({"message": "画像を正常にアップロードしました", "filename": unique_filename}), 200
     except Exception as e:
-        print(f"ファイル保存エラー: {e}")
+        log_event(logger, "upload_save_failed", logging.ERROR, image=original_filename, error=str(e))
+        if os.path.exists(temp_filepath):
+            os.remove(temp_filepath)
         return jsonify({"error": f"サーバー側でファイル保存に失敗しました: {e}"}), 500
 
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    # アップロード時に返したジョブIDで処理状況と結果を参照する
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({"error": "ジョブが見つかりません"}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/image')
+def job_image(job_id):
+    # 検出結果を描画した画像を返す (要求されたときに初めて描画する)
+    frame = render_cache.lookup(job_id)
+    if frame is None:
+        # 別のワーカープロセスで推論した画像 (またはキャッシュから外れた画像) は、result/ に保存したものを返す
+        job = job_store.get(job_id)
+        saved_image = (job.result or {}).get("saved_image") if job is not None else None
+        if saved_image:
+            return send_from_directory(result_writer.result_dir, saved_image)
+        return jsonify({"error": "描画できる画像が保持されていません"}), 404
+    ok, encoded = cv2.imencode('.jpg', render_cache.render(frame))
+    if not ok:
+        return jsonify({"error": "画像のエンコードに失敗しました"}), 500
+    return Response(encoded.tobytes(), mimetype='image/jpeg')
+
+# --- 起動処理 ---
+# img/ の監視とバックログの処理は、複数のワーカープロセスのうち1つだけが担当する
+img_watcher_lock = ProcessLock("img_watcher")
+_app_created = False
+
+def create_app(preload_models=False):
+    """
+    アプリケーションファクトリ (gunicorn などの WSGI サーバーから呼び出す)。
+
+    Args:
+        preload_models: True の場合、モデルをこのプロセスで (ロード完了まで待って) ロードしてから返す。
+            gunicorn の preload_app と組み合わせると、フォーク前にロードした重みを全ワーカーが
+            コピーオンライトで共有する。False の場合は従来どおりバックグラウンドでロードする
+            (ロード状況は /healthz と /readyz で確認できる。失敗した場合は /readyz が 503 を返す)。
+
+    推論ワーカーや監視のスレッドはフォークで引き継がれないため、ここでは起動しない。
+    フォーク後の各プロセスで start_pipeline() を呼び出す。
+    """
+    global _app_created
+    if _app_created:
+        return app
+    _app_created = True
+    if preload_models:
+        # ウォームアップ (推論用のスレッドプールの作成) はフォーク後に各ワーカーで行う
+        load_models(warmup=False)
+        # ロード済みのオブジェクトを GC の対象外にし、フォーク後の GC でページがコピーされるのを防ぐ
+        gc.freeze()
+    else:
+        start_background_model_loading()
+    return app
+
+def start_ingest_owner():
+    """img/ の監視とバックログの処理を開始する (担当の1プロセスだけで実行される)"""
+    # 先に監視を開始してから img/ を一覧する。一覧と監視開始の間に届いた画像も取りこぼさない
+    # (両方に現れた画像は IngestQueue がキーで重複を除く)
+    start_file_watcher()
+
+    # 前回の実行で処理中のまま残った画像を戻し、未処理の画像 (バックログ) を集める
+    backlog = spool.recover()
+    if backlog:
+        threading.Thread(target=drain_backlog, args=(backlog,), daemon=True).start()
+
+def start_pipeline(warmup=False, processes=1):
+    """
+    このプロセスの推論ワーカーと監視スレッドを起動する。
+    gunicorn では post_fork で各ワーカーが呼び出す (gunicorn.conf.py)。
+
+    Args:
+        warmup: True の場合、常駐しているモデルで1回ずつ推論しておく。
+        processes: 同じマシンで推論するプロセス数 (gunicorn のワーカー数)。torch のスレッド数をコア数から分割する。
+    """
+    if processes > 1:
+        threads = limit_torch_threads(processes)
+        log_event(logger, "torch_threads_limited", threads=threads, processes=processes)
+    if warmup:
+        warmup_models()
+
+    # 推論ワーカーを起動
+    micro_batcher.start()
+    ingest_queue.start()
+    if ingest_queue.worker_count < micro_batcher.max_batch_size:
+        # 同時に結果を待てるワーカーがバッチサイズより少ないと、バッチは最大でもワーカー数までしか埋まらない
+        log_event(logger, "batch_size_unreachable", logging.WARNING,
+                  workers=ingest_queue.worker_count, max_batch_size=micro_batcher.max_batch_size)
+
+    # モデルのロード完了後に、撮影プロファイルが実際のモデルに合っているかを確認する
+    threading.Thread(target=check_capture_profile, name="capture-profile-check", daemon=True).start()
+
+    # モデルフォルダを監視し、.pt の追加・更新・削除をバックグラウンドで反映する (モデルはプロセスごとに持つため各プロセスで監視する)
+    start_model_dir_watcher()
+
+    # img/ の監視はロックを取得できた1プロセスだけが行う (担当のプロセスが終了したら別のプロセスが引き継ぐ)
+    run_as_leader(img_watcher_lock, start_ingest_owner)
+
 if __name__ == '__main__':
-    # ファイル監視を別スレッドで開始
-    watcher_thread = threading.Thread(target=start_file_watcher)
-    watcher_thread.daemon = True # メインスレッドが終了したら、監視スレッドも終了する
-    watcher_thread.start()
-    
+    # 開発用: 1プロセスで起動する (本番では gunicorn -c gunicorn.conf.py で起動する)
+    create_app()
+    start_pipeline()
+
     # 開発サーバーの起動
     # ファイル監視とFlaskのリローダーの競合を避けるため、use_reloader=Falseを設定
-    app.run(debug=True, use_reloader=False)
\ No newline at end of file
+    # デバッグモードは FLASK_DEBUG=1 のときだけ有効にする
+    app.run(debug=os.environ.get("FLASK_DEBUG") == "1", use_reloader=False)
\ No newline at end of file
@@ -0,0 +1,30 @@
+# 本番用の gunicorn 設定
+#   gunicorn -c gunicorn.conf.py
+# 開発時は従来どおり python app.py (1プロセスの開発サーバー) で起動できる。
+import os
+
+_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# フォーク前 (マスタープロセス) でアプリを作成し、モデルをロードしておく。
+# ワーカーはフォーク時に重みをコピーオンライトで共有するので、ワーカー数を増やしてもモデル分のメモリは増えにくい。
+wsgi_app = "app:create_app(preload_models=True)"
+preload_app = True
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("GUNICORN_WORKERS", "2"))
+# WebSocket (/stream) とロングポーリング (/api/detect-disease/<job_id>?wait=) は接続を保持するため、スレッドワーカーを使う
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "16"))
+# モデルのロードに時間がかかるため、タイムアウトは長めにする
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+
+# ジョブの状態はワーカー間で共有する (受け付けたワーカーと別のワーカーに問い合わせが届いても結果を返せるように)
+os.environ.setdefault("JOB_SHARE_DIR", os.path.join(_ROOT, "run", "jobs"))
+
+def post_fork(server, worker):
+    # 推論ワーカーや監視のスレッドはフォークで引き継がれないため、ワーカーごとに起動する
+    # (img/ の監視はロックファイルを取得できた1ワーカーだけが担当する)
+    # torch はプロセスごとに全コア分のスレッドを使おうとするため、ワーカー数でコアを分け合う
+    from app import start_pipeline
+    start_pipeline(warmup=True, processes=workers)
@@ -1,8 +1,24 @@
 import os
-from ultralytics import YOLO
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any, Tuple, Optional
+import time
 import cv2 # 画像描画のために追加
-import uuid # ユニークなファイル名生成のために追加
+import numpy as np
+import threading
+import logging
+import multiprocessing
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from .onnx_backend import load_backend_model
+from .model_registry import LazyModel, ModelRegistry
+from .detections import Detections, RawDetections, empty_raw, make_raw
+from .render_service import AnnotatedFrame
+from .cascade_service import CascadePolicy
+from .log_service import get_logger, log_event
+from .metrics_service import MODEL_INFERENCE_SECONDS
+from .tile_service import (
+    TILE_INCLUDE_FULL_FRAME, TILE_MAX_IN_FLIGHT, merge_tile_detections, should_tile, tile_signature, tile_windows
+)
+
+logger = get_logger("ai")
 
 # モデルファイルが存在するディレクトリへの相対パスを設定
 # services/ から見て '../yolov8_DataSet/' にアクセス
@@ -39,120 +55,787 @@ def get_model_paths_from_dir(model_dir: str) -> List[Tuple[str, str]]:
 
 MODEL_PATHS = get_model_paths_from_dir(MODEL_DIR)
 
+# 推論に使うバックエンド
+#   "torch"    ... .pt を Ultralytics (PyTorch) でそのまま実行 (デフォルト)
+#   "onnx"     ... 初回ロード時に ONNX へエクスポートし、onnxruntime で実行
+#   "openvino" ... 初回ロード時に OpenVINO IR へエクスポートして実行
+# エクスポート結果は .pt のハッシュごとにキャッシュされる (services/onnx_backend.py)
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "torch")
+
 # モデルロード時に使用するリスト (サーバー起動時にメモリにロード)
-yolo_model_list: List[Tuple[YOLO, str, str]] = [] # YOLOオブジェクト, カテゴリ, モデルファイル名
+# (ultralytics/torch の import は重いため、モデルをロードするときに初めて import する)
+yolo_model_list: List[Tuple[Any, str, str]] = [] # YOLOオブジェクト, カテゴリ, モデルファイル名
+# ロードしたモデルファイルの (更新時刻, サイズ)。結果キャッシュのキーに使う
+loaded_model_files: Dict[str, Tuple[int, int]] = {}
 
-# --- サーバー起動時に一度だけ実行される初期化処理 ---
-def load_models():
-    """MODEL_PATHSに指定されたすべてのYOLOv8モデルをロードする"""
-    print("--- YOLOv8モデルの初期化中 ---")
-    
-    # グローバルリストをクリア（念のため）
-    yolo_model_list.clear() 
-
-    for model_name, category in MODEL_PATHS: # model_name は "tomato_best.pt" など
-        full_path = os.path.join(MODEL_DIR, model_name)
-        
-        if not os.path.exists(full_path):
-            print(f"❌ モデルファイルが見つかりません: {full_path}")
-            # モデルが見つからない場合は、推論時にエラーを発生させるため、ロードはスキップ
-            continue
+# 並列にロードするモデル数
+MODEL_LOAD_PARALLEL = int(os.environ.get("MODEL_LOAD_PARALLEL", "4"))
+# ロード直後にダミー画像で推論し、初回推論の遅さを起動時に済ませる
+MODEL_WARMUP = os.environ.get("MODEL_WARMUP", "1") == "1"
+# 推論時にモデルのロード完了を待つ最大秒数
+MODEL_READY_TIMEOUT = float(os.environ.get("MODEL_READY_TIMEOUT", "300"))
+
+# モデルごとのロード状態 (/healthz, /readyz 表示用)
+# state: pending -> loading -> warming -> ready / failed
+model_load_status: Dict[str, Dict[str, Any]] = {}
+_load_state: Dict[str, Any] = {"state": "not_started", "started_at": None, "finished_at": None, "error": None}
+_models_loaded = threading.Event() # ロードが (成功/失敗にかかわらず) 終わったら set される
+
+def _load_model_file(model_name: str, category: str, warmup: bool = MODEL_WARMUP) -> Any:
+    """1つのモデルをロードしてウォームアップする (レジストリのローダー)。失敗した場合は例外を投げる"""
+    status = model_load_status.setdefault(model_name, {"category": category, "state": "pending", "error": None})
+    full_path = os.path.join(MODEL_DIR, model_name)
+
+    if not os.path.exists(full_path):
+        log_event(logger, "model_file_missing", logging.ERROR, model=model_name, path=full_path)
+        # モデルが見つからない場合は、推論時にエラーを発生させるため、ロードはスキップ
+        status.update(state="failed", error="モデルファイルが見つかりません")
+        raise FileNotFoundError(full_path)
 
+    try:
+        # YOLOモデルをロード
+        status["state"] = "loading"
+        start = time.perf_counter()
+        model = load_backend_model(full_path, INFERENCE_BACKEND)
+        status["load_seconds"] = round(time.perf_counter() - start, 3)
+
+        if warmup:
+            # ダミー画像で1回推論しておく (初回推論時のグラフ構築などを起動時に済ませる)
+            status["state"] = "warming"
+            status["warmup_seconds"] = _warmup_model(model)
+
+        status.update(state="ready", error=None)
+        log_event(logger, "model_loaded", model=model_name, category=category, backend=INFERENCE_BACKEND,
+                  load_seconds=status["load_seconds"], warmup_seconds=status.get("warmup_seconds"))
+        return model
+    except Exception as e:
+        status.update(state="failed", error=str(e))
+        log_event(logger, "model_load_failed", logging.ERROR, model=model_name, error=str(e))
+        raise
+
+# メモリ上限付きのモデルレジストリ (MODEL_MEMORY_BUDGET_MB, MODEL_PINNED で設定)
+# 上限なし (デフォルト) の場合は従来どおり全モデルを起動時にロードして常駐させる
+model_registry = ModelRegistry(_load_model_file)
+
+def _warmup_model(model: Any) -> float:
+    start = time.perf_counter()
+    size = get_model_input_size(model)
+    _predict_raw(model, [np.full((size, size, 3), LETTERBOX_COLOR[0], dtype=np.uint8)], size)
+    return round(time.perf_counter() - start, 3)
+
+def warmup_models():
+    """
+    メモリに常駐しているモデルで1回ずつ推論しておく。
+    フォーク前に (ウォームアップなしで) ロードした場合に、フォーク後の各ワーカーで呼び出す。
+    """
+    for model, _, model_name in list(yolo_model_list):
+        if not model_registry.is_resident(model_name):
+            continue
         try:
-            # YOLOモデルをロード
-            model = YOLO(full_path)
-            yolo_model_list.append((model, category, model_name)) # モデルファイル名も保存
-            print(f"✅ モデルロード成功: {model_name} (カテゴリ: {category})")
+            model_load_status.get(model_name, {})["warmup_seconds"] = _warmup_model(model)
         except Exception as e:
-            print(f"❌ モデルのロード中にエラーが発生しました ({model_name}): {e}")
-            
-    if not yolo_model_list:
-        # 少なくとも1つモデルがないと推論できないため、エラーとして扱う
-        raise ConnectionError("AIモデルのロードに失敗しました。ファイルパスとファイル名を確認してください。")
+            log_event(logger, "model_warmup_failed", logging.WARNING, model=model_name, error=str(e))
+
+def _prepare_model(model_name: str, category: str, warmup: bool = MODEL_WARMUP) -> Optional[Tuple[LazyModel, str, str, Tuple[int, int]]]:
+    """
+    モデルをレジストリに登録する。上限なしの場合と固定モデルはここでロードし、
+    それ以外は初回の推論時にロードする。ロードに失敗した場合は None
+    """
+    full_path = os.path.join(MODEL_DIR, model_name)
+    try:
+        st = os.stat(full_path)
+    except FileNotFoundError:
+        log_event(logger, "model_file_missing", logging.ERROR, model=model_name, path=full_path)
+        model_load_status[model_name] = {"category": category, "state": "failed", "error": "モデルファイルが見つかりません"}
+        return None
+    file_stat = (st.st_mtime_ns, st.st_size)
+
+    model = None
+    if not model_registry.bounded or model_registry.is_pinned(model_name, category):
+        try:
+            model = _load_model_file(model_name, category, warmup)
+        except Exception:
+            return None
+    else:
+        model_load_status[model_name] = {"category": category, "state": "lazy", "error": None}
+    proxy = model_registry.register(model_name, category, full_path, file_stat, model=model)
+    return proxy, category, model_name, file_stat
+
+# --- サーバー起動時に一度だけ実行される初期化処理 ---
+def load_models(warmup: bool = MODEL_WARMUP):
+    """
+    MODEL_PATHSに指定されたすべてのYOLOv8モデルを並列にロードする。
+    warmup=False の場合はウォームアップを省略する (フォーク前にロードし、ウォームアップは warmup_models() で各ワーカーが行う)
+    """
+    log_event(logger, "models_loading", models=len(MODEL_PATHS), backend=INFERENCE_BACKEND)
+    _models_loaded.clear()
+    _load_state.update(state="loading", started_at=time.time(), finished_at=None, error=None)
+    model_load_status.clear()
+    for model_name, category in MODEL_PATHS:
+        model_load_status[model_name] = {"category": category, "state": "pending", "error": None}
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, MODEL_LOAD_PARALLEL), thread_name_prefix="model-loader") as executor:
+            loaded = list(executor.map(lambda entry: _prepare_model(*entry, warmup=warmup), MODEL_PATHS))
+
+        # ロードが終わった順ではなく MODEL_PATHS の順で並べ、推論結果の順番を固定する
+        loaded = [entry for entry in loaded if entry is not None]
+        yolo_model_list[:] = [(model, category, model_name) for model, category, model_name, _ in loaded]
+        loaded_model_files.clear()
+        loaded_model_files.update({model_name: file_stat for _, _, model_name, file_stat in loaded})
+
+        if not yolo_model_list:
+            # 少なくとも1つモデルがないと推論できないため、エラーとして扱う
+            raise ConnectionError("AIモデルのロードに失敗しました。ファイルパスとファイル名を確認してください。")
+        _load_state.update(state="ready", finished_at=time.time())
+        log_event(logger, "models_ready", models=len(yolo_model_list), resident=model_registry.stats()["resident"],
+                  seconds=round(_load_state["finished_at"] - _load_state["started_at"], 1))
+    except Exception as e:
+        _load_state.update(state="failed", finished_at=time.time(), error=str(e))
+        raise
+    finally:
+        _models_loaded.set()
+
+def start_background_model_loading() -> threading.Thread:
+    """モデルのロードをバックグラウンドで開始する (Webサーバーはロード完了を待たずに起動できる)"""
+    def _run():
+        try:
+            load_models()
+        except ConnectionError as e:
+            # モデルロード失敗は致命的なので、ログに出力 (/readyz も失敗を返す)
+            log_event(logger, "models_unavailable", logging.CRITICAL, error=str(e))
+
+    thread = threading.Thread(target=_run, name="model-loading", daemon=True)
+    thread.start()
+    return thread
+
+def wait_for_models(timeout: float = MODEL_READY_TIMEOUT) -> bool:
+    """モデルのロードが終わるまで待つ。推論できるモデルがあれば True"""
+    _models_loaded.wait(timeout)
+    return bool(yolo_model_list)
+
+def get_model_status() -> Dict[str, Any]:
+    """モデルのロード状況 (全体とモデルごと) を返す"""
+    return {
+        **_load_state,
+        "ready": _load_state["state"] == "ready",
+        "backend": INFERENCE_BACKEND,
+        "models": {name: dict(status) for name, status in model_load_status.items()},
+        "registry": model_registry.stats(),
+        "last_reload": dict(_last_reload) or None,
+    }
+
+def get_rss_bytes() -> int:
+    """現在のプロセスの常駐メモリ (RSS) をバイト単位で返す"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # /proc がない環境 (macOSなど) ではピーク値で代用する
+        import resource
+        import sys
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+_reload_lock = threading.Lock()
+_last_reload: Dict[str, Any] = {}
+
+def reload_models() -> Dict[str, Any]:
+    """
+    MODEL_DIR を再スキャンし、追加・更新されたモデルだけをロード/ウォームアップしてから
+    yolo_model_list を一度に入れ替える。変更のないモデルは再ロードしない。
+    推論は入れ替え前のスナップショットで続行されるため、処理中の推論は止まらない。
+    (メモリ上限を設定している場合、固定されていないモデルは登録だけ行い、次の推論時にロードする)
+    """
+    with _reload_lock:
+        start = time.perf_counter()
+        rss_before = get_rss_bytes()
+        new_paths = get_model_paths_from_dir(MODEL_DIR)
+        current = {model_name: (model, category) for model, category, model_name in yolo_model_list}
+
+        added, changed, unchanged, failed = [], [], [], []
+        new_entries: List[Optional[Tuple[LazyModel, str, str, Tuple[int, int]]]] = []
+        for model_name, category in new_paths:
+            full_path = os.path.join(MODEL_DIR, model_name)
+            try:
+                st = os.stat(full_path)
+            except FileNotFoundError:
+                new_entries.append(None)
+                continue
+            file_stat = (st.st_mtime_ns, st.st_size)
+            if model_name in current and loaded_model_files.get(model_name) == file_stat:
+                model, _ = current[model_name]
+                new_entries.append((model, category, model_name, file_stat))
+                unchanged.append(model_name)
+                continue
+            (changed if model_name in current else added).append(model_name)
+            model_load_status[model_name] = {"category": category, "state": "pending", "error": None}
+            entry = _prepare_model(model_name, category)
+            if entry is None:
+                failed.append(model_name)
+            new_entries.append(entry)
+
+        for model_name in failed:
+            # 更新後のロードに失敗したモデルは、古い内容のまま使い続けずに外す
+            model_registry.unregister(model_name)
+
+        new_names = {model_name for model_name, _ in new_paths}
+        removed = [model_name for model_name in current if model_name not in new_names]
+        loaded = [entry for entry in new_entries if entry is not None]
+
+        if added or changed or removed:
+            # 新しいモデルの準備ができてから一度に入れ替える
+            yolo_model_list[:] = [(model, category, model_name) for model, category, model_name, _ in loaded]
+            loaded_model_files.clear()
+            loaded_model_files.update({model_name: file_stat for _, _, model_name, file_stat in loaded})
+            MODEL_PATHS[:] = new_paths
+            for model_name in removed:
+                model_load_status.pop(model_name, None)
+                model_registry.unregister(model_name)
+            # プロセスワーカーは古いモデルを持っているため作り直す (次の推論時に再作成される)
+            _reset_process_executors()
+
+        report = {
+            "added": added,
+            "changed": changed,
+            "removed": removed,
+            "unchanged": unchanged,
+            "failed": failed,
+            "reload_seconds": round(time.perf_counter() - start, 3),
+            "rss_delta_mb": round((get_rss_bytes() - rss_before) / (1024 * 1024), 1),
+            "finished_at": time.time(),
+        }
+        _last_reload.clear()
+        _last_reload.update(report)
+        log_event(logger, "models_reloaded", added=added, changed=changed, removed=removed, failed=failed,
+                  reload_seconds=report["reload_seconds"], rss_delta_mb=report["rss_delta_mb"])
+        return report
+
+def get_model_signature() -> str:
+    """
+    ロード済みモデルの組み合わせ (ファイル名と更新時刻) を表す文字列。モデルが変わると値も変わる。
+    推論バックエンド、タイル推論、カスケードの設定によっても結果が変わるため、それらの設定も含める。
+    """
+    signature = "|".join(
+        f"{name}:{mtime_ns}:{size}" for name, (mtime_ns, size) in sorted(loaded_model_files.items())
+    )
+    signature += f"|backend:{INFERENCE_BACKEND}|tile:{tile_signature()}"
+    if cascade_policy.enabled:
+        signature += f"|cascade:{cascade_policy.signature()}"
+    return signature
+
+def get_model_input_sizes() -> Dict[str, int]:
+    """
+    モデルごとの入力サイズ (imgsz)。レジストリが覚えているサイズだけを返し、モデルをロードすることはない。
+    (遅延ロードのモデルは一度ロードされるまで含まれない。/capture-profile や /status から呼ばれるため)
+    """
+    sizes = {}
+    for model, _, model_name in list(yolo_model_list):
+        input_size = model_registry.cached_input_size(model_name)
+        if input_size is not None:
+            sizes[model_name] = input_size
+        elif model_registry.is_resident(model_name):
+            # imgsz を持たないモデルは常駐していれば既定のサイズになる (ロードは発生しない)
+            sizes[model_name] = get_model_input_size(model)
+    return sizes
 
 # サーバー起動時にこの関数を呼び出す必要があるため、外部から呼び出せるようにしておく
 # NOTE: 適切なタイミングで routes.py や app.py から load_models() を呼び出す必要があります。
 
+# --- 前処理 (デコード/レターボックス) ---
+LETTERBOX_COLOR = (114, 114, 114) # Ultralytics と同じパディング色
+DEFAULT_INPUT_SIZE = 640 # モデルに imgsz 情報がない場合の入力サイズ
+LETTERBOX_STRIDE = 32 # YOLOv8 の最大ストライド。パディング後の大きさはこの倍数にする
+
+class _Stage:
+    """with文で囲んだ区間の処理時間(秒)を timings に加算する小さなヘルパー"""
+    def __init__(self, timings: Optional[Dict[str, float]], name: str):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.timings is not None:
+            self.timings[self.name] = self.timings.get(self.name, 0.0) + (time.perf_counter() - self.start)
+        return False
+
+def get_model_input_size(model: Any) -> int:
+    """モデルの学習時の入力サイズ (imgsz) を返す。不明な場合は DEFAULT_INPUT_SIZE"""
+    imgsz = getattr(model, 'overrides', {}).get('imgsz') or DEFAULT_INPUT_SIZE
+    if isinstance(imgsz, (list, tuple)):
+        imgsz = max(imgsz)
+    return int(imgsz)
+
+def letterbox_shape(shape: Tuple[int, ...], new_size: int) -> Tuple[int, int]:
+    """
+    画像を new_size に収まるよう縮小したときの大きさを、LETTERBOX_STRIDE の倍数に切り上げた (高さ, 幅)。
+    正方形まで埋めずに済む最小の長方形 (Ultralytics の rect/auto と同じ考え方) になる。
+    """
+    h, w = shape[:2]
+    ratio = min(new_size / h, new_size / w)
+    new_h, new_w = int(round(h * ratio)), int(round(w * ratio))
+    return -(-new_h // LETTERBOX_STRIDE) * LETTERBOX_STRIDE, -(-new_w // LETTERBOX_STRIDE) * LETTERBOX_STRIDE
+
+def batch_letterbox_shape(shapes: List[Tuple[int, ...]], new_size: int) -> Tuple[int, int]:
+    """1バッチにまとめる画像を同じ大きさにそろえるため、全画像の letterbox_shape を収められる (高さ, 幅) を返す"""
+    padded = [letterbox_shape(shape, new_size) for shape in shapes]
+    return max(h for h, _ in padded), max(w for _, w in padded)
+
+def letterbox(img: np.ndarray, new_size: int, shape: Optional[Tuple[int, int]] = None) -> Tuple[np.ndarray, float, Tuple[int, int]]:
+    """
+    アスペクト比を保ったまま new_size に収まるよう縮小し、shape (高さ, 幅) になるよう余白をパディングする。
+    shape を省略した場合は letterbox_shape の大きさにする。
+    Ultralytics の LetterBox と同じ配置 (中央寄せ) にすることで、モデル側での再リサイズを不要にする。
+
+    Returns:
+        (レターボックス済み画像, 縮小率, (左パディング, 上パディング))
+    """
+    h, w = img.shape[:2]
+    out_h, out_w = shape or letterbox_shape(img.shape, new_size)
+    ratio = min(new_size / h, new_size / w)
+    new_w, new_h = int(round(w * ratio)), int(round(h * ratio))
+    if (new_w, new_h) != (w, h):
+        img = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    dw, dh = (out_w - new_w) / 2, (out_h - new_h) / 2
+    top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
+    left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
+    img = cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=LETTERBOX_COLOR)
+    return img, ratio, (left, top)
+
+def _unletterbox_boxes(xyxy: np.ndarray, ratio: float, pad: Tuple[int, int], shape: Tuple[int, ...]) -> np.ndarray:
+    """レターボックス座標のボックス (N, 4) をまとめて元画像の座標 (整数) に戻す"""
+    h, w = shape[:2]
+    left, top = pad
+    boxes = (xyxy.astype(np.float64) - (left, top, left, top)) / ratio
+    boxes = np.clip(boxes, 0, (w, h, w, h))
+    return boxes.astype(np.int32) # 0以上なので切り捨て (従来の int() と同じ)
+
+# --- 複数モデルの並列推論 ---
+# INFERENCE_EXECUTOR:
+#   "serial"  ... 従来どおり1モデルずつ順番に推論 (デフォルト)
+#   "thread"  ... スレッドプールで全モデルを同時に推論 (torchのスレッド数はコア数を並列数で分割)
+#   "process" ... プロセスプールで推論。各ワーカーが自分の担当モデルだけをロードする
+INFERENCE_EXECUTOR = os.environ.get("INFERENCE_EXECUTOR", "serial")
+# 同時に推論するモデル数の上限 (0 の場合はロード済みモデル数)
+INFERENCE_MAX_PARALLEL = int(os.environ.get("INFERENCE_MAX_PARALLEL", "0"))
+
+_executor_lock = threading.Lock()
+_thread_executor: Optional[ThreadPoolExecutor] = None
+_process_executors: List[ProcessPoolExecutor] = [] # ワーカーごとの単一プロセスプール
+_process_assignment: Dict[str, int] = {} # モデルファイル名 -> 担当ワーカー番号
+
+# プロセスワーカー側でロードしたモデル (モデルファイル名 -> YOLOなど)
+_worker_models: Dict[str, Any] = {}
+
+def _max_parallel(model_count: int) -> int:
+    limit = INFERENCE_MAX_PARALLEL if INFERENCE_MAX_PARALLEL > 0 else model_count
+    return max(1, min(limit, model_count))
+
+# このプロセスが推論に使ってよいコア数 (同じマシンで複数のプロセスが推論する場合は limit_torch_threads で分割する)
+_cpu_share = os.cpu_count() or 1
+
+def _torch_threads_per_worker(parallel: int) -> int:
+    """並列数に応じて、1モデルあたりに割り当てる torch の intra-op スレッド数を決める"""
+    return max(1, _cpu_share // parallel)
+
+def limit_torch_threads(processes: int) -> int:
+    """
+    同じマシンで processes 個のプロセス (gunicorn のワーカーなど) が推論する場合に、
+    このプロセスの torch の intra-op スレッド数をコア数の 1/processes にする (コアの奪い合いを防ぐ)。
+    設定したスレッド数を返す。
+    """
+    global _cpu_share
+    import torch
+    _cpu_share = max(1, (os.cpu_count() or 1) // max(1, processes))
+    torch.set_num_threads(_cpu_share)
+    return _cpu_share
+
+def _predict_raw(model: Any, inputs: List[np.ndarray], size: int) -> List[RawDetections]:
+    """
+    1つのモデルで複数画像をまとめて (1バッチで) 推論し、画像ごとの結果を
+    プロセス間でも受け渡せる NumPy 配列 (RawDetections) に変換して返す。
+    """
+    if isinstance(model, LazyModel):
+        # 複数の推論ワーカー (BATCH_MAX_SIZE=1 の場合や並列推論) から同じモデルを同時に呼ばないようにする
+        with model.inference_lock:
+            return _predict_raw(model.resolve(), inputs, size)
+    if hasattr(model, "predict_raw"):
+        # onnxruntime で直接実行する検出器は、同じ形式の結果を自分で返す
+        return model.predict_raw(inputs)
+    results = model(inputs if len(inputs) > 1 else inputs[0], imgsz=size)
+    raw_per_image: List[RawDetections] = []
+    for r in results:
+        if r.boxes is None or len(r.boxes) == 0:
+            raw_per_image.append(empty_raw())
+            continue
+        # ボックスごとに .item() を呼ばず、テンソル全体を1回で NumPy に変換する
+        # (boxes.data の列: x1, y1, x2, y2, [track_id,] 確信度, クラスID)
+        data = r.boxes.data.cpu().numpy()
+        raw_per_image.append(make_raw(data[:, -1], data[:, -2], data[:, :4]))
+    return raw_per_image
+
+def _timed_predict(model: Any, inputs: List[np.ndarray], size: int) -> Tuple[List[RawDetections], float]:
+    start = time.perf_counter()
+    raw = _predict_raw(model, inputs, size)
+    return raw, time.perf_counter() - start
+
+def _process_worker_init(model_files: List[str], torch_threads: int):
+    """プロセスワーカーの初期化: 担当モデルだけをロードする"""
+    import torch
+    torch.set_num_threads(torch_threads)
+    for model_name in model_files:
+        _worker_models[model_name] = load_backend_model(os.path.join(MODEL_DIR, model_name), INFERENCE_BACKEND)
+
+def _process_predict(model_name: str, inputs: List[np.ndarray], size: int) -> Tuple[List[RawDetections], float]:
+    return _timed_predict(_worker_models[model_name], inputs, size)
+
+def _get_thread_executor(models: List[Tuple[Any, str, str]]) -> ThreadPoolExecutor:
+    global _thread_executor
+    with _executor_lock:
+        if _thread_executor is None:
+            import torch
+            parallel = _max_parallel(len(models))
+            # torch.set_num_threads はプロセス全体に効くため、コア数を並列数で分割して設定する
+            torch.set_num_threads(_torch_threads_per_worker(parallel))
+            _thread_executor = ThreadPoolExecutor(max_workers=parallel, thread_name_prefix="yolo-infer")
+            log_event(logger, "inference_executor_started", executor="thread", parallel=parallel)
+        return _thread_executor
+
+def _get_process_executor(model_name: str, models: List[Tuple[Any, str, str]]) -> Executor:
+    with _executor_lock:
+        if model_name not in _process_assignment:
+            # 担当表にないモデル (新規ロード等) があればワーカーを作り直す
+            for executor in _process_executors:
+                executor.shutdown(wait=False)
+            _process_executors.clear()
+            _process_assignment.clear()
+
+            parallel = _max_parallel(len(models))
+            assignments: List[List[str]] = [[] for _ in range(parallel)]
+            for index, (_, _, name) in enumerate(models):
+                assignments[index % parallel].append(name)
+                _process_assignment[name] = index % parallel
+            # torch と fork の相性問題を避けるため spawn でワーカーを起動する
+            context = multiprocessing.get_context("spawn")
+            for model_files in assignments:
+                _process_executors.append(ProcessPoolExecutor(
+                    max_workers=1,
+                    mp_context=context,
+                    initializer=_process_worker_init,
+                    initargs=(model_files, _torch_threads_per_worker(parallel)),
+                ))
+            log_event(logger, "inference_executor_started", executor="process", parallel=parallel)
+        return _process_executors[_process_assignment[model_name]]
+
+def _run_models(
+    models: List[Tuple[Any, str, str]],
+    batch_inputs: Dict[int, List[np.ndarray]],
+    all_models: Optional[List[Tuple[Any, str, str]]] = None
+) -> List[Tuple[List[RawDetections], float]]:
+    """
+    models の各モデルで推論し、models と同じ順番で (画像ごとの生の検出結果, 推論時間) のリストを返す。
+    batch_inputs は入力サイズごとのレターボックス済み画像のリストで、各モデルは1バッチで推論する。
+    並列実行した場合も結果の順番はモデルの順番に固定される。
+    all_models はワーカーへのモデルの割り当てに使う全モデルのリスト (一部のモデルだけ実行する場合に渡す)。
+    """
+    all_models = all_models or models
+    if INFERENCE_EXECUTOR == "serial" or len(models) <= 1:
+        return [
+            _timed_predict(model, batch_inputs[get_model_input_size(model)], get_model_input_size(model))
+            for model, _, _ in models
+        ]
+
+    futures = []
+    for model, _, model_filename in models:
+        size = get_model_input_size(model)
+        inputs = batch_inputs[size]
+        if INFERENCE_EXECUTOR == "process":
+            futures.append(_get_process_executor(model_filename, all_models).submit(_process_predict, model_filename, inputs, size))
+        else:
+            futures.append(_get_thread_executor(all_models).submit(_timed_predict, model, inputs, size))
+    return [future.result() for future in futures]
+
+def _reset_process_executors():
+    """プロセスワーカーを破棄する (次の推論時に最新のモデル構成で作り直される)"""
+    with _executor_lock:
+        for executor in _process_executors:
+            executor.shutdown(wait=False)
+        _process_executors.clear()
+        _process_assignment.clear()
+
+def shutdown_inference_executors():
+    """並列推論用のスレッドプール/プロセスプールを終了する"""
+    global _thread_executor
+    with _executor_lock:
+        if _thread_executor is not None:
+            _thread_executor.shutdown(wait=True)
+            _thread_executor = None
+        for executor in _process_executors:
+            executor.shutdown(wait=True)
+        _process_executors.clear()
+        _process_assignment.clear()
+
 # --- 推論実行ロジック ---
-def run_detection_and_analyze(image_path: str) -> Tuple[str, float, List[Dict[str, Any]], Any, str]: # 戻り値に画像データとファイル名を追加
+def decode_image_bytes(data: bytes) -> Optional[np.ndarray]:
+    """エンコード済み画像 (JPEG/PNGなど) のバイト列をメモリ上でBGR画像にデコードする"""
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+# モデルのカスケード設定 (CASCADE_CONFIG のファイルがなければ無効)
+cascade_policy = CascadePolicy.load()
+
+def _max_confidence_by_category(
+    outputs: List[Optional[Tuple[RawDetections, float]]],
+    models: List[Tuple[Any, str, str]]
+) -> Dict[str, float]:
+    """ここまでに実行したモデルの結果から、カテゴリごとの最大確信度を求める (カスケードの条件判定用)"""
+    best: Dict[str, float] = {}
+    for (_, category, _), output in zip(models, outputs):
+        if output is not None and len(output[0].confidences):
+            best[category] = max(best.get(category, 0.0), float(output[0].confidences.max()))
+    return best
+
+class FrameInput:
+    """run_detection_batch に渡す1枚分の入力 (path / デコード済み画像 / バイト列 のいずれか)"""
+    __slots__ = ("image_path", "image", "image_bytes", "timings")
+
+    def __init__(
+        self,
+        image_path: str,
+        image: Optional[np.ndarray] = None,
+        image_bytes: Optional[bytes] = None,
+        timings: Optional[Dict[str, float]] = None
+    ):
+        self.image_path = image_path
+        self.image = image
+        self.image_bytes = image_bytes
+        self.timings = timings
+
+def run_detection_and_analyze(
+    image_path: str,
+    image: Optional[np.ndarray] = None,
+    timings: Optional[Dict[str, float]] = None,
+    image_bytes: Optional[bytes] = None
+) -> Tuple[str, float, Detections, Optional[AnnotatedFrame], str]:
+    """
+    ロード済みのすべてのモデルで1枚の画像を推論し、結果を統合・分析して返す (run_detection_batch の1枚版)。
+    戻り値は (病名, 確信度, 検出結果, 描画前の画像, 元のファイル名)。
+
+    画像のデコードは1回だけ行い、入力サイズごとに1回だけレターボックスした配列を
+    すべてのモデルで共有する (モデルの数だけJPEGをデコードし直さない)。
+    検出結果は列ごとの配列を持つ Detections で返す。JSON や DB に渡すときは to_dicts() で変換する。
+    描画済み画像の代わりに AnnotatedFrame を返すので、必要になった時点で render() で描画する。
+
+    Args:
+        image_path: 画像ファイルのパス (image を渡した場合はファイル名としてのみ使用)。
+        image: デコード済みのBGR画像。渡された場合はファイルを読み込まない。
+        timings: 渡された場合、各ステージの処理時間(秒)をこの辞書に書き込む。
+        image_bytes: エンコード済み画像のバイト列。渡された場合はディスクを経由せずメモリ上でデコードする。
+    """
+    return run_detection_batch([FrameInput(image_path, image=image, image_bytes=image_bytes, timings=timings)])[0]
+
+def run_detection_batch(frames: List[FrameInput]) -> List[Tuple[str, float, Detections, Optional[AnnotatedFrame], str]]:
     """
-    ロード済みのすべてのモデルで推論を実行し、結果を統合・分析して返す。
-    routes.py が期待する3つの値を返すように修正。
+    複数枚の画像をまとめて推論する。各モデルは全画像を1バッチで1回だけ推論し、
+    結果は画像ごとに分けて run_detection_and_analyze と同じ形式で返す。
+    カスケード設定がある場合、後段のモデルは条件を満たした画像だけをまとめて推論する。
+    TILE_MODE に応じて、高解像度の画像はタイル分割して推論する (services/tile_service.py)。
     """
-    if not yolo_model_list:
+    if not wait_for_models():
         raise ConnectionError("YOLOv8モデルがロードされていません。")
 
-    all_detections: List[Dict[str, Any]] = []
-    
-    # 元の画像を読み込み、描画のために使用
-    original_img = cv2.imread(image_path)
-    if original_img is None:
-        print(f"ERROR: 画像ファイルの読み込みに失敗しました: {image_path}")
-        return "健康 (エラー)", 0.0, [], None, os.path.basename(image_path) # 画像データとファイル名を返す
-
-    # 描画用の一時画像をコピー
-    drawn_img = original_img.copy()
-
-    # --- 1. すべてのモデルで推論を実行し、all_detectionsに結果を統合 ---
-    for model, category, model_filename in yolo_model_list: 
-            results = model(image_path)
-            
-            # 結果の解析
-            if results and results[0].boxes:
-                r = results[0]
-                
-                for box in r.boxes:
-                    class_id = int(box.cls.item())
-                    confidence = round(box.conf.item(), 3)
-                    class_name = model.names[class_id] 
-                    
-                    # バウンディングボックス座標 (xyxy) を整数に変換
-                    x_min, y_min, x_max, y_max = [int(x) for x in box.xyxy[0].tolist()]
-
-                    # 検出されたバウンディングボックスを描画
-                    color = (0, 255, 0) # 緑色
-                    thickness = 2
-                    font = cv2.FONT_HERSHEY_SIMPLEX
-                    font_scale = 0.7
-                    cv2.rectangle(drawn_img, (x_min, y_min), (x_max, y_max), color, thickness)
-                    label = f"{class_name} ({confidence:.2f})";
-                    cv2.putText(drawn_img, label, (x_min, y_min - 10), font, font_scale, color, thickness)
-
-                    all_detections.append({
-                        "disease": f"{class_name} ({category})", 
-                        "confidence": confidence,
-                        "model_category": category, 
-                        "model_filename": model_filename, 
-                        "box": {
-                            "x_min": x_min, "y_min": y_min, "x_max": x_max, "y_max": y_max
-                        }
-                    })
-    
-    # 描画された画像を一時保存フォルダに保存するロジックを削除
-    # original_filename = os.path.basename(image_path)
-    # unique_filename = f"detected_{uuid.uuid4()}_{original_filename}"
-    # temp_output_path = os.path.join(TEMP_INFERENCE_RESULTS_DIR, unique_filename)
-    # cv2.imwrite(temp_output_path, drawn_img)
-    # print(f"✅ 推論結果描画画像を一時保存しました: {temp_output_path}")
+    # 推論中にモデルリストが入れ替わっても影響を受けないようにスナップショットを取る
+    models = list(yolo_model_list)
+    total_start = time.perf_counter()
 
-    # --- 2. 結果の集約と整形 ---
-    if not all_detections:
-        return "健康 (検出なし)", 1.0, [], drawn_img, os.path.basename(image_path) # 画像データとファイル名を返す
+    # 元の画像を1回だけデコードし、描画と全モデルの入力に共用する
+    originals: List[Optional[np.ndarray]] = []
+    for frame in frames:
+        with _Stage(frame.timings, "decode"):
+            if frame.image is not None:
+                original_img = frame.image
+            elif frame.image_bytes is not None:
+                original_img = decode_image_bytes(frame.image_bytes)
+            else:
+                original_img = cv2.imread(frame.image_path)
+        if original_img is None:
+            log_event(logger, "decode_failed", logging.ERROR, image=frame.image_path)
+        originals.append(original_img)
 
-    filtered_detections = [
-        d for d in all_detections
-        if d["confidence"] <= 0.75
-    ]
+    # モデルの入力サイズごとに1回だけレターボックスする (実際に使うサイズだけ)
+    valid_indices = [i for i, img in enumerate(originals) if img is not None]
+    tiled = {i: should_tile(originals[i].shape) for i in valid_indices} # TILE_MODE に応じてタイル推論する画像
+    prepared: Dict[int, Dict[int, Tuple[np.ndarray, float, Tuple[int, int]]]] = {i: {} for i in valid_indices}
+    batch_shapes: Dict[int, Tuple[int, int]] = {}
+
+    def prepare(i: int, size: int) -> Tuple[np.ndarray, float, Tuple[int, int]]:
+        if size not in prepared[i]:
+            if size not in batch_shapes:
+                # 1バッチの画像は同じ大きさにそろえる必要があるため、この呼び出しの全画像を収められる長方形にする
+                # (カスケードの段ごとに対象の画像が変わっても、同じレターボックス結果を使い回せる)
+                batch_shapes[size] = batch_letterbox_shape([originals[j].shape for j in valid_indices if not tiled[j]], size)
+            with _Stage(frames[i].timings, "letterbox"):
+                prepared[i][size] = letterbox(originals[i], size, batch_shapes[size])
+        return prepared[i][size]
+
+    # --- 1. モデルで推論を実行 ---
+    # カスケード設定がある場合は段ごとに実行し、前段の結果に応じて後段を省略する (設定がなければ全モデル)
+    # (INFERENCE_EXECUTOR に応じて並列実行されるが、結果はモデルの順番で返る)
+    frame_outputs: Dict[int, List[Optional[Tuple[RawDetections, float]]]] = {i: [None] * len(models) for i in valid_indices}
+    for stage, model_indices in cascade_policy.plan([category for _, category, _ in models]):
+        stage_models = [models[j] for j in model_indices]
+        active = [
+            i for i in valid_indices
+            if cascade_policy.should_run(
+                stage,
+                _max_confidence_by_category(frame_outputs[i], models) if stage is not None and stage.conditional else {}
+            )
+        ]
+        if not active:
+            continue
+        sizes = sorted({get_model_input_size(model) for model, _, _ in stage_models})
+
+        # 高解像度の画像はタイルに分割し、1枚ずつタイルをまとめて推論する
+        for i in [i for i in active if tiled[i]]:
+            tiled_outputs = _run_tiled(stage_models, originals[i], models, frames[i].timings)
+            _observe_model_inference(stage_models, tiled_outputs)
+            cascade_policy.record_inference(stage, sum(seconds for _, seconds in tiled_outputs))
+            for j, output in zip(model_indices, tiled_outputs):
+                frame_outputs[i][j] = output
+            for size in sizes:
+                # タイル推論の結果は元画像の座標に戻してあるため、座標変換は不要 (縮小率1, パディングなし)
+                prepared[i][size] = (None, 1.0, (0, 0))
+
+        active = [i for i in active if not tiled[i]]
+        if not active:
+            continue
+        batch_inputs = {size: [prepare(i, size)[0] for i in active] for size in sizes}
+        stage_outputs = _run_models(stage_models, batch_inputs, all_models=models)
+        _observe_model_inference(stage_models, stage_outputs)
+        cascade_policy.record_inference(stage, sum(seconds for _, seconds in stage_outputs))
+        for j, (raw_per_image, seconds) in zip(model_indices, stage_outputs):
+            for position, i in enumerate(active):
+                frame_outputs[i][j] = (raw_per_image[position], seconds)
+
+    outputs = []
+    for i, frame in enumerate(frames):
+        if originals[i] is None:
+            outputs.append(("健康 (エラー)", 0.0, Detections.empty(), None, os.path.basename(frame.image_path))) # 画像データとファイル名を返す
+            continue
+        outputs.append(_collect_frame_result(frame, originals[i], prepared[i], models, frame_outputs[i]))
+        if frame.timings is not None:
+            frame.timings["total"] = time.perf_counter() - total_start
+    return outputs
 
-    if not filtered_detections:
-        return "健康 (正常)", 1.0, all_detections, drawn_img, os.path.basename(image_path) # 画像データとファイル名を返す
+def _observe_model_inference(models: List[Tuple[Any, str, str]], outputs: List[Tuple[Any, float]]):
+    """モデルごとの推論時間を、バッチ (またはタイル推論の1枚) につき1回だけ記録する"""
+    for (_, _, model_filename), (_, seconds) in zip(models, outputs):
+        MODEL_INFERENCE_SECONDS.observe(seconds, model_filename=model_filename)
+
+def _run_tiled(
+    models: List[Tuple[Any, str, str]],
+    image: np.ndarray,
+    all_models: List[Tuple[Any, str, str]],
+    timings: Optional[Dict[str, float]] = None
+) -> List[Tuple[RawDetections, float]]:
+    """
+    高解像度の画像を重なりのあるタイルに分割し、各モデルでタイルをまとめて (1バッチで) 推論する。
+    同時に推論するタイル数は TILE_MAX_IN_FLIGHT までに抑え、解像度によらずメモリ使用量の上限を保つ。
+    タイルごとの検出は元画像の座標に戻してから、タイル間の重複を NMS でまとめる。
+
+    Returns:
+        models と同じ順番の (元画像の座標の検出結果, 推論時間の合計)
+    """
+    windows: List[Optional[np.ndarray]] = list(tile_windows(image.shape))
+    if TILE_INCLUDE_FULL_FRAME:
+        windows.insert(0, None) # None は画像全体
+    sizes = sorted({get_model_input_size(model) for model, _, _ in models})
+    model_sizes = [get_model_input_size(model) for model, _, _ in models]
+    parts: List[List[RawDetections]] = [[] for _ in models]
+    seconds = [0.0] * len(models)
+
+    chunk_size = max(1, TILE_MAX_IN_FLIGHT)
+    for start in range(0, len(windows), chunk_size):
+        chunk = windows[start:start + chunk_size]
+        batch_inputs: Dict[int, List[np.ndarray]] = {}
+        transforms: Dict[int, List[Tuple[float, float, float, float, float]]] = {} # (縮小率, 左, 上, タイルのx, タイルのy)
+        with _Stage(timings, "tile"):
+            for size in sizes:
+                batch_inputs[size] = []
+                transforms[size] = []
+                tiles = []
+                for window in chunk:
+                    if window is None:
+                        tiles.append((image, 0, 0))
+                    else:
+                        x0, y0, x1, y1 = (int(v) for v in window)
+                        tiles.append((image[y0:y1, x0:x1], x0, y0))
+                shape = batch_letterbox_shape([tile.shape for tile, _, _ in tiles], size)
+                for tile, x0, y0 in tiles:
+                    input_img, ratio, (left, top) = letterbox(tile, size, shape)
+                    batch_inputs[size].append(input_img)
+                    transforms[size].append((ratio, left, top, x0, y0))
+
+        for j, (raw_per_tile, inference_seconds) in enumerate(_run_models(models, batch_inputs, all_models=all_models)):
+            seconds[j] += inference_seconds
+            for raw, (ratio, left, top, x0, y0) in zip(raw_per_tile, transforms[model_sizes[j]]):
+                if len(raw.class_ids) == 0:
+                    continue
+                boxes = (raw.boxes - (left, top, left, top)) / ratio + (x0, y0, x0, y0)
+                parts[j].append(RawDetections(raw.class_ids, raw.confidences, boxes.astype(np.float32)))
+        del batch_inputs # 次のタイルを用意する前に入力を解放する
+
+    with _Stage(timings, "tile_merge"):
+        return [(merge_tile_detections(model_parts, image.shape), model_seconds) for model_parts, model_seconds in zip(parts, seconds)]
+
+def _collect_frame_result(
+    frame: FrameInput,
+    original_img: np.ndarray,
+    prepared: Dict[int, Tuple[np.ndarray, float, Tuple[int, int]]],
+    models: List[Tuple[Any, str, str]],
+    frame_outputs: List[Optional[Tuple[RawDetections, float]]]
+) -> Tuple[str, float, Detections, Optional[AnnotatedFrame], str]:
+    """
+    1枚分の検出結果を集約する。
+    frame_outputs はモデルの順番に並んだ (生の検出結果, バッチの推論時間) で、カスケードで省略したモデルは None
+    """
+    image_path = frame.image_path
+    sources = [(category, model_filename, model.names) for model, category, model_filename in models]
+
+    # all_detectionsに結果を統合 (モデルごとに配列のまま座標を戻し、最後に1回で連結する)
+    with _Stage(frame.timings, "extract"):
+        parts = []
+        for model_id, ((model, _, model_filename), output) in enumerate(zip(models, frame_outputs)):
+            if output is None:
+                continue
+            raw, inference_seconds = output
+            if frame.timings is not None:
+                # バッチ全体の推論時間 (同じバッチの画像はこの時間を共有する)
+                frame.timings[f"inference:{model_filename}"] = inference_seconds
+            if len(raw.class_ids) == 0:
+                continue
+            _, ratio, pad = prepared[get_model_input_size(model)]
+            # バウンディングボックス座標 (xyxy) をレターボックス前の座標に戻して整数に変換
+            parts.append((model_id, raw, _unletterbox_boxes(raw.boxes, ratio, pad, original_img.shape)))
+        all_detections = Detections.concatenate(parts, sources)
+
+    # 描画はここでは行わず、元画像への参照だけを持たせる (保存/表示するときに描画する)
+    annotated = AnnotatedFrame(original_img, all_detections)
+
+    # --- 2. 結果の集約と整形 ---
+    if not all_detections:
+        return "健康 (検出なし)", 1.0, all_detections, annotated, os.path.basename(image_path) # 画像データとファイル名を返す
 
-    best_detection = max(filtered_detections, key=lambda d: d["confidence"])
+    best = all_detections.best_index(all_detections.confidences <= 0.75)
+    if best is None:
+        return "健康 (正常)", 1.0, all_detections, annotated, os.path.basename(image_path) # 画像データとファイル名を返す
 
-    final_disease = best_detection["disease"]
-    final_confidence = best_detection["confidence"]
+    final_disease = all_detections.disease(best)
+    final_confidence = float(all_detections.confidences[best])
 
-    return final_disease, final_confidence, all_detections, drawn_img, os.path.basename(image_path) # 画像データとファイル名を返す
+    return final_disease, final_confidence, all_detections, annotated, os.path.basename(image_path) # 画像データとファイル名を返す
 
 # --- 結果の集約と整形ロジック ---
 def get_best_detection(detections: List[Dict[str, Any]]) -> Tuple[str, float, List[Dict[str, Any]]]:
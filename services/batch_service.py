@@ -0,0 +1,103 @@
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List
+
+from .log_service import get_logger, log_event
+
+logger = get_logger("batch")
+
+# --- マイクロバッチの設定 ---
+# 1回の推論にまとめる最大枚数 (1 にするとバッチ化しない)
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", "4"))
+# 最初の1枚が届いてから、後続の画像を待つ最大時間 (ミリ秒)
+BATCH_MAX_WAIT_MS = float(os.environ.get("BATCH_MAX_WAIT_MS", "10"))
+
+class MicroBatcher:
+    """
+    複数の推論ワーカーから届いた画像を、最大 max_batch_size 枚 / 最大 max_wait_ms ミリ秒の範囲で
+    まとめて batch_handler に渡す。呼び出し側は infer() で自分の画像の結果だけを受け取る。
+    """
+    def __init__(
+        self,
+        batch_handler: Callable[[List[Any]], List[Any]],
+        max_batch_size: int = BATCH_MAX_SIZE,
+        max_wait_ms: float = BATCH_MAX_WAIT_MS
+    ):
+        self.batch_handler = batch_handler
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self._queue: "queue.Queue" = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._batch_sizes: Counter = Counter() # バッチサイズ -> 回数
+        self._total_wait_seconds = 0.0
+        self._frames = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None or self.max_batch_size == 1:
+                return
+            self._thread = threading.Thread(target=self._dispatch_loop, name="micro-batcher", daemon=True)
+            self._thread.start()
+        log_event(logger, "micro_batcher_started", max_batch_size=self.max_batch_size, max_wait_ms=self.max_wait * 1000)
+
+    def infer(self, item: Any) -> Any:
+        """1枚分の入力を投入し、バッチ推論が終わるまで待って結果を返す"""
+        if self._thread is None:
+            # バッチ化が無効 (または未起動) の場合はその場で1枚だけ推論する
+            result = self.batch_handler([item])[0]
+            self._record([0.0])
+            return result
+        future: Future = Future()
+        self._queue.put((time.perf_counter(), item, future))
+        return future.result()
+
+    def stats(self) -> Dict[str, Any]:
+        """達成したバッチサイズの分布などを返す (/status 表示用)"""
+        with self._lock:
+            sizes = dict(sorted(self._batch_sizes.items()))
+            batches = sum(self._batch_sizes.values())
+            frames = self._frames
+            total_wait = self._total_wait_seconds
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "batches": batches,
+            "frames": frames,
+            "avg_batch_size": round(frames / batches, 2) if batches else 0.0,
+            "batch_size_histogram": sizes,
+            "avg_batch_wait_ms": round(total_wait / frames * 1000, 1) if frames else 0.0,
+        }
+
+    def _record(self, waits: List[float]):
+        with self._lock:
+            self._batch_sizes[len(waits)] += 1
+            self._frames += len(waits)
+            self._total_wait_seconds += sum(waits)
+
+    def _dispatch_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            dispatched_at = time.perf_counter()
+            self._record([dispatched_at - enqueued_at for enqueued_at, _, _ in batch])
+            try:
+                results = self.batch_handler([item for _, item, _ in batch])
+                for (_, _, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
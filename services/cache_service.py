@@ -0,0 +1,145 @@
+import atexit
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from .log_service import get_logger, log_event
+
+logger = get_logger("cache")
+
+# --- 推論結果キャッシュの設定 ---
+# 保持する最大件数 (0 でキャッシュ無効)
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", "512"))
+# 有効期限 (秒)。0 の場合は期限なし
+RESULT_CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL", "3600"))
+# 再起動後も使えるように保存するファイル (空の場合は保存しない)
+RESULT_CACHE_PERSIST_PATH = os.environ.get("RESULT_CACHE_PERSIST_PATH", "")
+
+class ResultCache:
+    """
+    画像の内容 (ハッシュ) とロード済みモデルの組み合わせをキーにした、推論結果のLRUキャッシュ。
+    夜間などに同じ画像が繰り返し送られてきた場合に、推論そのものを省略する。
+    """
+    def __init__(
+        self,
+        max_entries: int = RESULT_CACHE_SIZE,
+        ttl_seconds: float = RESULT_CACHE_TTL,
+        persist_path: str = RESULT_CACHE_PERSIST_PATH
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.persist_path = persist_path
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict() # キー -> (保存時刻, 値)
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+        # 終了時の保存を登録したプロセスのID。gunicorn のマスター (preload_app でここを通るが推論しない) が
+        # 起動時に読み込んだ内容でワーカーの保存を上書きしないよう、最初に put したプロセスでだけ登録する
+        self._save_registered_pid: Optional[int] = None
+        if self.persist_path:
+            self._load()
+
+    @staticmethod
+    def make_key(image_bytes: bytes, model_signature: str) -> str:
+        """画像のバイト列とモデルの組み合わせからキャッシュキーを作る"""
+        digest = hashlib.sha256(image_bytes).hexdigest()
+        model_digest = hashlib.sha1(model_signature.encode('utf-8')).hexdigest()[:16]
+        return f"{digest}:{model_digest}"
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def get(self, key: str) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._is_expired(entry[0]):
+                del self._entries[key]
+                self._stats["expired"] += 1
+                entry = None
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry[1]
+
+    def put(self, key: str, value: Any):
+        if not self.enabled:
+            return
+        if self.persist_path and self._save_registered_pid != os.getpid():
+            self._save_registered_pid = os.getpid()
+            atexit.register(self.save)
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else 0.0
+        stats["max_entries"] = self.max_entries
+        stats["ttl_seconds"] = self.ttl_seconds
+        return stats
+
+    def save(self):
+        """
+        キャッシュの内容をファイルに保存する (アトミックに置き換える)。
+        複数のワーカーが順に保存しても互いの結果を消さないよう、保存済みのファイルの内容とマージする。
+        """
+        if not self.persist_path:
+            return
+        with self._lock:
+            entries = dict(self._entries)
+        for key, (stored_at, value) in self._read_file():
+            if key not in entries or entries[key][0] < stored_at:
+                entries[key] = (stored_at, value)
+        # 保存時刻の古い順に並べ、上限を超えた分と期限切れを捨てる (_load は末尾から読み込む)
+        entries = sorted(
+            ((key, entry) for key, entry in entries.items() if not self._is_expired(entry[0])),
+            key=lambda item: item[1][0]
+        )[-self.max_entries:] if self.max_entries > 0 else []
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.persist_path)), exist_ok=True)
+            # 複数のワーカープロセスが終了時に同時に保存しても、互いの書きかけのファイルを壊さないようにする
+            temp_path = f"{self.persist_path}.{os.getpid()}.tmp"
+            with open(temp_path, 'wb') as f:
+                pickle.dump(entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self.persist_path)
+            log_event(logger, "result_cache_saved", path=self.persist_path, entries=len(entries))
+        except Exception as e:
+            log_event(logger, "result_cache_save_failed", logging.WARNING, path=self.persist_path, error=str(e))
+
+    def _read_file(self) -> List[Tuple[str, Tuple[float, Any]]]:
+        if not os.path.exists(self.persist_path):
+            return []
+        try:
+            with open(self.persist_path, 'rb') as f:
+                return pickle.load(f)
+        except Exception as e:
+            log_event(logger, "result_cache_load_failed", logging.WARNING, path=self.persist_path, error=str(e))
+            return []
+
+    def _load(self):
+        entries = self._read_file()
+        if not entries:
+            return
+        with self._lock:
+            for key, (stored_at, value) in entries[-self.max_entries:] if self.max_entries > 0 else []:
+                if not self._is_expired(stored_at):
+                    self._entries[key] = (stored_at, value)
+        log_event(logger, "result_cache_loaded", path=self.persist_path, entries=len(self._entries))
+
+    def _is_expired(self, stored_at: float) -> bool:
+        return self.ttl_seconds > 0 and time.time() - stored_at > self.ttl_seconds
@@ -0,0 +1,69 @@
+import os
+from typing import Any, Dict, List, Tuple
+
+from .tile_service import TILE_MODE
+
+# --- カメラクライアント向けの撮影プロファイル (/capture-profile) の設定 ---
+# 送信する画像の長辺 (ピクセル)。0 の場合はロード済みモデルの入力サイズ (imgsz) の最大値にする
+# (YOLO はどのみち長辺を入力サイズに縮小するので、それより大きく撮っても転送とデコードが無駄になる)
+CAPTURE_MAX_SIDE = int(os.environ.get("CAPTURE_MAX_SIDE", "0"))
+# 画像の形式 (canvas.toBlob に渡す MIME タイプ) と品質 (0〜1)
+CAPTURE_FORMAT = os.environ.get("CAPTURE_FORMAT", "image/jpeg")
+CAPTURE_QUALITY = float(os.environ.get("CAPTURE_QUALITY", "0.8"))
+
+# サーバー側 (cv2.imdecode) でデコードできる形式 -> アップロード時の拡張子
+SUPPORTED_FORMATS = {"image/jpeg": ".jpg", "image/webp": ".webp", "image/png": ".png"}
+DEFAULT_FORMAT = "image/jpeg"
+DEFAULT_QUALITY = 0.8
+
+def build_capture_profile(input_sizes: Dict[str, int], default_size: int) -> Dict[str, Any]:
+    """
+    モデルの入力サイズからクライアントが撮影・エンコードすべき形式を決める。
+
+    Args:
+        input_sizes: モデルファイル名 -> 入力サイズ (imgsz)。
+        default_size: モデルがまだロードされていない場合に使う入力サイズ。
+    """
+    profile_format = CAPTURE_FORMAT if CAPTURE_FORMAT in SUPPORTED_FORMATS else DEFAULT_FORMAT
+    quality = CAPTURE_QUALITY if 0.0 < CAPTURE_QUALITY <= 1.0 else DEFAULT_QUALITY
+    if TILE_MODE != "off":
+        # タイル推論は高解像度の画像を分割して推論するため、縮小せずにそのまま送ってもらう
+        max_side, source = 0, "tiling"
+    elif CAPTURE_MAX_SIDE > 0:
+        max_side, source = CAPTURE_MAX_SIDE, "override"
+    elif input_sizes:
+        max_side, source = max(input_sizes.values()), "models"
+    else:
+        max_side, source = default_size, "default"
+    return {
+        "max_side": max_side, # 0 の場合は縮小しない
+        "format": profile_format,
+        "extension": SUPPORTED_FORMATS[profile_format],
+        "quality": quality,
+        "source": source,
+        "model_input_sizes": dict(input_sizes),
+    }
+
+def validate_capture_profile(input_sizes: Dict[str, int], default_size: int) -> Tuple[Dict[str, Any], List[str]]:
+    """
+    ロード済みモデルに対して撮影プロファイルが妥当かを確認し、(プロファイル, 警告のリスト) を返す。
+    起動時 (モデルのロード完了後) に呼び出してログに出す。
+    """
+    profile = build_capture_profile(input_sizes, default_size)
+    warnings: List[str] = []
+    if CAPTURE_FORMAT not in SUPPORTED_FORMATS:
+        warnings.append(f"CAPTURE_FORMAT={CAPTURE_FORMAT} はサーバーでデコードできないため {profile['format']} を使います")
+    if not 0.0 < CAPTURE_QUALITY <= 1.0:
+        warnings.append(f"CAPTURE_QUALITY={CAPTURE_QUALITY} は範囲外 (0〜1) のため {profile['quality']} を使います")
+    if not input_sizes:
+        warnings.append(f"ロード済みのモデルがないため、既定の入力サイズ {default_size} を使います")
+    elif profile["max_side"] > 0:
+        largest = max(input_sizes.values())
+        if profile["max_side"] < largest:
+            undersized = sorted(name for name, size in input_sizes.items() if size > profile["max_side"])
+            warnings.append(
+                f"撮影サイズ {profile['max_side']} がモデルの入力サイズより小さいため、拡大して推論されます: {', '.join(undersized)}"
+            )
+    if profile["format"] == "image/png" and profile["max_side"] == 0:
+        warnings.append("PNG で縮小せずに送信すると転送量が大きくなります")
+    return profile, warnings
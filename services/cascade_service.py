@@ -0,0 +1,175 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from .log_service import get_logger, log_event
+
+logger = get_logger("cascade")
+
+# --- モデルのカスケード (段階実行) の設定 ---
+# 設定ファイルのパス。ファイルがない場合はカスケードを使わず、従来どおり全モデルを毎回実行する
+# (書式は cascade_config.example.json を参照)
+CASCADE_CONFIG = os.environ.get(
+    "CASCADE_CONFIG",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cascade_config.json')
+)
+
+class CascadeStage:
+    """
+    カスケードの1段。categories のモデルをまとめて実行する。
+    run_if がある段は、前段までの検出に条件を満たすものがあった画像 (または sample_every 枚に1枚) だけで実行する。
+    """
+    __slots__ = ("name", "categories", "trigger_categories", "min_confidence", "sample_every",
+                 "frames", "runs", "sampled", "skipped", "inference_seconds")
+
+    def __init__(
+        self,
+        name: str,
+        categories: Sequence[str],
+        trigger_categories: Optional[Sequence[str]] = None,
+        min_confidence: Optional[float] = None,
+        sample_every: int = 0
+    ):
+        self.name = name
+        self.categories = list(categories)
+        # 条件に使う前段のカテゴリ (None の場合は前段のすべてのカテゴリ)
+        self.trigger_categories = list(trigger_categories) if trigger_categories else None
+        # None の場合は条件なし (毎回実行する)
+        self.min_confidence = min_confidence
+        self.sample_every = sample_every
+        # 統計
+        self.frames = 0 # この段を実行するか判定した画像数
+        self.runs = 0 # 実行した画像数 (サンプリング分を含む)
+        self.sampled = 0 # 条件を満たさなかったがサンプリングで実行した画像数
+        self.skipped = 0 # 実行を省略した画像数
+        self.inference_seconds = 0.0
+
+    @property
+    def conditional(self) -> bool:
+        return self.min_confidence is not None
+
+class CascadePolicy:
+    """
+    モデルをカテゴリごとの段に分け、前段の結果に応じて後段の実行を省略する。
+    段が1つもない場合 (設定ファイルがない場合) は無効で、全モデルを毎回実行する。
+    """
+    def __init__(self, stages: Optional[List[CascadeStage]] = None, source: Optional[str] = None, raw_config: Any = None):
+        self.stages = stages or []
+        self.source = source
+        self._signature = hashlib.sha1(json.dumps(raw_config, sort_keys=True).encode('utf-8')).hexdigest()[:12] if raw_config else ""
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str = CASCADE_CONFIG) -> "CascadePolicy":
+        """設定ファイルを読み込む。ファイルがない場合や不正な場合はカスケードなしで動作する"""
+        if not path or not os.path.exists(path):
+            return cls()
+        try:
+            with open(path, encoding='utf-8') as f:
+                config = json.load(f)
+            stages = []
+            for index, stage_config in enumerate(config.get("stages", [])):
+                run_if = stage_config.get("run_if")
+                if run_if is not None and "min_confidence" not in run_if:
+                    # しきい値を省略すると条件が常に成り立つため、既定値で補わずに設定ミスとして扱う
+                    raise ValueError(f"run_if に min_confidence がありません (段 {index + 1})")
+                stages.append(CascadeStage(
+                    name=stage_config.get("name", f"stage{index + 1}"),
+                    categories=stage_config["categories"],
+                    trigger_categories=run_if.get("categories") if run_if else None,
+                    min_confidence=float(run_if["min_confidence"]) if run_if is not None else None,
+                    sample_every=int(stage_config.get("sample_every", 0)),
+                ))
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            # 読み込めない場合は全モデルを毎回実行する
+            log_event(logger, "cascade_config_invalid", logging.WARNING, path=path, error=str(e))
+            return cls()
+        log_event(logger, "cascade_config_loaded", path=path, stages=[stage.name for stage in stages])
+        return cls(stages, path, config)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.stages)
+
+    def signature(self) -> str:
+        """設定内容を表す短い文字列 (結果キャッシュのキーに含める)"""
+        return self._signature
+
+    def plan(self, categories: Sequence[str]) -> List[Tuple[Optional[CascadeStage], List[int]]]:
+        """
+        モデルのカテゴリの並びを段ごとに分け、(段, モデルの位置のリスト) を実行順に返す。
+        どの段にも含まれないカテゴリのモデルは、取りこぼさないよう最初の段で実行する。
+        """
+        if not self.enabled:
+            return [(None, list(range(len(categories))))]
+        plan: List[Tuple[Optional[CascadeStage], List[int]]] = [(stage, []) for stage in self.stages]
+        for index, category in enumerate(categories):
+            for stage, model_indices in plan:
+                if category in stage.categories:
+                    model_indices.append(index)
+                    break
+            else:
+                plan[0][1].append(index)
+        return [(stage, model_indices) for stage, model_indices in plan if model_indices]
+
+    def should_run(self, stage: Optional[CascadeStage], prior_confidences: Dict[str, float]) -> bool:
+        """
+        1枚の画像についてこの段を実行するか判定し、統計を更新する。
+
+        Args:
+            stage: 判定する段 (None の場合はカスケード無効で常に実行)。
+            prior_confidences: 前段までのカテゴリごとの最大確信度。
+        """
+        if stage is None:
+            return True
+        with self._lock:
+            stage.frames += 1
+            if not stage.conditional:
+                stage.runs += 1
+                return True
+            # 前段で実際に検出されたカテゴリだけを条件に使う (検出なしを確信度0として扱わない)
+            candidates = stage.trigger_categories or list(prior_confidences)
+            if any(
+                category in prior_confidences and prior_confidences[category] >= stage.min_confidence
+                for category in candidates
+            ):
+                stage.runs += 1
+                return True
+            if stage.sample_every > 0 and stage.frames % stage.sample_every == 0:
+                # 見逃しを監視するため、条件を満たさなくても一定間隔で実行する
+                stage.runs += 1
+                stage.sampled += 1
+                return True
+            stage.skipped += 1
+            return False
+
+    def record_inference(self, stage: Optional[CascadeStage], seconds: float):
+        if stage is None:
+            return
+        with self._lock:
+            stage.inference_seconds += seconds
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        段ごとの実行/省略数。saved_seconds は省略した画像数 × 1枚あたりの平均推論時間 (節約できたCPU時間の目安)
+        """
+        with self._lock:
+            stages = []
+            for stage in self.stages:
+                per_frame = stage.inference_seconds / stage.runs if stage.runs else 0.0
+                stages.append({
+                    "name": stage.name,
+                    "categories": stage.categories,
+                    "conditional": stage.conditional,
+                    "frames": stage.frames,
+                    "runs": stage.runs,
+                    "sampled": stage.sampled,
+                    "skipped": stage.skipped,
+                    "skip_rate": round(stage.skipped / stage.frames, 3) if stage.frames else 0.0,
+                    "inference_seconds": round(stage.inference_seconds, 3),
+                    "saved_seconds": round(stage.skipped * per_frame, 3),
+                })
+        return {"enabled": self.enabled, "config": self.source, "stages": stages}
@@ -1,6 +1,18 @@
 import pymysql.cursors
-from typing import Tuple, Any, Dict, List, Optional
+from typing import Tuple, Any, Dict, List, Optional, Callable, Union
 import datetime
+import logging
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+
+from .log_service import get_logger, log_event
+from .metrics_service import DB_LOG_ROWS_TOTAL, STAGE_SECONDS
+
+logger = get_logger("db")
 
 # --- データベース接続設定 ---
 # 🚨 接続検証用のため、ダミーの設定が入っています。
@@ -14,59 +26,328 @@ DB_CONFIG: Dict[str, Any] = {
     'cursorclass': pymysql.cursors.DictCursor
 }
 
+# --- 書き込みの設定 ---
+# コネクションプールに保持する接続数
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "2"))
+# この件数が溜まったらまとめて書き込む
+DB_FLUSH_BATCH_SIZE = int(os.environ.get("DB_FLUSH_BATCH_SIZE", "50"))
+# 件数が溜まらなくても、この秒数ごとに書き込む
+DB_FLUSH_INTERVAL = float(os.environ.get("DB_FLUSH_INTERVAL", "1.0"))
+# メモリ上に溜める最大件数 (超えた分はローカルファイルに退避する)
+DB_BUFFER_MAX_ROWS = int(os.environ.get("DB_BUFFER_MAX_ROWS", "10000"))
+# 書き込み失敗時のリトライ回数 (超えたらローカルファイルに退避する)
+DB_RETRY_MAX = int(os.environ.get("DB_RETRY_MAX", "3"))
+# DBに書き込めなかった行を退避するファイル (JSON Lines)
+DB_SPOOL_FILE = os.environ.get(
+    "DB_SPOOL_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'db_spool', 'detection_logs.jsonl')
+)
+
+# データベースのテーブル名とカラムは仮定しています
+# detection_time はDBのNOW()ではなく、検出時刻を行ごとに渡す (まとめて書き込むため)
+INSERT_DETECTION_LOG_SQL = """
+    INSERT INTO detection_logs
+        (image_file, main_disease, confidence, detections_data, detection_time)
+    VALUES
+        ({p}, {p}, {p}, {p}, {p})
+"""
+
+class ConnectionPool:
+    """
+    DB接続を使い回すための簡易コネクションプール。
+    connect_factory を差し替えれば、pymysql 以外 (ローカルの sqlite3 など) でも動かせる。
+    """
+    def __init__(self, connect_factory: Callable[[], Any], size: int = DB_POOL_SIZE):
+        self.connect_factory = connect_factory
+        self.size = max(1, size)
+        self._idle: "queue.LifoQueue" = queue.LifoQueue(maxsize=self.size)
+
+    def acquire(self) -> Any:
+        """空いている接続を返す。なければ新しく接続する"""
+        try:
+            connection = self._idle.get_nowait()
+        except queue.Empty:
+            return self.connect_factory()
+        if hasattr(connection, 'ping'):
+            # 長時間使われていなかった接続はサーバー側で切られていることがあるため再接続する
+            try:
+                connection.ping(reconnect=True)
+            except Exception:
+                # 再接続もできない接続は閉じて捨て、新しい接続に置き換える (失敗すれば呼び出し側に例外が伝わる)
+                _close_quietly(connection)
+                return self.connect_factory()
+        return connection
+
+    def release(self, connection: Any, broken: bool = False):
+        """使い終わった接続をプールに戻す。エラーが起きた接続は閉じて捨てる"""
+        if broken:
+            _close_quietly(connection)
+            return
+        try:
+            self._idle.put_nowait(connection)
+        except queue.Full:
+            _close_quietly(connection)
+
+    def close(self):
+        while True:
+            try:
+                _close_quietly(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+def _close_quietly(connection: Any):
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+class DetectionLogWriter:
+    """
+    検出ログをメモリ上に溜めて、件数または時間の閾値で executemany によりまとめて書き込む (write-behind)。
+    - メモリ上の件数には上限があり、超えた分はローカルファイルに退避する
+    - DBに接続できない場合はリトライし、それでも失敗した行はローカルファイルに退避する
+    - 退避した行は、次に書き込みが成功したときにファイルから少しずつ読んでDBへ再投入する
+    - プロセス終了時 (atexit) には残りを書き込む
+    """
+    def __init__(
+        self,
+        pool: ConnectionPool,
+        placeholder: str = "%s",
+        batch_size: int = DB_FLUSH_BATCH_SIZE,
+        flush_interval: float = DB_FLUSH_INTERVAL,
+        max_rows: int = DB_BUFFER_MAX_ROWS,
+        retry_max: int = DB_RETRY_MAX,
+        spool_path: str = DB_SPOOL_FILE
+    ):
+        self.pool = pool
+        self.sql = INSERT_DETECTION_LOG_SQL.format(p=placeholder)
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        self.retry_max = retry_max
+        self.spool_path = spool_path
+        self._rows: List[Tuple[Any, ...]] = []
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock() # DBへの書き込みは同時に1つだけ
+        self._spool_lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        self._closed = False
+        self._stats = {"queued": 0, "written": 0, "spilled": 0, "replayed": 0, "flush_errors": 0}
+        self._thread = threading.Thread(target=self._flush_loop, name="db-log-writer", daemon=True)
+        self._thread.start()
+
+    def append(self, row: Tuple[Any, ...]):
+        """1行を書き込みバッファに追加する (DBの応答は待たない)"""
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("DetectionLogWriter は既に停止しています。")
+        self._enqueue(row)
+
+    def _enqueue(self, row: Tuple[Any, ...]):
+        with self._cond:
+            if len(self._rows) >= self.max_rows:
+                overflow = [row]
+            else:
+                overflow = None
+                self._rows.append(row)
+                self._stats["queued"] += 1
+                if len(self._rows) >= self.batch_size:
+                    self._cond.notify()
+        if overflow:
+            # バッファが満杯の場合はメモリを増やさずファイルに退避する
+            self._spill(overflow)
+
+    def flush(self) -> bool:
+        """バッファの内容をすべて書き込む。すべて書き込めた場合は True"""
+        success = True
+        while True:
+            with self._cond:
+                rows = self._rows[:self.batch_size]
+                del self._rows[:self.batch_size]
+            if not rows:
+                return success
+            success = self._write(rows) and success
+
+    def close(self):
+        """残りを書き込んで停止する"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout=self.flush_interval * 2 + 1)
+        self.flush()
+        self.pool.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            stats = dict(self._stats)
+            stats["buffered"] = len(self._rows)
+        stats["spool_file_exists"] = os.path.exists(self.spool_path)
+        return stats
+
+    def _flush_loop(self):
+        while True:
+            with self._cond:
+                if not self._closed and len(self._rows) < self.batch_size:
+                    self._cond.wait(timeout=self.flush_interval)
+                closed = self._closed
+            if closed:
+                return
+            self.flush()
+
+    def _write(self, rows: List[Tuple[Any, ...]]) -> bool:
+        """rows を executemany で書き込む。リトライしても失敗した場合はファイルに退避する"""
+        with self._flush_lock:
+            last_error = self._execute(rows)
+            if last_error is not None:
+                log_event(logger, "db_rows_spilled", logging.ERROR, rows=len(rows), path=self.spool_path, error=str(last_error))
+                self._spill(rows)
+                return False
+
+        # DBに書き込めるようになったので、退避していた行を再投入する
+        self._replay_spool()
+        return True
+
+    def _execute(self, rows: List[Tuple[Any, ...]]) -> Optional[Exception]:
+        """rows を1トランザクションで書き込む (失敗時はリトライする)。書き込めなかった場合は最後の例外を返す"""
+        last_error = None
+        for attempt in range(self.retry_max + 1):
+            connection = None
+            broken = True
+            try:
+                flush_start = time.perf_counter()
+                connection = self.pool.acquire()
+                cursor = connection.cursor()
+                try:
+                    cursor.executemany(self.sql, rows)
+                finally:
+                    cursor.close()
+                connection.commit()
+                broken = False
+                STAGE_SECONDS.observe(time.perf_counter() - flush_start, stage="db_flush")
+                DB_LOG_ROWS_TOTAL.inc(len(rows), result="written")
+                with self._cond:
+                    self._stats["written"] += len(rows)
+                return None
+            except Exception as e:
+                last_error = e
+                with self._cond:
+                    self._stats["flush_errors"] += 1
+            finally:
+                # 成功した接続はプールに戻し、エラーが起きた接続は閉じて捨てる
+                if connection is not None:
+                    self.pool.release(connection, broken=broken)
+            if attempt < self.retry_max:
+                time.sleep(min(0.2 * (2 ** attempt), 5.0))
+        return last_error
+
+    def _spill(self, rows: List[Tuple[Any, ...]]):
+        with self._spool_lock:
+            os.makedirs(os.path.dirname(self.spool_path), exist_ok=True)
+            with open(self.spool_path, 'a', encoding='utf-8') as f:
+                for row in rows:
+                    f.write(json.dumps(list(row), ensure_ascii=False) + "\n")
+        DB_LOG_ROWS_TOTAL.inc(len(rows), result="spilled")
+        with self._cond:
+            self._stats["spilled"] += len(rows)
+
+    def _replay_spool(self):
+        """
+        退避ファイルの行を batch_size 件ずつ読み、メモリのバッファを経由せずにそのまま書き込む。
+        ファイルは書き込みがコミットされてから消すので、途中で失敗・クラッシュしても行は失われない
+        (クラッシュした場合は次回に最初から再投入されるため、同じ行が重複して書き込まれることはある)。
+        """
+        if not self._replay_lock.acquire(blocking=False):
+            return # 別のスレッドが再投入中
+        try:
+            replay_path = self.spool_path + ".replaying"
+            with self._spool_lock:
+                if not os.path.exists(replay_path):
+                    # 前回の再投入が途中で止まっていなければ、退避ファイルを再投入用に切り離す
+                    if not os.path.exists(self.spool_path):
+                        return
+                    os.replace(self.spool_path, replay_path)
+
+            replayed = 0
+            with open(replay_path, encoding='utf-8') as f:
+                while True:
+                    offset = f.tell()
+                    rows = []
+                    while len(rows) < self.batch_size:
+                        line = f.readline()
+                        if not line:
+                            break
+                        if line.strip():
+                            rows.append(tuple(json.loads(line)))
+                    if not rows:
+                        break
+                    with self._flush_lock:
+                        last_error = self._execute(rows)
+                    if last_error is not None:
+                        # 書き込めなかった行 (このチャンク以降) を退避ファイルに戻す
+                        f.seek(offset)
+                        with self._spool_lock:
+                            with open(self.spool_path, 'a', encoding='utf-8') as spool:
+                                for line in f:
+                                    spool.write(line)
+                        log_event(logger, "db_replay_failed", logging.ERROR, replayed=replayed, error=str(last_error))
+                        break
+                    replayed += len(rows)
+                    with self._cond:
+                        self._stats["replayed"] += len(rows)
+            os.remove(replay_path)
+            if replayed:
+                log_event(logger, "db_rows_replayed", rows=replayed)
+        finally:
+            self._replay_lock.release()
+
+_writer_lock = threading.Lock()
+_log_writer: Optional[DetectionLogWriter] = None
+
+def get_log_writer() -> DetectionLogWriter:
+    """アプリ全体で共有する検出ログの書き込み器を返す (初回呼び出し時に作成)"""
+    global _log_writer
+    with _writer_lock:
+        if _log_writer is None:
+            _log_writer = DetectionLogWriter(ConnectionPool(lambda: pymysql.connect(**DB_CONFIG)))
+            atexit.register(_log_writer.close)
+        return _log_writer
+
 def insert_detection_log(
-    filename: str, 
-    final_disease: str, 
-    confidence: float, 
-    detections: List[Dict[str, Any]]
+    filename: str,
+    final_disease: str,
+    confidence: float,
+    detections: Union[List[Dict[str, Any]], Any]
 ) -> Tuple[bool, str]:
     """
     YOLOv8の検出結果をデータベースに挿入します。
-    
+    実際の書き込みはバックグラウンドでまとめて行われるため、呼び出し側はDBの応答を待ちません。
+
     Args:
         filename: アップロードされた画像ファイル名。
         final_disease: 最も確信度の高い病名（代表結果）。
         confidence: 最も確信度の高い確信度。
         detections: YOLOv8からのすべての検出結果リスト（JSON文字列として保存）。
-        
+            ai_service の Detections もそのまま渡せる (ここで辞書のリストに変換する)。
+
     Returns:
         Tuple[bool, str]: 成功/失敗を示すブール値とメッセージ。
     """
-    import json
-    
+    start = time.perf_counter()
     try:
-        # DB接続を試みる
-        connection = pymysql.connect(**DB_CONFIG)
-        
         # 検出結果リストをJSON文字列に変換
+        if hasattr(detections, "to_dicts"):
+            detections = detections.to_dicts()
         detections_json = json.dumps(detections)
+        detection_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+        get_log_writer().append((filename, final_disease, confidence, detections_json, detection_time))
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage="insert_detection_log")
+        return True, "DB挿入処理を受け付けました。 (バックグラウンドで書き込みます)"
 
-        with connection.cursor() as cursor:
-            # データベースのテーブル名とカラムは仮定しています
-            sql = """
-            INSERT INTO detection_logs 
-                (image_file, main_disease, confidence, detections_data, detection_time) 
-            VALUES 
-                (%s, %s, %s, %s, NOW())
-            """
-            
-            # SQLインジェクションを防ぐため、データを%sで安全に渡します
-            cursor.execute(sql, (filename, final_disease, confidence, detections_json))
-
-        # コミットして変更を永続化
-        connection.commit()
-        connection.close()
-        
-        return True, "DB挿入処理が正常に実行されました。"
-    
-    except pymysql.err.OperationalError as e:
-        # 接続拒否やDBが見つからないなど、接続設定の問題
-        error_message = f"DB接続エラーが発生しました。 (設定: {DB_CONFIG['host']} / Error: {e.args[1]})"
-        print(f"[{datetime.datetime.now().strftime('%H:%M:%S')}] {error_message}")
-        return False, error_message
-    
     except Exception as e:
-        # その他のエラー (例: テーブルが存在しない、JSON変換失敗など)
+        # その他のエラー (例: JSON変換失敗など)
         error_message = f"DB処理中の予期せぬエラー: {e}"
-        print(f"[{datetime.datetime.now().strftime('%H:%M:%S')}] {error_message}")
-        return False, error_message
\ No newline at end of file
+        log_event(logger, "db_log_failed", logging.ERROR, image=filename, error=str(e))
+        return False, error_message
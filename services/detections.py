@@ -0,0 +1,142 @@
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+class RawDetections(NamedTuple):
+    """
+    1つのモデルが1枚の画像について返す生の検出結果 (列ごとの配列)。
+    プロセス間でもそのまま受け渡せるよう、NumPy 配列だけで構成する。
+    """
+    class_ids: np.ndarray   # (N,) int64
+    confidences: np.ndarray # (N,) float64 (小数第3位で丸め済み)
+    boxes: np.ndarray       # (N, 4) float32, レターボックス座標の xyxy
+
+def empty_raw() -> RawDetections:
+    return RawDetections(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64), np.empty((0, 4), dtype=np.float32))
+
+def make_raw(class_ids: Any, confidences: Any, boxes: Any) -> RawDetections:
+    """配列 (またはそれに変換できる値) から RawDetections を作る。確信度は従来どおり小数第3位で丸める"""
+    return RawDetections(
+        np.asarray(class_ids, dtype=np.int64).reshape(-1),
+        np.round(np.asarray(confidences, dtype=np.float64).reshape(-1), 3),
+        np.asarray(boxes, dtype=np.float32).reshape(-1, 4),
+    )
+
+# 検出元のモデル情報: (カテゴリ, モデルファイル名, クラスID -> クラス名)
+DetectionSource = Tuple[str, str, Dict[int, str]]
+
+class Detections:
+    """
+    1枚の画像に対する全モデルの検出結果を、列ごとの配列で保持するコンテナ。
+    検出1件ごとに辞書を作らず、閾値での絞り込みなどは配列演算で行う。
+    API応答やDB保存で従来の辞書のリストが必要になった時点で to_dicts() で変換する。
+    """
+    __slots__ = ("boxes", "confidences", "class_ids", "model_ids", "sources")
+
+    def __init__(
+        self,
+        boxes: np.ndarray,
+        confidences: np.ndarray,
+        class_ids: np.ndarray,
+        model_ids: np.ndarray,
+        sources: Sequence[DetectionSource]
+    ):
+        self.boxes = boxes             # (N, 4) int32, 元画像の座標の xyxy
+        self.confidences = confidences # (N,) float64
+        self.class_ids = class_ids     # (N,) int64
+        self.model_ids = model_ids     # (N,) int16, sources のインデックス
+        self.sources = tuple(sources)
+
+    @classmethod
+    def empty(cls, sources: Sequence[DetectionSource] = ()) -> "Detections":
+        return cls(
+            np.empty((0, 4), dtype=np.int32), np.empty(0, dtype=np.float64),
+            np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int16), sources
+        )
+
+    @classmethod
+    def concatenate(
+        cls,
+        parts: Sequence[Tuple[int, RawDetections, np.ndarray]],
+        sources: Sequence[DetectionSource]
+    ) -> "Detections":
+        """
+        モデルごとの結果をモデルの順番で1つにまとめる。
+
+        Args:
+            parts: (sources 内のモデル番号, 生の検出結果, 元画像の座標に戻したボックス) のリスト。
+            sources: 検出元のモデル情報。
+        """
+        parts = [part for part in parts if len(part[1].class_ids)]
+        if not parts:
+            return cls.empty(sources)
+        return cls(
+            np.concatenate([boxes for _, _, boxes in parts]).astype(np.int32, copy=False),
+            np.concatenate([raw.confidences for _, raw, _ in parts]),
+            np.concatenate([raw.class_ids for _, raw, _ in parts]),
+            np.concatenate([np.full(len(raw.class_ids), model_id, dtype=np.int16) for model_id, raw, _ in parts]),
+            sources,
+        )
+
+    def __len__(self) -> int:
+        return len(self.confidences)
+
+    def __bool__(self) -> bool:
+        return len(self) > 0
+
+    def select(self, index: Any) -> "Detections":
+        """ブール配列またはインデックス配列で絞り込んだ新しいコンテナを返す (モデル情報は共有する)"""
+        return Detections(self.boxes[index], self.confidences[index], self.class_ids[index], self.model_ids[index], self.sources)
+
+    def at_least(self, threshold: float) -> "Detections":
+        """確信度が threshold 以上の検出だけを返す"""
+        return self.select(self.confidences >= threshold)
+
+    def best_index(self, mask: Optional[np.ndarray] = None) -> Optional[int]:
+        """(mask が True の中で) 確信度が最も高い検出の位置。同点なら先に検出されたもの"""
+        candidates = np.flatnonzero(mask) if mask is not None else np.arange(len(self))
+        if len(candidates) == 0:
+            return None
+        return int(candidates[np.argmax(self.confidences[candidates])])
+
+    def class_name(self, i: int) -> str:
+        return self.sources[self.model_ids[i]][2][int(self.class_ids[i])]
+
+    def category(self, i: int) -> str:
+        return self.sources[self.model_ids[i]][0]
+
+    def disease(self, i: int) -> str:
+        """従来の "クラス名 (カテゴリ)" 形式の名前"""
+        return f"{self.class_name(i)} ({self.category(i)})"
+
+    def categories(self) -> List[str]:
+        """検出があったモデルカテゴリ (検出順、重複なし)"""
+        return list(dict.fromkeys(self.sources[model_id][0] for model_id in self.model_ids.tolist()))
+
+    def category_counts(self) -> Dict[str, int]:
+        """モデルカテゴリごとの検出数"""
+        model_ids, counts = np.unique(self.model_ids, return_counts=True)
+        result: Dict[str, int] = {}
+        for model_id, count in zip(model_ids.tolist(), counts.tolist()):
+            category = self.sources[model_id][0]
+            result[category] = result.get(category, 0) + count
+        return result
+
+    def to_dicts(self) -> List[Dict[str, Any]]:
+        """API/DB 向けに従来の形式 (検出1件ごとの辞書のリスト) に変換する"""
+        detections = []
+        for box, confidence, class_id, model_id in zip(
+            self.boxes.tolist(), self.confidences.tolist(), self.class_ids.tolist(), self.model_ids.tolist()
+        ):
+            category, model_filename, names = self.sources[model_id]
+            detections.append({
+                "disease": f"{names[class_id]} ({category})",
+                "confidence": confidence,
+                "model_category": category,
+                "model_filename": model_filename,
+                "box": {"x_min": box[0], "y_min": box[1], "x_max": box[2], "y_max": box[3]},
+            })
+        return detections
+
+    def __repr__(self) -> str:
+        return f"Detections({len(self)} 件)"
@@ -0,0 +1,114 @@
+import os
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import cv2
+import numpy as np
+
+# --- シーン変化ゲートの設定 ---
+# 有効にすると、前回推論した画像からほとんど変化していない画像は推論を省略する
+SCENE_GATE_ENABLED = os.environ.get("SCENE_GATE_ENABLED", "0") == "1"
+# 縮小グレースケール画像の平均絶対差 (0〜255) がこの値未満なら「変化なし」とみなす
+SCENE_GATE_THRESHOLD = float(os.environ.get("SCENE_GATE_THRESHOLD", "4.0"))
+# 比較に使う縮小画像の一辺のサイズ
+SCENE_GATE_THUMB_SIZE = int(os.environ.get("SCENE_GATE_THUMB_SIZE", "64"))
+# 連続して省略できる最大回数 (鮮度を保つため、これを超えたら必ず推論する)
+SCENE_GATE_MAX_SKIPS = int(os.environ.get("SCENE_GATE_MAX_SKIPS", "30"))
+# 前回の推論結果を再利用できる最大経過時間 (秒)
+SCENE_GATE_MAX_AGE = float(os.environ.get("SCENE_GATE_MAX_AGE", "600"))
+
+class _SourceState:
+    __slots__ = ("thumbnail", "result", "signature", "updated_at", "consecutive_skips", "frames", "skips")
+
+    def __init__(self):
+        self.thumbnail: Optional[np.ndarray] = None
+        self.result: Any = None
+        self.signature = "" # 前回の結果を出したモデル構成
+        self.updated_at = 0.0
+        self.consecutive_skips = 0
+        self.frames = 0
+        self.skips = 0
+
+class SceneChangeGate:
+    """
+    カメラ (ソース) ごとに、最後に推論した画像の縮小グレースケール画像を保持し、
+    新しい画像との差が閾値未満なら前回の検出結果を再利用して推論を省略する。
+    モデル構成 (signature) が前回の結果と異なる場合は、変化がなくても推論する。
+    """
+    def __init__(
+        self,
+        enabled: bool = SCENE_GATE_ENABLED,
+        threshold: float = SCENE_GATE_THRESHOLD,
+        thumb_size: int = SCENE_GATE_THUMB_SIZE,
+        max_skips: int = SCENE_GATE_MAX_SKIPS,
+        max_age: float = SCENE_GATE_MAX_AGE
+    ):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.thumb_size = thumb_size
+        self.max_skips = max_skips
+        self.max_age = max_age
+        self._sources: Dict[str, _SourceState] = {}
+        self._lock = threading.Lock()
+
+    def thumbnail(self, image: np.ndarray) -> np.ndarray:
+        """比較用の縮小グレースケール画像を作る"""
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+        return cv2.resize(gray, (self.thumb_size, self.thumb_size), interpolation=cv2.INTER_AREA)
+
+    def check(self, source: str, thumbnail: np.ndarray, signature: str = "") -> Tuple[bool, Any, float]:
+        """
+        前回の画像と比較する。
+
+        Args:
+            signature: 現在のモデル構成 (ai_service.get_model_signature)。モデルの再読み込み後に古い結果を返さないために使う。
+
+        Returns:
+            (推論を省略できるか, 再利用する前回の結果, 平均絶対差)
+        """
+        with self._lock:
+            state = self._sources.setdefault(source, _SourceState())
+            state.frames += 1
+            if state.thumbnail is None or state.signature != signature:
+                return False, None, float("inf")
+            # 縮小画像同士の差をまとめて計算する (ループを使わない)
+            difference = float(np.mean(np.abs(thumbnail.astype(np.int16) - state.thumbnail.astype(np.int16))))
+            fresh = (time.time() - state.updated_at) <= self.max_age and state.consecutive_skips < self.max_skips
+            if difference < self.threshold and fresh:
+                state.consecutive_skips += 1
+                state.skips += 1
+                return True, state.result, difference
+            return False, None, difference
+
+    def update(self, source: str, thumbnail: np.ndarray, result: Any, signature: str = ""):
+        """推論を実行した画像と結果を、そのソースの比較基準として記録する"""
+        with self._lock:
+            state = self._sources.setdefault(source, _SourceState())
+            state.thumbnail = thumbnail
+            state.result = result
+            state.signature = signature
+            state.updated_at = time.time()
+            state.consecutive_skips = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """ソースごとの省略率を返す (/status 表示用)"""
+        with self._lock:
+            sources = {
+                source: {
+                    "frames": state.frames,
+                    "skipped": state.skips,
+                    "skip_rate": round(state.skips / state.frames, 3) if state.frames else 0.0,
+                }
+                for source, state in self._sources.items()
+            }
+        frames = sum(s["frames"] for s in sources.values())
+        skips = sum(s["skipped"] for s in sources.values())
+        return {
+            "enabled": self.enabled,
+            "threshold": self.threshold,
+            "frames": frames,
+            "skipped": skips,
+            "skip_rate": round(skips / frames, 3) if frames else 0.0,
+            "sources": sources,
+        }
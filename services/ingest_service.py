@@ -0,0 +1,312 @@
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Optional, Set
+
+from .batch_service import BATCH_MAX_SIZE
+from .metrics_service import STAGE_SECONDS
+from .log_service import get_logger, log_event
+
+logger = get_logger("ingest")
+
+# --- 取り込みキューの設定 ---
+# 推論ワーカー (スレッド) の数
+# 各ワーカーはマイクロバッチの結果を待つ間ふさがるため、BATCH_MAX_SIZE 未満だとバッチが埋まらない。
+# 既定では BATCH_MAX_SIZE 以上にする
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", str(max(2, BATCH_MAX_SIZE))))
+# キューに溜められる最大件数 (これを超えると投入側が待たされる = バックプレッシャー)
+INGEST_QUEUE_SIZE = int(os.environ.get("INGEST_QUEUE_SIZE", "64"))
+# キューが満杯のときに投入側が待つ最大秒数。超えた場合は投入を諦める
+INGEST_PUT_TIMEOUT = float(os.environ.get("INGEST_PUT_TIMEOUT", "5.0"))
+# 取り出す順番の優先度 (小さいほど先に処理する)。起動時に残っていた画像は新着より先に処理する
+PRIORITY_BACKLOG = 0
+PRIORITY_NORMAL = 1
+
+# --- ファイル書き込み完了の判定設定 ---
+# サイズ/更新時刻をポーリングする間隔 (秒)
+FILE_READY_POLL_INTERVAL = float(os.environ.get("FILE_READY_POLL_INTERVAL", "0.05"))
+# 何回連続でサイズ/更新時刻が変わらなければ書き込み完了とみなすか
+FILE_READY_STABLE_CHECKS = int(os.environ.get("FILE_READY_STABLE_CHECKS", "2"))
+# 待ち時間の上限 (秒)。MIN〜MAX の範囲で、観測した書き込み時間から適応的に決める
+# 上限に達してもまだサイズ/更新時刻が変わり続けているファイルは、MAX まで待ち続ける
+FILE_READY_MIN_TIMEOUT = float(os.environ.get("FILE_READY_MIN_TIMEOUT", "0.5"))
+FILE_READY_MAX_TIMEOUT = float(os.environ.get("FILE_READY_MAX_TIMEOUT", "3.0"))
+
+# wait_until_ready の結果
+FILE_READY = "ready"       # 書き込み完了 (処理してよい)
+FILE_MISSING = "missing"   # ファイルが消えた
+FILE_WRITING = "writing"   # FILE_READY_MAX_TIMEOUT まで待ってもまだ書き込み中 (後で再試行する)
+
+class FileReadinessTracker:
+    """
+    新しいファイルの書き込みが完了したかを判定する。
+    - close_write (on_closed) やリネーム (on_moved) を受け取ったファイルは即座に完了とみなす
+    - それ以外はサイズ/更新時刻が安定するまでポーリングする (変化し続けている間は処理しない)
+    待ち時間の上限は、これまでに観測した書き込み時間から適応的に決める。
+    """
+    def __init__(
+        self,
+        poll_interval: float = FILE_READY_POLL_INTERVAL,
+        stable_checks: int = FILE_READY_STABLE_CHECKS,
+        min_timeout: float = FILE_READY_MIN_TIMEOUT,
+        max_timeout: float = FILE_READY_MAX_TIMEOUT
+    ):
+        self.poll_interval = poll_interval
+        self.stable_checks = max(1, stable_checks)
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self._ready: Dict[str, float] = {} # パス -> 完了通知を受けた時刻
+        self._lock = threading.Lock()
+        self._avg_wait = 0.0 # 観測した待ち時間の指数移動平均
+        self._stats = {"signaled": 0, "stable": 0, "timeout": 0, "writing": 0, "missing": 0}
+
+    def mark_ready(self, path: str):
+        """close_write/リネームなどで書き込み完了が分かったファイルを登録する"""
+        now = time.monotonic()
+        with self._lock:
+            self._ready[path] = now
+            # 処理されなかったパスが溜まり続けないよう、古い通知は捨てる
+            if len(self._ready) > 1024:
+                for stale in [p for p, t in self._ready.items() if now - t > 60]:
+                    del self._ready[stale]
+
+    def forget(self, path: str):
+        """処理を引き受けたファイルの完了通知を消す (同じ名前で後から届いたファイルを完了済みと誤認しない)"""
+        with self._lock:
+            self._ready.pop(path, None)
+
+    def current_timeout(self) -> float:
+        """適応的な待ち時間の上限 (観測した平均書き込み時間の4倍を min/max で制限)"""
+        return min(self.max_timeout, max(self.min_timeout, self._avg_wait * 4))
+
+    def wait_until_ready(self, path: str) -> str:
+        """
+        ファイルの書き込みが完了するまで待つ。
+        適応的な上限に達した時点で変化が止まっていれば完了とみなし、まだ変化している場合は
+        FILE_READY_MAX_TIMEOUT まで待ち続ける。それでも変化が止まらなければ書き込み中として返す。
+
+        Returns:
+            str: FILE_READY / FILE_MISSING / FILE_WRITING のいずれか。
+        """
+        start = time.monotonic()
+        timeout = self.current_timeout()
+        previous = None
+        stable_count = 0
+        outcome = "timeout"
+
+        while True:
+            with self._lock:
+                signaled = self._ready.pop(path, None) is not None
+            if signaled:
+                outcome = "signaled"
+                break
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                outcome = "missing"
+                break
+            sample = (st.st_size, st.st_mtime_ns)
+            changing = st.st_size == 0 or sample != previous
+            if not changing:
+                stable_count += 1
+                if stable_count >= self.stable_checks or _has_complete_jpeg_marker(path, st.st_size):
+                    outcome = "stable"
+                    break
+            else:
+                stable_count = 0
+            previous = sample
+            elapsed = time.monotonic() - start
+            if elapsed >= max(timeout, self.max_timeout):
+                outcome = "writing" if changing else "timeout"
+                break
+            if elapsed >= timeout and not changing:
+                break
+            time.sleep(self.poll_interval)
+
+        waited = time.monotonic() - start
+        STAGE_SECONDS.observe(waited, stage="file_ready_wait")
+        with self._lock:
+            self._stats[outcome] += 1
+            if outcome == "stable":
+                # 安定判定に要した時間だけを学習し、次回以降の上限に反映する
+                self._avg_wait = waited if self._avg_wait == 0.0 else self._avg_wait * 0.8 + waited * 0.2
+        if outcome == "timeout":
+            log_event(logger, "file_ready_timeout", logging.WARNING, path=path, timeout_seconds=round(timeout, 2))
+        elif outcome == "writing":
+            log_event(logger, "file_still_writing", logging.WARNING, path=path, waited_seconds=round(waited, 2))
+        if outcome == "missing":
+            return FILE_MISSING
+        return FILE_WRITING if outcome == "writing" else FILE_READY
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+        stats["timeout_seconds"] = round(self.current_timeout(), 3)
+        return stats
+
+def _has_complete_jpeg_marker(path: str, size: int) -> bool:
+    """JPEG の場合、末尾が EOI マーカー (FFD9) で終わっていれば書き込み完了とみなす"""
+    if size < 2 or not path.lower().endswith(('.jpg', '.jpeg')):
+        return False
+    try:
+        with open(path, 'rb') as f:
+            f.seek(-2, os.SEEK_END)
+            return f.read(2) == b'\xff\xd9'
+    except OSError:
+        return False
+
+class IngestQueue:
+    """
+    有界キューと複数の推論ワーカーからなる取り込みキュー。
+    watchdog のイベントハンドラはパスを投入するだけにし、重い処理はワーカーで行う。
+    """
+    def __init__(
+        self,
+        handler: Callable[[Any], None],
+        workers: int = INGEST_WORKERS,
+        maxsize: int = INGEST_QUEUE_SIZE,
+        put_timeout: float = INGEST_PUT_TIMEOUT
+    ):
+        self.handler = handler
+        self.worker_count = max(1, workers)
+        self.put_timeout = put_timeout
+        self._queue: "queue.PriorityQueue" = queue.PriorityQueue(maxsize=maxsize)
+        self._sequence = itertools.count() # 同じ優先度の中では投入順 (FIFO) にする
+        self._pending: Set[Hashable] = set() # 同じファイルの二重投入を防ぐためのキー
+        self._lock = threading.Lock()
+        self._threads = []
+        self._running = False
+        self._in_flight = 0
+        self._stats: Dict[str, float] = {
+            "submitted": 0, "backlog": 0, "processed": 0, "failed": 0, "rejected": 0, "duplicates": 0,
+            "max_depth": 0, "total_wait_seconds": 0.0, "total_process_seconds": 0.0,
+        }
+
+    def start(self):
+        """ワーカースレッドを起動する"""
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+            for i in range(self.worker_count):
+                thread = threading.Thread(target=self._worker_loop, name=f"ingest-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        log_event(logger, "ingest_workers_started", workers=self.worker_count, queue_capacity=self._queue.maxsize)
+
+    def stop(self, timeout: Optional[float] = None):
+        """キューに残っている項目を処理し終えてからワーカーを停止する"""
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+        for _ in self._threads:
+            # 終了の合図は残っている項目をすべて処理した後に取り出されるよう、最も低い優先度で入れる
+            self._queue.put((float("inf"), next(self._sequence), None))
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads.clear()
+
+    def submit(
+        self,
+        item: Any,
+        key: Optional[Hashable] = None,
+        priority: int = PRIORITY_NORMAL,
+        block: bool = False,
+        nowait: bool = False
+    ) -> bool:
+        """
+        項目をキューに投入する。キューが満杯の場合は最大 put_timeout 秒待つ。
+
+        Args:
+            item: ワーカーの handler に渡す項目。
+            key: 二重投入を防ぐためのキー (処理が終わるまで同じキーは投入できない)。
+            priority: 優先度。PRIORITY_BACKLOG の項目は PRIORITY_NORMAL の項目より先に取り出される。
+            block: True の場合、キューが空くまで (タイムアウトせずに) 待つ。
+            nowait: True の場合、キューが満杯なら待たずにすぐ諦める (リクエスト処理やWebSocketの受信スレッド用)。
+
+        Returns:
+            bool: 投入できた場合は True。重複または満杯で投入できなかった場合は False。
+        """
+        if key is not None:
+            with self._lock:
+                if key in self._pending:
+                    self._stats["duplicates"] += 1
+                    return False
+                self._pending.add(key)
+
+        entry = (priority, next(self._sequence), (time.perf_counter(), key, item))
+        try:
+            if nowait:
+                self._queue.put_nowait(entry)
+            else:
+                self._queue.put(entry, timeout=None if block else self.put_timeout)
+        except queue.Full:
+            with self._lock:
+                self._stats["rejected"] += 1
+                self._pending.discard(key)
+            log_event(logger, "queue_full", logging.WARNING, item=str(item), queue_depth=self.depth())
+            return False
+
+        with self._lock:
+            self._stats["submitted"] += 1
+            if priority == PRIORITY_BACKLOG:
+                self._stats["backlog"] += 1
+            self._stats["max_depth"] = max(self._stats["max_depth"], self._queue.qsize())
+        return True
+
+    def depth(self) -> int:
+        """現在キューで待っている項目数"""
+        return self._queue.qsize()
+
+    def stats(self) -> Dict[str, Any]:
+        """キューの状態を返す (/status 表示用)"""
+        with self._lock:
+            stats = dict(self._stats)
+            in_flight = self._in_flight
+        finished = stats["processed"] + stats["failed"]
+        return {
+            "workers": self.worker_count,
+            "queue_depth": self.depth(),
+            "queue_capacity": self._queue.maxsize,
+            "in_flight": in_flight,
+            "submitted": int(stats["submitted"]),
+            "backlog": int(stats["backlog"]),
+            "processed": int(stats["processed"]),
+            "failed": int(stats["failed"]),
+            "rejected": int(stats["rejected"]),
+            "duplicates": int(stats["duplicates"]),
+            "max_depth": int(stats["max_depth"]),
+            "avg_wait_ms": round(stats["total_wait_seconds"] / finished * 1000, 1) if finished else 0.0,
+            "avg_process_ms": round(stats["total_process_seconds"] / finished * 1000, 1) if finished else 0.0,
+        }
+
+    def _worker_loop(self):
+        while True:
+            _, _, entry = self._queue.get()
+            if entry is None:
+                self._queue.task_done()
+                break
+            enqueued_at, key, item = entry
+            started_at = time.perf_counter()
+            STAGE_SECONDS.observe(started_at - enqueued_at, stage="enqueue_wait")
+            with self._lock:
+                self._in_flight += 1
+            succeeded = True
+            try:
+                self.handler(item)
+            except Exception as e:
+                succeeded = False
+                log_event(logger, "worker_error", logging.ERROR, item=str(item), error=str(e))
+            finally:
+                finished_at = time.perf_counter()
+                with self._lock:
+                    self._in_flight -= 1
+                    self._pending.discard(key)
+                    self._stats["processed" if succeeded else "failed"] += 1
+                    self._stats["total_wait_seconds"] += started_at - enqueued_at
+                    self._stats["total_process_seconds"] += finished_at - started_at
+                self._queue.task_done()
@@ -0,0 +1,236 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+from .log_service import get_logger, log_event
+
+logger = get_logger("jobs")
+
+# 状態を保持しておく直近のジョブ数 (古いものから破棄する)
+JOB_HISTORY_SIZE = int(os.environ.get("JOB_HISTORY_SIZE", "1000"))
+# 複数のワーカープロセスで動かす場合に、公開したジョブの状態を共有するディレクトリ (空の場合は共有しない)
+# ジョブを受け付けたプロセスとは別のプロセスに結果の問い合わせが届いても応答できるようにする
+JOB_SHARE_DIR = os.environ.get("JOB_SHARE_DIR", "")
+# 共有ディレクトリに残すジョブの状態の保持時間 (秒)
+JOB_SHARE_TTL = float(os.environ.get("JOB_SHARE_TTL", "3600"))
+# 別プロセスのジョブの完了を待つときのポーリング間隔 (秒)
+JOB_SHARE_POLL_INTERVAL = float(os.environ.get("JOB_SHARE_POLL_INTERVAL", "0.2"))
+
+_JOB_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+class InferenceJob:
+    """
+    推論キューに流す1枚分の仕事。
+    imgフォルダからの取り込みなら path、アップロードからのメモリ取り込みなら data (画像のバイト列) を持つ。
+    """
+    __slots__ = ("job_id", "filename", "path", "data", "source", "camera_id", "status", "result", "error",
+                 "created_at", "started_at", "finished_at", "on_finished")
+
+    def __init__(
+        self,
+        filename: str,
+        path: Optional[str] = None,
+        data: Optional[bytes] = None,
+        source: str = "folder",
+        camera_id: str = "folder"
+    ):
+        self.job_id = uuid.uuid4().hex
+        self.filename = filename
+        self.path = path
+        self.data = data
+        self.source = source
+        self.camera_id = camera_id # 撮影元カメラの識別子 (シーン変化の比較に使う)
+        self.status = "queued" # queued -> processing -> done / failed (失敗した folder の画像は retrying -> queued で再試行)
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        # done/failed になったときに呼ばれる (ストリーミング接続へ結果を送り返すのに使う)
+        self.on_finished: Optional[Callable[["InferenceJob"], None]] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        """API応答用の辞書に変換する"""
+        return {
+            "job_id": self.job_id,
+            "filename": self.filename,
+            "source": self.source,
+            "camera_id": self.camera_id,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "timing": self.timing(),
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "InferenceJob":
+        """to_dict() の結果から復元する (別プロセスで処理中/処理済みのジョブの参照用)"""
+        job = cls(data["filename"], source=data["source"], camera_id=data["camera_id"])
+        for key in ("job_id", "status", "result", "error", "created_at", "started_at", "finished_at"):
+            setattr(job, key, data[key])
+        return job
+
+    def timing(self) -> Dict[str, Optional[float]]:
+        """キュー待ち/処理/合計の時間 (ミリ秒)。まだ終わっていない区間は None"""
+        def elapsed_ms(start: Optional[float], end: Optional[float]) -> Optional[float]:
+            return round((end - start) * 1000, 1) if start is not None and end is not None else None
+        return {
+            "queue_wait_ms": elapsed_ms(self.created_at, self.started_at),
+            "processing_ms": elapsed_ms(self.started_at, self.finished_at),
+            "total_ms": elapsed_ms(self.created_at, self.finished_at),
+        }
+
+class JobStore:
+    """直近のジョブをIDで引けるように保持する (件数上限付き)"""
+    def __init__(self, max_jobs: int = JOB_HISTORY_SIZE, share_dir: str = JOB_SHARE_DIR):
+        self.max_jobs = max_jobs
+        self.share_dir = share_dir
+        self._jobs: "OrderedDict[str, InferenceJob]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._finished = threading.Condition() # wait() で完了を待っているリクエストを起こす
+        self._published: set = set() # 共有ディレクトリに状態を書き出すジョブ
+        self._published_count = 0
+
+    def add(self, job: InferenceJob) -> InferenceJob:
+        with self._lock:
+            self._jobs[job.job_id] = job
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+        return job
+
+    def get(self, job_id: str) -> Optional[InferenceJob]:
+        """ジョブを返す。このプロセスにない場合は、共有ディレクトリに公開された状態から復元する"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None and self.share_dir:
+            job = self._load_snapshot(job_id)
+        return job
+
+    def publish(self, job: InferenceJob):
+        """
+        ジョブの状態を共有ディレクトリに書き出し、完了時にも更新する (共有しない設定なら何もしない)。
+        API で受け付けたジョブなど、別のプロセスから結果を問い合わせられるジョブに対して呼び出す。
+        """
+        if not self.share_dir:
+            return
+        with self._lock:
+            self._published.add(job.job_id)
+            self._published_count += 1
+            prune = self._published_count % 100 == 0
+        self._write_snapshot(job)
+        if prune:
+            self._prune_snapshots()
+
+    def wait(self, job: InferenceJob, timeout: float) -> bool:
+        """ジョブが done/failed になるまで最大 timeout 秒待つ (ロングポーリング用)。完了していれば True"""
+        with self._lock:
+            local = self._jobs.get(job.job_id) is job
+        if not local:
+            return self._wait_snapshot(job, timeout)
+        with self._finished:
+            return self._finished.wait_for(lambda: job.status in ("done", "failed"), timeout)
+
+    def mark_processing(self, job: InferenceJob):
+        job.status = "processing"
+        job.started_at = time.time()
+
+    def mark_done(self, job: InferenceJob, result: Dict[str, Any]):
+        job.result = result
+        job.status = "done"
+        job.finished_at = time.time()
+        job.data = None # 画像データは処理後に解放する
+        self._notify(job)
+
+    def mark_retrying(self, job: InferenceJob, error: str):
+        job.error = error
+        job.status = "retrying"
+        job.data = None # 再試行時は spool のファイルから読み直す
+
+    def mark_queued(self, job: InferenceJob):
+        job.status = "queued"
+
+    def mark_failed(self, job: InferenceJob, error: str):
+        job.error = error
+        job.status = "failed"
+        job.finished_at = time.time()
+        job.data = None
+        self._notify(job)
+
+    def _notify(self, job: InferenceJob):
+        if job.on_finished is not None:
+            try:
+                job.on_finished(job)
+            except Exception as e:
+                # 通知先の不具合で推論ワーカーを止めない
+                log_event(logger, "job_notify_failed", logging.WARNING, job_id=job.job_id, error=str(e))
+        with self._lock:
+            published = job.job_id in self._published
+            self._published.discard(job.job_id)
+        if published:
+            self._write_snapshot(job)
+        with self._finished:
+            self._finished.notify_all()
+
+    def _snapshot_path(self, job_id: str) -> Optional[str]:
+        # ジョブIDはURLから渡されるので、ファイル名として安全な形式だけを受け付ける
+        if not _JOB_ID_PATTERN.match(job_id):
+            return None
+        return os.path.join(self.share_dir, f"{job_id}.json")
+
+    def _write_snapshot(self, job: InferenceJob):
+        path = self._snapshot_path(job.job_id)
+        try:
+            os.makedirs(self.share_dir, exist_ok=True)
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(job.to_dict(), f, ensure_ascii=False)
+            os.replace(temp_path, path) # 読み込み側が書きかけのファイルを読まないようにする
+        except (OSError, TypeError, ValueError) as e:
+            log_event(logger, "job_snapshot_failed", logging.WARNING, job_id=job.job_id, error=str(e))
+
+    def _load_snapshot(self, job_id: str) -> Optional[InferenceJob]:
+        path = self._snapshot_path(job_id)
+        if path is None:
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return InferenceJob.from_dict(json.load(f))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _wait_snapshot(self, job: InferenceJob, timeout: float) -> bool:
+        """別プロセスのジョブの完了を、共有ディレクトリの状態をポーリングして待つ"""
+        deadline = time.monotonic() + timeout
+        while job.status not in ("done", "failed"):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(JOB_SHARE_POLL_INTERVAL, remaining))
+            latest = self._load_snapshot(job.job_id)
+            if latest is not None:
+                for key in ("status", "result", "error", "started_at", "finished_at"):
+                    setattr(job, key, getattr(latest, key))
+        return True
+
+    def _prune_snapshots(self):
+        cutoff = time.time() - JOB_SHARE_TTL
+        try:
+            names = os.listdir(self.share_dir)
+        except FileNotFoundError:
+            return
+        for name in names:
+            path = os.path.join(self.share_dir, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except FileNotFoundError:
+                continue
@@ -0,0 +1,82 @@
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+    import msvcrt
+
+from .log_service import get_logger, log_event
+
+logger = get_logger("lock")
+
+# --- プロセス間で1つだけ動かす処理 (img/ の監視など) の設定 ---
+# ロックファイルの置き場所。複数のワーカープロセスのうち、このファイルをロックできた1つだけが担当する
+RUN_DIR = os.environ.get(
+    "RUN_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'run')
+)
+# 担当になれなかったプロセスがロックを取り直す間隔 (秒)。担当のプロセスが落ちると別のプロセスが引き継ぐ
+LEADER_RETRY_INTERVAL = float(os.environ.get("LEADER_RETRY_INTERVAL", "5.0"))
+
+class ProcessLock:
+    """
+    ファイルロックによるプロセス間の排他。ロックはプロセスが終了すると OS が自動的に解放する。
+    (フォーク後に取得すること。フォーク前に取得したロックは子プロセスにも引き継がれてしまう)
+    """
+    def __init__(self, name: str, run_dir: str = RUN_DIR):
+        self.path = os.path.join(run_dir, f"{name}.lock")
+        self._fd: Optional[int] = None
+
+    @property
+    def held(self) -> bool:
+        return self._fd is not None
+
+    def try_acquire(self) -> bool:
+        """ロックを取得できれば True (待たない)"""
+        if self._fd is not None:
+            return True
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        except OSError:
+            os.close(fd)
+            return False
+        # 調査用に担当プロセスの PID を書いておく
+        os.ftruncate(fd, 0)
+        os.write(fd, f"{os.getpid()}\n".encode())
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is None:
+            return
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        else:
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+        os.close(self._fd)
+        self._fd = None
+
+def run_as_leader(lock: ProcessLock, start: Callable[[], None], retry_interval: float = LEADER_RETRY_INTERVAL) -> threading.Thread:
+    """
+    ロックを取得できたプロセスでだけ start() を実行する。
+    取得できなかった場合はバックグラウンドで取り直しを続け、担当のプロセスが終了したら引き継ぐ。
+    """
+    def _run():
+        while not lock.try_acquire():
+            time.sleep(retry_interval)
+        log_event(logger, "leader_acquired", lock=lock.path, pid=os.getpid())
+        start()
+
+    thread = threading.Thread(target=_run, name=f"leader-{os.path.basename(lock.path)}", daemon=True)
+    thread.start()
+    return thread
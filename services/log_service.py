@@ -0,0 +1,162 @@
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
+import threading
+from typing import Any, Dict, Optional
+
+# --- イベントログの設定 ---
+# コンソールに出力するレベル (DEBUG にすると watchdog の全イベントなども表示する)
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# 構造化ログ (1行1JSON) の出力先。空の場合はファイルに出力しない
+# 子プロセス (gunicorn のワーカーや推論のプロセスプール) は PID 付きのファイル (events.<PID>.jsonl) に書く
+LOG_FILE = os.environ.get(
+    "LOG_FILE",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'logs', 'events.jsonl')
+)
+LOG_FILE_LEVEL = os.environ.get("LOG_FILE_LEVEL", "INFO").upper()
+# ログファイルのローテーション (1ファイルの最大サイズと残す世代数)
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT", "5"))
+# 書き込み待ちのログの上限。満杯のときは推論処理を待たせず、ログを捨てる
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+# 検出1件ごとの詳細 (ボックス座標など) をログに含めるか (本番では 0 にして量を減らせる)
+LOG_DETECTION_DETAILS = os.environ.get("LOG_DETECTION_DETAILS", "1") == "1"
+
+class JsonLinesFormatter(logging.Formatter):
+    """ログレコードを1行のJSONにする。log_event で渡した項目はそのままキーになる"""
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class ConsoleFormatter(logging.Formatter):
+    """コンソール向けの1行表示 (構造化項目は key=value で後ろに付ける)"""
+    def format(self, record: logging.LogRecord) -> str:
+        line = f"[{datetime.datetime.fromtimestamp(record.created).strftime('%H:%M:%S')}] {record.levelname:<7} {record.getMessage()}"
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items() if key != "detection_details")
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """キューが満杯でも呼び出し側を待たせず、ログを捨てて件数だけ数える"""
+    def __init__(self, log_queue: "queue.Queue"):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 構造化項目 (fields) を残したまま、メッセージだけ先に確定させる
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        return record
+
+_setup_lock = threading.Lock()
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional[NonBlockingQueueHandler] = None
+_forked = False # フォークで作られた子プロセスか
+
+def _log_file_path() -> str:
+    """
+    このプロセスが書き込むログファイル。
+    RotatingFileHandler は複数のプロセスが同じファイルに書くとローテーションで互いのログを消してしまうため、
+    子プロセスでは PID 付きのファイルにする。
+    """
+    if not _forked and multiprocessing.parent_process() is None:
+        return LOG_FILE
+    root, ext = os.path.splitext(LOG_FILE)
+    return f"{root}.{os.getpid()}{ext}"
+
+def setup_logging():
+    """
+    アプリ全体のログ出力を設定する (2回目以降は何もしない)。
+    ログを出すスレッドはキューに積むだけで、コンソール/ファイルへの書き込みは専用スレッドで行う。
+    """
+    global _listener, _queue_handler
+    with _setup_lock:
+        if _listener is not None:
+            return
+        handlers = []
+        console = logging.StreamHandler()
+        console.setLevel(LOG_LEVEL)
+        console.setFormatter(ConsoleFormatter())
+        handlers.append(console)
+        if LOG_FILE:
+            log_file = _log_file_path()
+            os.makedirs(os.path.dirname(os.path.abspath(log_file)), exist_ok=True)
+            file_handler = logging.handlers.RotatingFileHandler(
+                log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
+            )
+            file_handler.setLevel(LOG_FILE_LEVEL)
+            file_handler.setFormatter(JsonLinesFormatter())
+            handlers.append(file_handler)
+
+        first_setup = _queue_handler is None
+        logger = logging.getLogger("detection")
+        if _queue_handler is not None:
+            logger.removeHandler(_queue_handler)
+        _queue_handler = NonBlockingQueueHandler(queue.Queue(maxsize=max(1, LOG_QUEUE_SIZE)))
+        logger.setLevel(min(logging.getLevelName(LOG_LEVEL), logging.getLevelName(LOG_FILE_LEVEL)))
+        logger.addHandler(_queue_handler)
+        logger.propagate = False
+
+        _listener = logging.handlers.QueueListener(_queue_handler.queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        if first_setup:
+            atexit.register(_stop_listener) # 終了時にキューに残ったログを書き出す
+
+def _stop_listener():
+    if _listener is not None:
+        _listener.stop()
+
+def _reset_after_fork():
+    """
+    フォークした子プロセス (gunicorn のワーカーなど) では書き込みスレッドが存在しないため、
+    キューと書き込みスレッドを作り直す (ログファイルも子プロセス用のものに切り替える)。
+    """
+    global _listener, _setup_lock, _forked
+    _setup_lock = threading.Lock()
+    _forked = True
+    if _listener is not None:
+        _listener = None
+        setup_logging()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+def get_logger(name: str = "") -> logging.Logger:
+    """detection 配下のロガーを返す"""
+    setup_logging()
+    return logging.getLogger(f"detection.{name}" if name else "detection")
+
+def log_event(logger: logging.Logger, event: str, level: int = logging.INFO, **fields: Any):
+    """
+    構造化イベントを1件記録する。fields はJSONログの項目としてそのまま出力される。
+    呼び出し側はキューに積むだけなので、ディスクやコンソールへの書き込みを待たない。
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={"fields": fields})
+
+def dropped_log_count() -> int:
+    """キューが満杯で捨てたログの件数"""
+    return _queue_handler.dropped if _queue_handler is not None else 0
@@ -0,0 +1,301 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from .log_service import get_logger, log_event
+
+logger = get_logger("models")
+
+# --- モデルレジストリの設定 ---
+# 常駐させるモデルのメモリ上限 (MB)。0 の場合は上限なし (全モデルを起動時にロードして常駐させる)
+MODEL_MEMORY_BUDGET_MB = float(os.environ.get("MODEL_MEMORY_BUDGET_MB", "0"))
+# 上限を超えても追い出さないモデル (ファイル名またはカテゴリをカンマ区切りで指定)
+MODEL_PINNED = [name.strip() for name in os.environ.get("MODEL_PINNED", "").split(",") if name.strip()]
+
+def estimate_model_bytes(model: Any, path: Optional[str] = None) -> int:
+    """
+    モデルが使うメモリ量の見積もり (バイト)。
+    PyTorch モデルはパラメータとバッファの合計、それ以外はモデルファイルのサイズで代用する。
+    """
+    torch_model = getattr(model, "model", None)
+    if hasattr(torch_model, "parameters"):
+        try:
+            total = sum(p.numel() * p.element_size() for p in torch_model.parameters())
+            total += sum(b.numel() * b.element_size() for b in torch_model.buffers())
+            if total:
+                return int(total)
+        except Exception:
+            pass
+    if path and os.path.exists(path):
+        return os.path.getsize(path)
+    return 0
+
+class _ModelEntry:
+    __slots__ = ("name", "category", "path", "pinned", "file_stat", "model", "memory_bytes",
+                 "names", "input_size", "load_count", "evict_count", "last_used", "load_lock",
+                 "inference_lock", "retired")
+
+    def __init__(self, name: str, category: str, path: str, pinned: bool, file_stat: Tuple[int, int]):
+        self.name = name
+        self.category = category
+        self.path = path
+        self.pinned = pinned
+        self.file_stat = file_stat
+        self.model: Any = None
+        self.memory_bytes = 0
+        # 一度ロードしたら覚えておくメタデータ (追い出し後もロードせずに参照できる)
+        self.names: Optional[Dict[int, str]] = None
+        self.input_size: Optional[int] = None
+        self.load_count = 0
+        self.evict_count = 0
+        self.last_used: Optional[float] = None
+        self.load_lock = threading.Lock()
+        # Ultralytics のモデル (predictor) はスレッドセーフではないため、同じモデルの推論は1つずつ実行する
+        self.inference_lock = threading.Lock()
+        # 登録解除/入れ替え済み。代理オブジェクトを持つ推論が終わるまではモデルを保持する
+        self.retired = False
+
+class LazyModel:
+    """
+    レジストリに登録されたモデルの代理オブジェクト。yolo_model_list にはこれが入る。
+    推論などで実際に使われた時点でレジストリからモデルを取り出し (必要ならロードし)、
+    クラス名と入力サイズはロード済みでなくても参照できるようにする。
+    登録エントリを直接持つため、ホットリロードで登録が外れても、このオブジェクトを
+    取得済みの推論は古いモデルのまま最後まで実行できる。
+    """
+    __slots__ = ("_registry", "_entry", "name")
+
+    def __init__(self, registry: "ModelRegistry", entry: _ModelEntry):
+        self._registry = registry
+        self._entry = entry
+        self.name = entry.name
+
+    def resolve(self) -> Any:
+        return self._registry.resolve(self._entry)
+
+    def __call__(self, *args, **kwargs):
+        with self.inference_lock:
+            return self.resolve()(*args, **kwargs)
+
+    @property
+    def inference_lock(self) -> threading.Lock:
+        """このモデルで推論するときに保持するロック (モデルごとに1つ)"""
+        return self._entry.inference_lock
+
+    @property
+    def names(self) -> Dict[int, str]:
+        names = self._entry.names
+        return names if names is not None else self.resolve().names
+
+    @property
+    def overrides(self) -> Dict[str, Any]:
+        # ai_service.get_model_input_size がロードせずに入力サイズを参照できるようにする
+        input_size = self._entry.input_size
+        return {"imgsz": input_size} if input_size is not None else getattr(self.resolve(), "overrides", {})
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self.resolve(), attr)
+
+    def __repr__(self) -> str:
+        return f"LazyModel({self.name!r})"
+
+class ModelRegistry:
+    """
+    メモリ上限付きのモデルレジストリ。
+    モデルは初めて使われたときにロードし、常駐モデルの合計が上限を超えたら
+    最も長く使われていないモデル (LRU) から追い出す。固定 (pin) したモデルは追い出さない。
+    """
+    def __init__(
+        self,
+        loader: Callable[[str, str], Any],
+        budget_mb: float = MODEL_MEMORY_BUDGET_MB,
+        pinned: Iterable[str] = MODEL_PINNED
+    ):
+        """
+        Args:
+            loader: (モデルファイル名, カテゴリ) を受け取ってモデルを返す関数。失敗時は例外を投げる。
+            budget_mb: 常駐モデルのメモリ上限 (MB)。0 の場合は上限なし。
+            pinned: 常駐させるモデルのファイル名またはカテゴリ。
+        """
+        self.loader = loader
+        self.budget_bytes = int(budget_mb * 1024 * 1024)
+        self.pinned = set(pinned)
+        self._entries: Dict[str, _ModelEntry] = {}
+        self._resident: "OrderedDict[str, None]" = OrderedDict() # 使用順 (古い順) の常駐モデル
+        self._lock = threading.Lock()
+        self._stats = {"loads": 0, "evictions": 0, "load_failures": 0}
+
+    @property
+    def bounded(self) -> bool:
+        return self.budget_bytes > 0
+
+    def is_pinned(self, name: str, category: str) -> bool:
+        return name in self.pinned or category in self.pinned
+
+    def register(
+        self,
+        name: str,
+        category: str,
+        path: str,
+        file_stat: Tuple[int, int],
+        model: Any = None
+    ) -> LazyModel:
+        """
+        モデルを登録する。model を渡した場合はロード済みとして常駐させ、渡さない場合は初回使用時にロードする。
+        同じ名前で内容が変わっていれば、古いモデルは新しいものと一度に入れ替わる。
+        """
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or entry.file_stat != file_stat:
+                if entry is not None:
+                    self._retire(entry)
+                entry = _ModelEntry(name, category, path, self.is_pinned(name, category), file_stat)
+                self._entries[name] = entry
+            else:
+                entry.category = category
+            if model is not None and entry.model is None:
+                self._install(entry, model)
+                self._evict_over_budget(keep=name)
+        return LazyModel(self, entry)
+
+    def unregister(self, name: str):
+        with self._lock:
+            entry = self._entries.pop(name, None)
+            if entry is not None:
+                self._retire(entry)
+
+    def get(self, name: str) -> Any:
+        """モデルを返す。ロードされていなければロードし、上限を超えた分を追い出す"""
+        with self._lock:
+            entry = self._entries.get(name)
+        if entry is None:
+            raise KeyError(f"モデルが登録されていません: {name}")
+        return self.resolve(entry)
+
+    def resolve(self, entry: _ModelEntry) -> Any:
+        """
+        エントリのモデルを返す。登録解除済みのエントリでも、保持しているモデルがあればそれを返す
+        (追い出し後に解除された場合は、常駐させずに一時的にロードする)。
+        """
+        with self._lock:
+            if entry.model is not None:
+                if not entry.retired:
+                    self._touch(entry)
+                return entry.model
+
+        # ロードは時間がかかるため、レジストリ全体ではなくモデルごとのロックで行う
+        with entry.load_lock:
+            if entry.model is not None:
+                with self._lock:
+                    if not entry.retired:
+                        self._touch(entry)
+                return entry.model
+            start = time.perf_counter()
+            try:
+                model = self.loader(entry.name, entry.category)
+            except Exception:
+                with self._lock:
+                    self._stats["load_failures"] += 1
+                raise
+            load_seconds = time.perf_counter() - start
+
+            with self._lock:
+                if entry.retired:
+                    # ロード中に登録が消えた/入れ替わった場合は、常駐させずにそのまま返す
+                    return model
+                self._install(entry, model)
+                evicted = self._evict_over_budget(keep=entry.name)
+        if self.bounded:
+            log_event(logger, "model_loaded_on_demand", model=entry.name, load_seconds=round(load_seconds, 1), evicted=evicted)
+        return model
+
+    def is_resident(self, name: str) -> bool:
+        with self._lock:
+            entry = self._entries.get(name)
+            return entry is not None and entry.model is not None
+
+    def cached_input_size(self, name: str) -> Optional[int]:
+        entry = self._entries.get(name)
+        return entry.input_size if entry is not None else None
+
+    def resident_bytes(self) -> int:
+        with self._lock:
+            return sum(self._entries[name].memory_bytes for name in self._resident)
+
+    def stats(self) -> Dict[str, Any]:
+        """モデルごとの常駐状況・ロード回数・メモリ量 (/status 表示用)"""
+        with self._lock:
+            models = {
+                entry.name: {
+                    "category": entry.category,
+                    "resident": entry.model is not None,
+                    "pinned": entry.pinned,
+                    "load_count": entry.load_count,
+                    "evict_count": entry.evict_count,
+                    "memory_mb": round(entry.memory_bytes / (1024 * 1024), 1),
+                    "last_used": entry.last_used,
+                }
+                for entry in self._entries.values()
+            }
+            resident_bytes = sum(self._entries[name].memory_bytes for name in self._resident)
+            stats = dict(self._stats)
+        stats.update(
+            budget_mb=round(self.budget_bytes / (1024 * 1024), 1) if self.bounded else None,
+            resident_mb=round(resident_bytes / (1024 * 1024), 1),
+            resident=sum(1 for m in models.values() if m["resident"]),
+            registered=len(models),
+            models=models,
+        )
+        return stats
+
+    def _install(self, entry: _ModelEntry, model: Any):
+        """ロードしたモデルを常駐させ、メタデータを記録する (ロック内で呼ぶ)"""
+        entry.model = model
+        entry.memory_bytes = estimate_model_bytes(model, entry.path)
+        entry.names = getattr(model, "names", None)
+        imgsz = getattr(model, "overrides", {}).get("imgsz")
+        if imgsz:
+            entry.input_size = int(max(imgsz) if isinstance(imgsz, (list, tuple)) else imgsz)
+        entry.load_count += 1
+        self._stats["loads"] += 1
+        self._touch(entry)
+
+    def _touch(self, entry: _ModelEntry):
+        entry.last_used = time.time()
+        self._resident[entry.name] = None
+        self._resident.move_to_end(entry.name)
+
+    def _drop(self, entry: _ModelEntry):
+        entry.model = None
+        self._resident.pop(entry.name, None)
+
+    def _retire(self, entry: _ModelEntry):
+        """
+        登録から外す (ロック内で呼ぶ)。常駐数・メモリ量の集計からは除くが、モデル自体は
+        消さないため、代理オブジェクトを取得済みの推論はそのまま完了できる。
+        代理オブジェクトがすべて破棄されればモデルも解放される。
+        """
+        entry.retired = True
+        self._resident.pop(entry.name, None)
+
+    def _evict_over_budget(self, keep: str) -> List[str]:
+        """上限を超えている間、固定されていない最も古いモデルから追い出す (ロック内で呼ぶ)"""
+        evicted: List[str] = []
+        if not self.bounded:
+            return evicted
+        total = sum(self._entries[name].memory_bytes for name in self._resident)
+        for name in list(self._resident):
+            if total <= self.budget_bytes:
+                break
+            entry = self._entries[name]
+            if name == keep or entry.pinned:
+                continue
+            # 推論中のスレッドが参照を持っていれば、そちらが終わるまでモデル自体は解放されない
+            self._drop(entry)
+            entry.evict_count += 1
+            self._stats["evictions"] += 1
+            total -= entry.memory_bytes
+            evicted.append(name)
+        return evicted
@@ -0,0 +1,54 @@
+import logging
+import os
+import threading
+from typing import Optional
+
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+
+from .ai_service import MODEL_DIR, reload_models
+from .log_service import get_logger, log_event
+
+logger = get_logger("model_watch")
+
+# 最後の変更から、この秒数だけ変更がなければ再読み込みする (コピー中の .pt を読まないため)
+MODEL_RELOAD_DEBOUNCE = float(os.environ.get("MODEL_RELOAD_DEBOUNCE", "2.0"))
+
+class ModelDirHandler(FileSystemEventHandler):
+    """yolov8_DataSet 内の .pt の追加・更新・削除を検知し、まとめて再読み込みする"""
+    def __init__(self, debounce: float = MODEL_RELOAD_DEBOUNCE):
+        self.debounce = debounce
+        self._timer: Optional[threading.Timer] = None
+        self._lock = threading.Lock()
+
+    def on_any_event(self, event):
+        if event.is_directory:
+            return
+        paths = [event.src_path, getattr(event, 'dest_path', '')]
+        if not any(path.endswith('.pt') for path in paths if path):
+            return
+        with self._lock:
+            # 連続したイベントは1回の再読み込みにまとめる
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.debounce, self._reload)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _reload(self):
+        try:
+            reload_models()
+        except Exception as e:
+            log_event(logger, "model_reload_failed", logging.ERROR, error=str(e))
+
+def start_model_dir_watcher() -> Optional[Observer]:
+    """モデルフォルダの監視を開始する (フォルダがなければ何もしない)"""
+    if not os.path.isdir(MODEL_DIR):
+        log_event(logger, "model_watch_disabled", logging.WARNING, path=MODEL_DIR, reason="フォルダが存在しません")
+        return None
+    observer = Observer()
+    observer.schedule(ModelDirHandler(), MODEL_DIR, recursive=False)
+    observer.daemon = True
+    observer.start()
+    log_event(logger, "model_watch_started", path=os.path.abspath(MODEL_DIR))
+    return observer
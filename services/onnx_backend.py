@@ -0,0 +1,195 @@
+import ast
+import hashlib
+import os
+import shutil
+import statistics
+import sys
+import time
+from typing import Any, Dict, List
+
+import cv2
+import numpy as np
+
+from .detections import RawDetections, empty_raw, make_raw
+from .log_service import get_logger, log_event
+
+logger = get_logger("backend")
+
+# エクスポート済みモデルのキャッシュ先 (.pt の内容のハッシュごとにフォルダを分ける)
+EXPORT_CACHE_DIR = os.environ.get(
+    "EXPORT_CACHE_DIR",
+    os.path.join(os.path.dirname(__file__), '..', 'yolov8_DataSet', '.export_cache')
+)
+# onnxruntime のスレッド設定 (0 の場合は onnxruntime の既定値)
+ONNX_INTRA_OP_THREADS = int(os.environ.get("ONNX_INTRA_OP_THREADS", "0"))
+ONNX_INTER_OP_THREADS = int(os.environ.get("ONNX_INTER_OP_THREADS", "1"))
+# 後処理の設定 (Ultralytics の predict の既定値に合わせる)
+ONNX_CONF_THRESHOLD = 0.25
+ONNX_IOU_THRESHOLD = 0.7
+ONNX_MAX_DET = 300
+_CLASS_OFFSET = 7680 # クラスごとにNMSするため、クラスIDに応じて座標をずらす量
+
+def file_sha256(path: str) -> str:
+    """モデルファイルの内容のハッシュ (エクスポートキャッシュのキー)"""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def export_model(pt_path: str, backend: str) -> str:
+    """
+    .pt を ONNX / OpenVINO IR にエクスポートし、キャッシュ先のパスを返す。
+    同じ内容の .pt をエクスポート済みなら、エクスポートせずにキャッシュを返す。
+    """
+    from ultralytics import YOLO
+
+    base_name = os.path.splitext(os.path.basename(pt_path))[0]
+    cache_dir = os.path.join(EXPORT_CACHE_DIR, file_sha256(pt_path)[:16])
+    if backend == "onnx":
+        cached_path = os.path.join(cache_dir, f"{base_name}.onnx")
+    else:
+        # 静的な入力形状でエクスポートしていた以前のキャッシュ (*_openvino_model) とは別の名前にする
+        cached_path = os.path.join(cache_dir, f"{base_name}_dynamic_openvino_model")
+    if os.path.exists(cached_path):
+        return cached_path
+
+    log_event(logger, "model_export_started", model=os.path.basename(pt_path), backend=backend)
+    start = time.perf_counter()
+    model = YOLO(pt_path)
+    # 学習時の入力サイズでエクスポートする。マイクロバッチ/タイルをまとめて推論でき、
+    # 長方形のレターボックス画像もそのまま渡せるよう、ONNX/OpenVINO ともに動的な入力形状にする
+    export_kwargs = {"format": backend, "imgsz": model.overrides.get("imgsz") or 640, "dynamic": True}
+    exported_path = model.export(**export_kwargs)
+    os.makedirs(cache_dir, exist_ok=True)
+    shutil.move(str(exported_path), cached_path)
+    log_event(logger, "model_exported", path=cached_path, backend=backend, seconds=round(time.perf_counter() - start, 1))
+    return cached_path
+
+class OnnxDetector:
+    """
+    エクスポートした YOLOv8 の ONNX モデルを onnxruntime で直接実行する検出器。
+    スレッド数などのセッション設定を調整でき、後処理 (NMS) も NumPy/OpenCV で行う。
+    """
+    def __init__(self, onnx_path: str, intra_op_threads: int = ONNX_INTRA_OP_THREADS, inter_op_threads: int = ONNX_INTER_OP_THREADS):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        if intra_op_threads > 0:
+            options.intra_op_num_threads = intra_op_threads
+        if inter_op_threads > 0:
+            options.inter_op_num_threads = inter_op_threads
+        self.session = ort.InferenceSession(onnx_path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        self.dynamic_batch = not isinstance(self.session.get_inputs()[0].shape[0], int)
+
+        # Ultralytics がエクスポート時に書き込むメタデータからクラス名と入力サイズを取得する
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.names: Dict[int, str] = ast.literal_eval(metadata.get("names", "{}"))
+        imgsz = ast.literal_eval(metadata.get("imgsz", "[640, 640]"))
+        # ai_service.get_model_input_size が YOLO と同じように参照できるようにする
+        self.overrides = {"imgsz": max(imgsz) if isinstance(imgsz, (list, tuple)) else int(imgsz)}
+
+    def predict_raw(self, inputs: List[np.ndarray]) -> List[RawDetections]:
+        """レターボックス済みのBGR画像のリストを推論し、画像ごとの (クラスID, 確信度, xyxy) の配列を返す"""
+        blob = np.stack([cv2.cvtColor(img, cv2.COLOR_BGR2RGB) for img in inputs]).transpose(0, 3, 1, 2)
+        blob = np.ascontiguousarray(blob, dtype=np.float32) / 255.0
+        if self.dynamic_batch:
+            outputs = self.session.run(None, {self.input_name: blob})[0]
+        else:
+            outputs = np.concatenate([self.session.run(None, {self.input_name: blob[i:i + 1]})[0] for i in range(len(inputs))])
+        return [self._postprocess(output) for output in outputs]
+
+    def _postprocess(self, output: np.ndarray) -> RawDetections:
+        # output: (4 + クラス数, アンカー数) -> (アンカー数, 4 + クラス数)
+        predictions = output.T
+        scores = predictions[:, 4:]
+        class_ids = scores.argmax(axis=1)
+        confidences = scores[np.arange(len(scores)), class_ids]
+        keep = confidences >= ONNX_CONF_THRESHOLD
+        if not keep.any():
+            return empty_raw()
+        boxes_xywh = predictions[keep, :4]
+        class_ids = class_ids[keep]
+        confidences = confidences[keep]
+
+        xyxy = np.empty_like(boxes_xywh)
+        xyxy[:, 0] = boxes_xywh[:, 0] - boxes_xywh[:, 2] / 2
+        xyxy[:, 1] = boxes_xywh[:, 1] - boxes_xywh[:, 3] / 2
+        xyxy[:, 2] = boxes_xywh[:, 0] + boxes_xywh[:, 2] / 2
+        xyxy[:, 3] = boxes_xywh[:, 1] + boxes_xywh[:, 3] / 2
+
+        # クラスごとのNMSを1回の呼び出しで行うため、クラスIDに応じて座標をずらす
+        offset = class_ids[:, None].astype(np.float32) * _CLASS_OFFSET
+        nms_boxes = np.concatenate([xyxy[:, :2] + offset, boxes_xywh[:, 2:]], axis=1) # (x, y, w, h)
+        indices = cv2.dnn.NMSBoxes(nms_boxes.tolist(), confidences.tolist(), ONNX_CONF_THRESHOLD, ONNX_IOU_THRESHOLD)
+        indices = np.array(indices, dtype=np.int64).reshape(-1)
+        indices = indices[np.argsort(-confidences[indices])][:ONNX_MAX_DET]
+        return make_raw(class_ids[indices], confidences[indices], xyxy[indices])
+
+def load_backend_model(pt_path: str, backend: str) -> Any:
+    """指定したバックエンドで推論するモデルを返す (torch の場合は .pt をそのままロードする)"""
+    from ultralytics import YOLO
+
+    if backend == "torch":
+        return YOLO(pt_path)
+    exported_path = export_model(pt_path, backend)
+    if backend == "onnx":
+        return OnnxDetector(exported_path)
+    # OpenVINO IR は Ultralytics の AutoBackend 経由で実行する
+    import yaml
+    model = YOLO(exported_path, task="detect")
+    with open(os.path.join(exported_path, "metadata.yaml"), encoding="utf-8") as f:
+        imgsz = yaml.safe_load(f).get("imgsz", [640, 640])
+    model.overrides["imgsz"] = max(imgsz) if isinstance(imgsz, (list, tuple)) else int(imgsz)
+    return model
+
+def compare_backends(image_path: str, backend: str = "onnx", runs: int = 20) -> List[Dict[str, Any]]:
+    """
+    MODEL_DIR 内の各モデルについて、PyTorch と指定バックエンドの推論時間 (中央値) と検出数を比較する。
+    python -m services.onnx_backend <画像パス> [onnx|openvino] [回数] で実行できる。
+    """
+    from services import ai_service
+
+    image = cv2.imread(image_path)
+    if image is None:
+        raise FileNotFoundError(f"画像ファイルの読み込みに失敗しました: {image_path}")
+
+    rows = []
+    for model_name, category in ai_service.MODEL_PATHS:
+        pt_path = os.path.join(ai_service.MODEL_DIR, model_name)
+        torch_model = load_backend_model(pt_path, "torch")
+        imgsz = ai_service.get_model_input_size(torch_model)
+        other_model = load_backend_model(pt_path, backend)
+        input_img = ai_service.letterbox(image, imgsz)[0]
+
+        row: Dict[str, Any] = {"model": model_name, "category": category}
+        for label, model in (("torch", torch_model), (backend, other_model)):
+            ai_service._predict_raw(model, [input_img], imgsz) # ウォームアップ
+            latencies = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                raw = ai_service._predict_raw(model, [input_img], imgsz)
+                latencies.append((time.perf_counter() - start) * 1000)
+            row[f"{label}_ms"] = round(statistics.median(latencies), 1)
+            row[f"{label}_detections"] = len(raw[0].class_ids)
+        row["speedup"] = round(row["torch_ms"] / row[f"{backend}_ms"], 2) if row[f"{backend}_ms"] else 0.0
+        rows.append(row)
+
+    print(f"{'モデル':<28}{'torch(ms)':>12}{backend + '(ms)':>14}{'速度比':>8}{'検出数(torch/' + backend + ')':>24}")
+    for row in rows:
+        print(f"{row['model']:<28}{row['torch_ms']:>12}{row[backend + '_ms']:>14}{row['speedup']:>8}"
+              f"{str(row['torch_detections']) + '/' + str(row[backend + '_detections']):>24}")
+    return rows
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("使い方: python -m services.onnx_backend <画像パス> [onnx|openvino] [回数]")
+        sys.exit(1)
+    compare_backends(
+        sys.argv[1],
+        sys.argv[2] if len(sys.argv) > 2 else "onnx",
+        int(sys.argv[3]) if len(sys.argv) > 3 else 20,
+    )
@@ -0,0 +1,106 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import cv2
+import numpy as np
+
+from .detections import Detections
+from .metrics_service import STAGE_SECONDS
+
+# --- 描画の設定 ---
+# 描画済み画像を保持する件数 (同じ画像を複数回保存/表示する場合に描画し直さない)
+RENDER_CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", "8"))
+# 後から描画できるよう元画像への参照を保持しておく直近のフレーム数 (/jobs/<job_id>/image 用)
+RENDER_FRAME_HISTORY = int(os.environ.get("RENDER_FRAME_HISTORY", "8"))
+
+def draw_detections(original_img: np.ndarray, detections: Detections) -> np.ndarray:
+    """元画像のコピーに検出結果のバウンディングボックスとラベルを描画して返す"""
+    # 描画用の一時画像をコピー
+    drawn_img = original_img.copy()
+    color = (0, 255, 0) # 緑色
+    thickness = 2
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    font_scale = 0.7
+    for i, ((x_min, y_min, x_max, y_max), confidence) in enumerate(zip(detections.boxes.tolist(), detections.confidences.tolist())):
+        cv2.rectangle(drawn_img, (x_min, y_min), (x_max, y_max), color, thickness)
+        label = f"{detections.class_name(i)} ({confidence:.2f})"
+        cv2.putText(drawn_img, label, (x_min, y_min - 10), font, font_scale, color, thickness)
+    return drawn_img
+
+class AnnotatedFrame:
+    """
+    検出結果と、その元画像への参照の組。
+    推論時には描画せず、保存や表示で実際に必要になった時点で render() で描画する。
+    """
+    __slots__ = ("frame_id", "image", "detections")
+
+    def __init__(self, image: np.ndarray, detections: Detections, frame_id: Optional[str] = None):
+        self.frame_id = frame_id or uuid.uuid4().hex
+        self.image = image
+        self.detections = detections
+
+    def render(self) -> np.ndarray:
+        return draw_detections(self.image, self.detections)
+
+class RenderCache:
+    """
+    描画済み画像の小さなLRUキャッシュ。
+    あわせて直近のフレームをキーで引けるように保持し、後から描画を要求できるようにする。
+    """
+    def __init__(self, max_rendered: int = RENDER_CACHE_SIZE, max_frames: int = RENDER_FRAME_HISTORY):
+        self.max_rendered = max_rendered
+        self.max_frames = max_frames
+        self._rendered: "OrderedDict[str, np.ndarray]" = OrderedDict() # frame_id -> 描画済み画像
+        self._frames: "OrderedDict[str, AnnotatedFrame]" = OrderedDict() # キー -> フレーム
+        self._lock = threading.Lock()
+        self._stats = {"renders": 0, "hits": 0, "render_seconds": 0.0}
+
+    def render(self, frame: AnnotatedFrame) -> np.ndarray:
+        """フレームを描画して返す。描画済みならキャッシュを返す"""
+        with self._lock:
+            rendered = self._rendered.get(frame.frame_id)
+            if rendered is not None:
+                self._rendered.move_to_end(frame.frame_id)
+                self._stats["hits"] += 1
+                return rendered
+
+        start = time.perf_counter()
+        rendered = frame.render()
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage="render")
+
+        with self._lock:
+            self._stats["renders"] += 1
+            self._stats["render_seconds"] += elapsed
+            if self.max_rendered > 0:
+                self._rendered[frame.frame_id] = rendered
+                self._rendered.move_to_end(frame.frame_id)
+                while len(self._rendered) > self.max_rendered:
+                    self._rendered.popitem(last=False)
+        return rendered
+
+    def remember(self, key: str, frame: AnnotatedFrame):
+        """後から lookup(key) で描画できるよう、フレームへの参照を保持する (古いものから破棄)"""
+        if self.max_frames <= 0:
+            return
+        with self._lock:
+            self._frames[key] = frame
+            self._frames.move_to_end(key)
+            while len(self._frames) > self.max_frames:
+                self._frames.popitem(last=False)
+
+    def lookup(self, key: str) -> Optional[AnnotatedFrame]:
+        with self._lock:
+            return self._frames.get(key)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["cached"] = len(self._rendered)
+            stats["frames"] = len(self._frames)
+        stats["render_seconds"] = round(stats["render_seconds"], 3)
+        return stats
@@ -0,0 +1,124 @@
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Union
+
+import cv2
+
+from .metrics_service import STAGE_SECONDS
+from .log_service import get_logger, log_event
+
+logger = get_logger("result_writer")
+
+# 推論結果画像の保存先: result/カテゴリ/
+RESULT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'result')
+# 保存を行うバックグラウンドスレッド数
+RESULT_WRITER_THREADS = int(os.environ.get("RESULT_WRITER_THREADS", "2"))
+# 書き込み待ちの最大件数 (超えると投入側が待たされる)
+RESULT_WRITER_MAX_PENDING = int(os.environ.get("RESULT_WRITER_MAX_PENDING", "32"))
+
+class ResultWriter:
+    """
+    推論結果画像をバックグラウンドで保存する。
+    画像のエンコードは1枚につき1回だけ行い、カテゴリごとのフォルダには
+    1回ずつ書き込む (2つ目以降のカテゴリはハードリンクで済ませる)。
+    """
+    def __init__(
+        self,
+        result_dir: str = RESULT_DIR,
+        threads: int = RESULT_WRITER_THREADS,
+        max_pending: int = RESULT_WRITER_MAX_PENDING
+    ):
+        self.result_dir = result_dir
+        self._executor = ThreadPoolExecutor(max_workers=max(1, threads), thread_name_prefix="result-writer")
+        self._pending = threading.BoundedSemaphore(max(1, max_pending))
+        self._created_dirs = set()
+        self._lock = threading.Lock()
+        self._stats = {"images": 0, "files": 0, "hardlinks": 0, "errors": 0}
+
+    def submit(self, image: Union[Any, Callable[[], Any]], filename: str, categories: List[str]) -> Future:
+        """
+        描画済み画像の保存を予約する。推論ワーカーはディスク書き込みを待たない。
+
+        Args:
+            image: 描画済みのBGR画像、または保存時に描画して画像を返す関数 (描画も保存スレッドで行う)。
+            filename: 保存するファイル名 (拡張子でエンコード形式を決める)。
+            categories: 保存先のカテゴリ (重複は1つにまとめる)。
+        """
+        unique_categories = list(dict.fromkeys(categories))
+        self._pending.acquire()
+        future = self._executor.submit(self._write, image, filename, unique_categories)
+        future.add_done_callback(lambda _: self._pending.release())
+        return future
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats)
+
+    def _ensure_dir(self, path: str):
+        if path not in self._created_dirs:
+            os.makedirs(path, exist_ok=True)
+            self._created_dirs.add(path)
+
+    def _write(self, image: Any, filename: str, categories: List[str]) -> List[str]:
+        saved_paths: List[str] = []
+        extension = os.path.splitext(filename)[1].lower() or '.jpg'
+        try:
+            if callable(image):
+                image = image()
+            # 画像のエンコードは1回だけ
+            with STAGE_SECONDS.time(stage="encode"):
+                ok, encoded = cv2.imencode(extension, image)
+            if not ok:
+                raise ValueError(f"画像のエンコードに失敗しました ({extension})")
+            data = encoded.tobytes()
+        except Exception as e:
+            log_event(logger, "result_encode_failed", logging.ERROR, filename=filename, error=str(e))
+            with self._lock:
+                self._stats["errors"] += 1
+            return saved_paths
+
+        first_path: Optional[str] = None
+        for model_category in categories:
+            save_dir = os.path.join(self.result_dir, model_category)
+            output_filepath = os.path.join(save_dir, filename)
+            try:
+                self._ensure_dir(save_dir)
+                linked = False
+                if first_path is not None:
+                    try:
+                        # 同じ内容なので2つ目以降はハードリンクで済ませる
+                        os.link(first_path, output_filepath)
+                        linked = True
+                    except OSError:
+                        linked = False
+                if not linked:
+                    # 書きかけのファイルが見えないよう、一時ファイルに書いてからリネームする
+                    temp_path = output_filepath + '.tmp'
+                    with STAGE_SECONDS.time(stage="imwrite"):
+                        with open(temp_path, 'wb') as f:
+                            f.write(data)
+                        os.replace(temp_path, output_filepath)
+                    first_path = first_path or output_filepath
+                saved_paths.append(output_filepath)
+                with self._lock:
+                    self._stats["files"] += 1
+                    if linked:
+                        self._stats["hardlinks"] += 1
+                log_event(logger, "result_saved", logging.DEBUG, path=output_filepath, category=model_category, hardlink=linked)
+            except PermissionError:
+                log_event(logger, "result_save_failed", logging.ERROR, path=output_filepath, error="書き込み権限がありません")
+                with self._lock:
+                    self._stats["errors"] += 1
+            except Exception as save_e:
+                log_event(logger, "result_save_failed", logging.ERROR, path=output_filepath, error=str(save_e))
+                with self._lock:
+                    self._stats["errors"] += 1
+
+        with self._lock:
+            self._stats["images"] += 1
+        return saved_paths
@@ -1,14 +1,9 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, url_for
 import os
-import datetime
-import uuid
-import time
-import shutil
-# AI/DBサービスを相対インポート
-from .ai_service import run_detection_and_analyze
+# ジョブ/DBサービスを相対インポート
 from .db_service import insert_detection_log
-import cv2 # 画像処理のために追加
-from typing import List, Dict, Any
+from .job_service import InferenceJob, JobStore
+from typing import Callable, Dict, Any
 
 # Blueprintの定義
 api_bp = Blueprint('api', __name__)
@@ -23,152 +18,118 @@ RESULT_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '
 os.makedirs(PROCESSED_IMAGES_FOLDER, exist_ok=True)
 os.makedirs(RESULT_FOLDER, exist_ok=True) # result フォルダも作成
 
-# def draw_bounding_box_and_save(
-#     image_path: str,
-#     detection: Dict[str, Any],
-#     output_filename: str,
-#     model_category: str # 新しい引数を追加
-# ) -> str:
-#     """
-#     画像に最も確信度の高い検出結果のバウンディングボックスを描画し、一時保存する。
-#     描画された画像の一時URLを返す。
-#     """
-#     # 画像の読み込み
-#     img = cv2.imread(image_path)
-#     if img is None:
-#         print(f"ERROR: 画像ファイルの読み込みに失敗しました: {image_path}")
-#         return ""
-# 
-#     # バウンディングボックスの描画
-#     box = detection['box']
-#     x_min, y_min, x_max, y_max = box['x_min'], box['y_min'], box['x_max'], box['x_max']
-#     disease = detection['disease']
-#     confidence = detection['confidence']
-# 
-#     # 色 (B, G, R)
-#     color = (0, 255, 0) # 緑色
-#     thickness = 2
-#     font = cv2.FONT_HERSHEY_SIMPLEX
-#     font_scale = 0.7
-# 
-#     # バウンディングボックス
-#     cv2.rectangle(img, (x_min, y_min), (x_max, y_max), color, thickness)
-# 
-#     # ラベル
-#     label = f"{disease}: {confidence:.2f}"
-#     cv2.putText(img, label, (x_min, y_min - 10), font, font_scale, color, thickness)
-# 
-#     # 描画された画像をまず processed_images に保存
-#     processed_filepath = os.path.join(PROCESSED_IMAGES_FOLDER, output_filename)
-# 
-#     try:
-#         cv2.imwrite(processed_filepath, img)
-#         print(f"SUCCESS: 処理済み画像を保存しました: {processed_filepath}")
-#         
-#         # 0.2秒の遅延を追加
-#         time.sleep(0.2)
-#         
-#         # 検出されたカテゴリに合わせて result フォルダに移動
-#         result_category_folder = os.path.join(RESULT_FOLDER, model_category)
-#         os.makedirs(result_category_folder, exist_ok=True)
-#         
-#         # result フォルダに移動（コピーではなく移動）
-#         result_filepath = os.path.join(result_category_folder, output_filename)
-#         
-#         # ファイルが存在することを確認してから移動
-#         if os.path.exists(processed_filepath):
-#             shutil.move(processed_filepath, result_filepath)
-#             print(f"SUCCESS: 推論結果画像を result フォルダに移動しました: {result_filepath} (カテゴリ: {model_category})")
-#         else:
-#             print(f"ERROR: 移動元のファイルが見つかりません: {processed_filepath}")
-#             return ""
-#         
-#         return f"/static/processed_images/{output_filename}"
-#     except Exception as e:
-#         print(f"ERROR: 処理済み画像の保存・移動中にエラーが発生しました: {e}")
-#         import traceback
-#         traceback.print_exc()
-#         return ""
-# 
-# @api_bp.route('/detect-disease', methods=['POST'])
-# def detect_disease_endpoint():
-#     # 1. ファイル受付のチェック
-#     if 'file' not in request.files:
-#         return jsonify({"error": "ファイルが添付されていません"}), 400
-#     
-#     file = request.files['file']
-#     if file.filename == '':
-#         return jsonify({"error": "ファイル名が空です"}), 400
-#         
-#     original_filename = file.filename
-#     # 一時保存用のユニークなファイル名を作成
-#     unique_filename = f"{uuid.uuid4()}_{original_filename}"
-#     temp_filepath = os.path.join(UPLOAD_FOLDER, unique_filename)
-#     
-#     # 2. 画像の一時保存
-#     try:
-#         file.save(temp_filepath)
-#         print(f"画像ファイル '{original_filename}' を一時保存しました。")
-#     except Exception as e:
-#         print(f"一時ファイル保存エラー: {e}")
-#         return jsonify({"error": f"サーバー側でファイル保存に失敗しました: {e}"}), 500
-# 
-#     # 3. YOLOv8 推論の実行 (AIサービス呼び出し)
-#     try:
-#         final_disease, final_confidence, all_detections = run_detection_and_analyze(temp_filepath)
-#     except Exception as e:
-#         print(f"YOLOv8推論エラー: {e}")
-#         # 4. エラー時も一時ファイルを削除
-#         if os.path.exists(temp_filepath):
-#             os.remove(temp_filepath)
-#         return jsonify({"error": f"AI推論中にエラーが発生しました: {e}"}), 500
-#     
-#     # 4. DBサービスによるログ挿入を実行
-#     db_success, db_message = insert_detection_log(
-#         original_filename, 
-#         final_disease, 
-#         final_confidence,
-#         all_detections
-#     )
-#     
-#     # 5. 一時ファイルの削除 (この位置から移動)
-#     # if os.path.exists(temp_filepath):
-#     #     os.remove(temp_filepath)
-#     #     print(f"一時ファイル '{temp_filepath}' を削除しました。")
-#         
-#     # 6. フロントエンドへの応答データの作成
-#     response_data = {
-#         "disease": final_disease,
-#         "confidence": final_confidence,
-#         "detections": all_detections,
-#         "db_status": "成功" if db_success else "失敗",
-#         "db_detail": db_message,
-#     }
-#     
-#     processed_image_url = "" # 初期化
-#     processed_filepath = "" # 初期化
-# 
-#     if all_detections: # 検出結果がある場合のみ処理済み画像を生成
-#         best_detection = max(all_detections, key=lambda d: d['confidence']) # 最も確信度の高い検出結果
-#         # ユニークなファイル名を生成
-#         processed_filename = f"processed_{uuid.uuid4()}_{os.path.basename(original_filename)}"
-#         processed_image_url = draw_bounding_box_and_save(
-#             temp_filepath, best_detection, processed_filename, best_detection['model_category'] # model_category を追加
-#         )
-#         processed_filepath = os.path.join(PROCESSED_IMAGES_FOLDER, processed_filename)
-# 
-#     response_data["processed_image_url"] = processed_image_url
-# 
-#     print(f"[{datetime.datetime.now().strftime('%H:%M:%S')}] 判定完了。DB: {db_success}")
-#     
-#     # 推論後、検出の有無に関わらず一時ファイルを削除
-#     if os.path.exists(temp_filepath):
-#         os.remove(temp_filepath)
-#         print(f"一時ファイル '{temp_filepath}' を削除しました。")
-#     
-#     # 処理済み画像の一時ファイルを削除 (一時的にコメントアウト)
-#     # if os.path.exists(processed_filepath):
-#     #     os.remove(processed_filepath)
-#     #     print(f"一時処理済みファイル '{processed_filepath}' を削除しました。")
-# 
-#     return jsonify(response_data)
\ No newline at end of file
+# --- 非同期ジョブAPI の設定 ---
+# GET /api/detect-disease/<job_id>?wait=秒 で完了を待つ最大秒数 (リクエストスレッドを長く占有しないよう制限する)
+API_LONG_POLL_MAX = float(os.environ.get("API_LONG_POLL_MAX", "25"))
+
+# app.py の推論パイプライン (ジョブの保持先と推論キューへの投入関数)。init_api で設定する
+_pipeline: Dict[str, Any] = {}
+
+def init_api(job_store: JobStore, submit: Callable[[InferenceJob], bool]):
+    """
+    Blueprint から推論パイプラインを使えるようにする (app.py で Blueprint を登録する前に呼び出す)。
+
+    Args:
+        job_store: ジョブを ID で参照するためのストア。
+        submit: ジョブを共有の推論キューに入れる関数。キューが満杯なら待たずに False を返すこと。
+    """
+    _pipeline.update(job_store=job_store, submit=submit)
+
+def _log_detection_to_db(job: InferenceJob):
+    """推論ワーカーから呼ばれる。完了したジョブの結果をDBに記録する (書き込みはバックグラウンドで行われる)"""
+    if job.status != "done":
+        return
+    db_success, db_message = insert_detection_log(
+        job.filename,
+        job.result["disease"],
+        job.result["confidence"],
+        job.result["detections"]
+    )
+    job.result["db_status"] = "成功" if db_success else "失敗"
+    job.result["db_detail"] = db_message
+
+def _processed_image_url(job: InferenceJob) -> str:
+    """
+    検出結果を描画した画像の URL (返せない場合は空文字)。
+    result/ に保存した画像はどのワーカープロセスからでも返せる。保存していない画像は
+    推論したプロセスの RenderCache にしか保持されないため、そのプロセスだけで動かしている
+    (ジョブを共有していない) 場合に限って案内する。
+    """
+    result = job.result
+    if not result["detections"]:
+        return ""
+    if result.get("saved_image") or (result.get("render_pid") == os.getpid() and not _pipeline["job_store"].share_dir):
+        return f"/jobs/{job.job_id}/image"
+    return ""
+
+def _job_response(job: InferenceJob) -> Dict[str, Any]:
+    """ジョブの状態をAPI応答にする。完了していれば従来の同期APIと同じ項目 (disease, detections など) を含める"""
+    response_data: Dict[str, Any] = {
+        "job_id": job.job_id,
+        "status": job.status,
+        "filename": job.filename,
+        "timing": job.timing(),
+    }
+    if job.status == "done":
+        result = job.result
+        response_data.update({
+            "disease": result["disease"],
+            "confidence": result["confidence"],
+            "detections": result["detections"],
+            "db_status": result.get("db_status", "処理中"),
+            "db_detail": result.get("db_detail", ""),
+            "timings_ms": result.get("timings_ms", {}),
+            # 検出結果を描画した画像 (要求されたときにサーバー側で描画する)
+            "processed_image_url": _processed_image_url(job),
+        })
+    elif job.status == "failed":
+        response_data["error"] = job.error
+    return response_data
+
+@api_bp.route('/detect-disease', methods=['POST'])
+def detect_disease_endpoint():
+    """
+    画像を受け付けて推論ジョブを作成し、すぐに 202 とジョブIDを返す。
+    推論は共有の推論ワーカーで行われ、結果は GET /api/detect-disease/<job_id> で取得する。
+    """
+    # 1. ファイル受付のチェック
+    if 'file' not in request.files:
+        return jsonify({"error": "ファイルが添付されていません"}), 400
+
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({"error": "ファイル名が空です"}), 400
+
+    # 2. ディスクに保存せず、メモリ上のまま推論キューに入れる
+    camera_id = request.form.get('camera_id') or request.remote_addr or "api"
+    job = InferenceJob(file.filename, data=file.read(), source="api", camera_id=camera_id)
+    job.on_finished = _log_detection_to_db
+    # 複数のワーカープロセスで動かしている場合、結果の問い合わせは別のプロセスに届くことがあるので状態を共有する
+    _pipeline["job_store"].publish(job)
+    if not _pipeline["submit"](job):
+        _pipeline["job_store"].mark_failed(job, "推論キューが満杯です")
+        return jsonify({"error": "推論キューが混雑しています。しばらくしてから再送してください"}), 503, {"Retry-After": "5"}
+
+    status_url = url_for('api.detect_disease_result', job_id=job.job_id)
+    return jsonify({"job_id": job.job_id, "status": job.status, "status_url": status_url}), 202, {"Location": status_url}
+
+@api_bp.route('/detect-disease/<job_id>', methods=['GET'])
+def detect_disease_result(job_id):
+    """
+    ジョブの状態と結果を返す。完了していれば 200、処理中なら 202。
+    ?wait=秒 を付けると、完了するまで最大 API_LONG_POLL_MAX 秒待ってから返す (ロングポーリング)。
+    """
+    job_store = _pipeline["job_store"]
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({"error": "ジョブが見つかりません"}), 404
+
+    try:
+        wait = min(max(float(request.args.get('wait', 0)), 0.0), API_LONG_POLL_MAX)
+    except ValueError:
+        return jsonify({"error": "wait は秒数で指定してください"}), 400
+    finished = job.status in ("done", "failed")
+    if not finished and wait > 0:
+        finished = job_store.wait(job, wait)
+
+    return jsonify(_job_response(job)), 200 if finished else 202
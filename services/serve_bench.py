@@ -0,0 +1,149 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _request(url: str, data: Optional[bytes] = None, headers: Optional[Dict[str, str]] = None, timeout: float = 60.0):
+    req = urllib.request.Request(url, data=data, headers=headers or {}, method="POST" if data is not None else "GET")
+    with urllib.request.urlopen(req, timeout=timeout) as response:
+        return response.status, response.read()
+
+def _multipart(filename: str, content: bytes) -> Tuple[bytes, str]:
+    boundary = uuid.uuid4().hex
+    body = (
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{filename}\"\r\n"
+        f"Content-Type: application/octet-stream\r\n\r\n"
+    ).encode() + content + f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+def _detect(base_url: str, image: bytes, filename: str):
+    """POST /api/detect-disease でジョブを作り、完了するまでロングポーリングで待つ"""
+    # 推論結果キャッシュに当たらないよう、JPEG の末尾 (EOI の後ろ) に毎回違うバイト列を付ける
+    body, content_type = _multipart(filename, image + uuid.uuid4().bytes)
+    _, raw = _request(f"{base_url}/api/detect-disease", body, {"Content-Type": content_type})
+    status_url = json.loads(raw)["status_url"]
+    while True:
+        status, raw = _request(f"{base_url}{status_url}?wait=25")
+        if status == 200:
+            if json.loads(raw)["status"] != "done":
+                raise RuntimeError(json.loads(raw).get("error"))
+            return
+
+def _wait_ready(base_url: str, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if _request(f"{base_url}/readyz", timeout=5)[0] == 200:
+                return True
+        except (urllib.error.URLError, ConnectionError, OSError):
+            pass
+        time.sleep(1.0)
+    return False
+
+def run_load(base_url: str, concurrency: int, duration: float, image: Optional[bytes], filename: str) -> Dict[str, Any]:
+    """concurrency 本の並列クライアントで duration 秒間リクエストを送り続け、スループットと遅延を返す"""
+    latencies: List[float] = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client():
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                if image is not None:
+                    _detect(base_url, image, filename)
+                else:
+                    _request(f"{base_url}/healthz")
+            except Exception:
+                with lock:
+                    errors[0] += 1
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "rps": round(len(latencies) / elapsed, 2),
+        "p50_ms": round(statistics.median(latencies) * 1000, 1) if latencies else None,
+        "p95_ms": round(latencies[max(0, int(len(latencies) * 0.95) - 1)] * 1000, 1) if latencies else None,
+    }
+
+def benchmark_workers(
+    worker_counts: List[int],
+    image_path: Optional[str] = None,
+    concurrency: int = 16,
+    duration: float = 30.0,
+    port: int = 5055,
+    ready_timeout: float = 600.0
+) -> List[Dict[str, Any]]:
+    """
+    gunicorn のワーカー数を変えて起動し直し、同じ負荷をかけたときのスループットを比較する。
+    画像を指定した場合は /api/detect-disease の推論完了まで、指定しない場合は /healthz を測る。
+    python -m services.serve_bench --workers 1,2,4 --image <画像パス> で実行できる。
+    """
+    image = None
+    filename = "bench.jpg"
+    if image_path:
+        with open(image_path, 'rb') as f:
+            image = f.read()
+        filename = os.path.basename(image_path)
+    base_url = f"http://127.0.0.1:{port}"
+
+    rows = []
+    for workers in worker_counts:
+        env = dict(os.environ, GUNICORN_WORKERS=str(workers), GUNICORN_BIND=f"127.0.0.1:{port}")
+        server = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py"],
+            cwd=_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        try:
+            if not _wait_ready(base_url, ready_timeout):
+                raise RuntimeError(f"サーバーが起動しませんでした (ワーカー数: {workers})")
+            run_load(base_url, concurrency, min(5.0, duration), image, filename) # ウォームアップ
+            row = {"workers": workers, **run_load(base_url, concurrency, duration, image, filename)}
+            rows.append(row)
+        finally:
+            server.terminate()
+            server.wait(timeout=60)
+
+    baseline = rows[0]["rps"] if rows and rows[0]["rps"] else None
+    print(f"{'ワーカー数':>8}{'req/s':>10}{'p50(ms)':>10}{'p95(ms)':>10}{'エラー':>8}{'対1台':>8}")
+    for row in rows:
+        scaling = round(row["rps"] / baseline, 2) if baseline else 0.0
+        row["scaling"] = scaling
+        print(f"{row['workers']:>8}{row['rps']:>10}{str(row['p50_ms']):>10}{str(row['p95_ms']):>10}{row['errors']:>8}{scaling:>8}")
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="gunicorn のワーカー数ごとのスループットを測定する")
+    parser.add_argument("--workers", default="1,2,4", help="測定するワーカー数 (カンマ区切り)")
+    parser.add_argument("--image", help="推論させる画像 (省略時は /healthz を測定)")
+    parser.add_argument("--concurrency", type=int, default=16, help="並列クライアント数")
+    parser.add_argument("--duration", type=float, default=30.0, help="1回の測定時間 (秒)")
+    parser.add_argument("--port", type=int, default=5055)
+    args = parser.parse_args()
+    benchmark_workers(
+        [int(count) for count in args.workers.split(",")],
+        args.image, args.concurrency, args.duration, args.port,
+    )
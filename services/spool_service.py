@@ -0,0 +1,215 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+from .log_service import get_logger, log_event
+
+logger = get_logger("spool")
+
+# --- 取り込み画像のスプールの設定 ---
+# 画像は img/ (incoming) → processing/ → done/ または failed/ の順にリネームで移動する。
+# リネームは同じファイルシステム内ではアトミックなので、どの時点でプロセスが落ちても画像は失われない。
+SPOOL_DIR = os.environ.get(
+    "SPOOL_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'spool')
+)
+# 推論に失敗した画像を再試行する回数の上限 (これを超えると failed/ に移して残す)
+SPOOL_MAX_ATTEMPTS = int(os.environ.get("SPOOL_MAX_ATTEMPTS", "3"))
+# 再試行までの待ち時間 (秒)。失敗するたびに2倍にする
+SPOOL_RETRY_DELAY = float(os.environ.get("SPOOL_RETRY_DELAY", "5.0"))
+# done/ に残しておく処理済み画像の数 (古いものから削除する)。0 の場合は処理後すぐに削除する
+SPOOL_KEEP_DONE = int(os.environ.get("SPOOL_KEEP_DONE", "100"))
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
+
+class Spool:
+    """
+    取り込み画像の状態をディレクトリで管理するスプール。
+    - incoming   ... 未処理 (img/ フォルダ。外部カメラやアップロードが書き込む)
+    - processing ... 推論ワーカーが処理中、または再試行待ち
+    - done       ... 処理済み (SPOOL_KEEP_DONE 件まで残す)
+    - failed     ... 再試行の上限に達した画像 (削除せず、原因を .error.json に残す)
+    状態の遷移と失敗回数は journal.jsonl に追記し、再起動後も失敗回数を引き継ぐ。
+    """
+    def __init__(
+        self,
+        incoming_dir: str,
+        spool_dir: str = SPOOL_DIR,
+        max_attempts: int = SPOOL_MAX_ATTEMPTS,
+        retry_delay: float = SPOOL_RETRY_DELAY,
+        keep_done: int = SPOOL_KEEP_DONE
+    ):
+        self.incoming_dir = os.path.abspath(incoming_dir)
+        self.spool_dir = os.path.abspath(spool_dir)
+        self.processing_dir = os.path.join(self.spool_dir, 'processing')
+        self.done_dir = os.path.join(self.spool_dir, 'done')
+        self.failed_dir = os.path.join(self.spool_dir, 'failed')
+        self.journal_path = os.path.join(self.spool_dir, 'journal.jsonl')
+        self.max_attempts = max(1, max_attempts)
+        self.retry_delay = retry_delay
+        self.keep_done = keep_done
+        self._attempts: Dict[str, int] = {} # ファイル名 -> これまでに失敗した回数
+        self._done: "deque[str]" = deque() # done/ のファイル名 (古い順)
+        self._lock = threading.Lock()
+        self._stats = {"recovered": 0, "backlog": 0, "claimed": 0, "done": 0, "retried": 0, "failed": 0}
+
+    def recover(self) -> List[str]:
+        """
+        起動時に呼び出す。前回の実行で処理中のまま残った画像を incoming に戻し、
+        incoming に溜まっている未処理の画像のパスを古い順に返す (ファイル監視では検出されないため)。
+        """
+        for directory in (self.incoming_dir, self.processing_dir, self.done_dir, self.failed_dir):
+            os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            self._attempts = self._read_journal()
+            self._done = deque(_sorted_by_mtime(self.done_dir))
+
+        for name in os.listdir(self.processing_dir):
+            if not name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            # 処理中に落ちた画像が原因でプロセスが落ち続けることもあるので、1回の失敗として数える
+            attempts = self._attempts.get(name, 0) + 1
+            if attempts >= self.max_attempts:
+                self._move_to_failed(name, os.path.join(self.processing_dir, name), attempts, "処理中にプロセスが終了しました")
+                continue
+            with self._lock:
+                self._attempts[name] = attempts
+                self._stats["recovered"] += 1
+            os.replace(os.path.join(self.processing_dir, name), os.path.join(self.incoming_dir, name))
+            log_event(logger, "spool_recovered", logging.WARNING, image=name, attempts=attempts)
+
+        backlog = [
+            os.path.join(self.incoming_dir, name) for name in _sorted_by_mtime(self.incoming_dir)
+            if name.lower().endswith(IMAGE_EXTENSIONS)
+        ]
+        with self._lock:
+            # 未処理の画像の失敗回数だけを残して、ジャーナルを書き直す (肥大化を防ぐ)
+            pending = {os.path.basename(path) for path in backlog}
+            self._attempts = {name: count for name, count in self._attempts.items() if name in pending}
+            self._stats["backlog"] = len(backlog)
+            self._compact_journal()
+        if backlog:
+            log_event(logger, "spool_backlog", count=len(backlog), incoming=self.incoming_dir)
+        return backlog
+
+    def claim(self, path: str) -> str:
+        """
+        incoming の画像を processing に移し、移動後のパスを返す (再試行で既に processing にある場合はそのまま)。
+        既に他のワーカーが移動した場合は FileNotFoundError。
+        """
+        name = os.path.basename(path)
+        if os.path.dirname(os.path.abspath(path)) == self.processing_dir:
+            return path
+        claimed = os.path.join(self.processing_dir, name)
+        os.replace(path, claimed)
+        with self._lock:
+            self._stats["claimed"] += 1
+        return claimed
+
+    def complete(self, path: str):
+        """処理済みの画像を done に移す (SPOOL_KEEP_DONE=0 の場合は削除する)"""
+        name = os.path.basename(path)
+        expired: List[str] = []
+        with self._lock:
+            failures = self._attempts.pop(name, 0)
+            self._stats["done"] += 1
+            if self.keep_done > 0:
+                self._done.append(name)
+                while len(self._done) > self.keep_done:
+                    expired.append(self._done.popleft())
+        if self.keep_done > 0:
+            os.replace(path, os.path.join(self.done_dir, name))
+        else:
+            os.remove(path)
+        for old in expired:
+            try:
+                os.remove(os.path.join(self.done_dir, old))
+            except FileNotFoundError:
+                pass
+        if failures:
+            # 失敗回数を記録済みの画像だけ、成功したことをジャーナルに残す
+            self._append_journal(name, "done", 0)
+
+    def fail(self, path: str, error: str) -> Optional[float]:
+        """
+        推論に失敗した画像を記録する。
+        再試行する場合は processing に残したまま待ち時間 (秒) を返し、上限に達した場合は failed に移して None を返す。
+        """
+        name = os.path.basename(path)
+        with self._lock:
+            attempts = self._attempts.get(name, 0) + 1
+            self._attempts[name] = attempts
+        if attempts >= self.max_attempts:
+            self._move_to_failed(name, path, attempts, error)
+            return None
+        with self._lock:
+            self._stats["retried"] += 1
+        self._append_journal(name, "retry", attempts, error)
+        return self.retry_delay * (2 ** (attempts - 1))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats: Dict[str, Any] = dict(self._stats)
+            stats["retry_pending"] = len(self._attempts)
+        for state, directory in (("processing", self.processing_dir), ("failed", self.failed_dir)):
+            try:
+                stats[f"{state}_files"] = sum(1 for name in os.listdir(directory) if name.lower().endswith(IMAGE_EXTENSIONS))
+            except FileNotFoundError:
+                stats[f"{state}_files"] = 0
+        stats["max_attempts"] = self.max_attempts
+        return stats
+
+    def _move_to_failed(self, name: str, path: str, attempts: int, error: str):
+        os.replace(path, os.path.join(self.failed_dir, name))
+        with open(os.path.join(self.failed_dir, name + '.error.json'), 'w', encoding='utf-8') as f:
+            json.dump({"file": name, "attempts": attempts, "error": error, "failed_at": time.time()}, f, ensure_ascii=False)
+        with self._lock:
+            self._attempts.pop(name, None)
+            self._stats["failed"] += 1
+        self._append_journal(name, "failed", attempts, error)
+        log_event(logger, "spool_failed", logging.ERROR, image=name, attempts=attempts, error=error)
+
+    def _append_journal(self, name: str, state: str, attempts: int, error: Optional[str] = None):
+        entry = {"ts": time.time(), "file": name, "state": state, "attempts": attempts}
+        if error is not None:
+            entry["error"] = error
+        with self._lock:
+            with open(self.journal_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def _read_journal(self) -> Dict[str, int]:
+        """ジャーナルを先頭から読み、ファイルごとの最新の失敗回数を返す (done/failed になったものは除く)"""
+        attempts: Dict[str, int] = {}
+        if not os.path.exists(self.journal_path):
+            return attempts
+        with open(self.journal_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue # 書き込み途中で落ちた最後の行は読み飛ばす
+                if entry.get("state") in ("done", "failed"):
+                    attempts.pop(entry.get("file"), None)
+                else:
+                    attempts[entry.get("file")] = int(entry.get("attempts", 0))
+        return attempts
+
+    def _compact_journal(self):
+        temp_path = self.journal_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            for name, count in self._attempts.items():
+                f.write(json.dumps({"ts": time.time(), "file": name, "state": "pending", "attempts": count}, ensure_ascii=False) + "\n")
+        os.replace(temp_path, self.journal_path)
+
+def _sorted_by_mtime(directory: str) -> List[str]:
+    entries = []
+    for name in os.listdir(directory):
+        try:
+            entries.append((os.path.getmtime(os.path.join(directory, name)), name))
+        except FileNotFoundError:
+            continue
+    return [name for _, name in sorted(entries)]
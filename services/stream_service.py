@@ -0,0 +1,147 @@
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from .job_service import InferenceJob
+from .log_service import get_logger, log_event
+from .metrics_service import metrics
+
+logger = get_logger("stream")
+
+# --- ストリーミング取り込み (/stream) の設定 ---
+# 1回の WebSocket メッセージで受け取る画像の最大バイト数 (これを超えるフレームは捨てる)
+STREAM_MAX_FRAME_BYTES = int(os.environ.get("STREAM_MAX_FRAME_BYTES", str(4 * 1024 * 1024)))
+# ブラウザに案内するフレームの送信間隔 (ミリ秒)。サーバー側で間引くので、推論より速くてもよい
+STREAM_FRAME_INTERVAL_MS = int(os.environ.get("STREAM_FRAME_INTERVAL_MS", "200"))
+
+STREAM_FRAMES_TOTAL = metrics.counter("detection_stream_frames_total", "Frames received over the streaming endpoint by outcome.", ["result"])
+
+class CameraStream:
+    """
+    1台のカメラ (1本の WebSocket 接続) の状態。
+    推論中のフレームは1枚だけにし、その間に届いたフレームは最新の1枚だけを残す (latest-wins)。
+    """
+    __slots__ = ("camera_id", "_send", "_send_lock", "in_flight", "pending", "sequence", "closed", "stats")
+
+    def __init__(self, camera_id: str, send: Callable[[str], None]):
+        self.camera_id = camera_id
+        self._send = send
+        self._send_lock = threading.Lock() # 推論ワーカーと受信スレッドの送信が混ざらないようにする
+        self.in_flight: Optional[InferenceJob] = None
+        self.pending: Optional[bytes] = None
+        self.sequence = 0
+        self.closed = False
+        self.stats = {"received": 0, "inferred": 0, "dropped": 0, "rejected": 0}
+
+    def send(self, message: Dict[str, Any]):
+        if self.closed:
+            return
+        try:
+            with self._send_lock:
+                self._send(json.dumps(message, ensure_ascii=False))
+        except Exception as e:
+            # 切断済みの接続への送信は捨てる (受信側のループが終了処理をする)
+            self.closed = True
+            log_event(logger, "stream_send_failed", logging.DEBUG, camera_id=self.camera_id, error=str(e))
+
+class StreamHub:
+    """
+    ストリーミング接続をまとめて管理し、フレームを推論キューに流す。
+    推論が追いつかない間に届いたフレームはサーバー側で捨て、カメラごとに常に最新のフレームを推論する。
+    結果は同じ接続で送り返す。
+    """
+    def __init__(self, submit: Callable[[InferenceJob], bool]):
+        # submit: ジョブを推論キューに入れる関数。キューが満杯なら待たずに False を返すこと
+        # (受信スレッドや、結果を返した直後の推論ワーカーから呼ぶため、待つとストリーム全体が止まる)
+        self.submit = submit
+        self._streams: Dict[int, CameraStream] = {}
+        self._lock = threading.Lock()
+        self._stats = {"connections": 0, "received": 0, "inferred": 0, "dropped": 0, "rejected": 0}
+
+    def open(self, camera_id: str, send: Callable[[str], None]) -> CameraStream:
+        stream = CameraStream(camera_id, send)
+        with self._lock:
+            self._streams[id(stream)] = stream
+            self._stats["connections"] += 1
+        log_event(logger, "stream_opened", camera_id=camera_id)
+        return stream
+
+    def close(self, stream: CameraStream):
+        with self._lock:
+            stream.closed = True
+            stream.pending = None
+            self._streams.pop(id(stream), None)
+        log_event(logger, "stream_closed", camera_id=stream.camera_id, **stream.stats)
+
+    def offer(self, stream: CameraStream, data: bytes):
+        """受信したフレームを渡す。推論中なら最新の1枚として保持し、前に保持していたフレームは捨てる"""
+        if len(data) > STREAM_MAX_FRAME_BYTES:
+            self._count(stream, "rejected")
+            stream.send({"type": "error", "error": f"フレームが大きすぎます ({len(data)} bytes)"})
+            return
+        self._count(stream, "received")
+        with self._lock:
+            if stream.in_flight is not None:
+                if stream.pending is not None:
+                    self._count_locked(stream, "dropped")
+                stream.pending = data
+                return
+            job = self._new_job(stream, data)
+        self._dispatch(stream, job)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats: Dict[str, Any] = dict(self._stats)
+            stats["open"] = len(self._streams)
+            stats["in_flight"] = sum(1 for stream in self._streams.values() if stream.in_flight is not None)
+        return stats
+
+    def _new_job(self, stream: CameraStream, data: bytes) -> InferenceJob:
+        # self._lock を保持した状態で呼ぶ
+        stream.sequence += 1
+        job = InferenceJob(f"stream_{stream.camera_id}_{stream.sequence}.jpg", data=data, source="stream", camera_id=stream.camera_id)
+        job.on_finished = lambda finished, stream=stream: self._finished(stream, finished)
+        stream.in_flight = job
+        return job
+
+    def _dispatch(self, stream: CameraStream, job: InferenceJob):
+        if self.submit(job):
+            self._count(stream, "inferred")
+            return
+        # 推論キューが満杯: このフレームは捨て、次に届いたフレームから再開する
+        with self._lock:
+            if stream.in_flight is job:
+                stream.in_flight = None
+        self._count(stream, "rejected")
+        stream.send({"type": "busy", "job_id": job.job_id})
+
+    def _finished(self, stream: CameraStream, job: InferenceJob):
+        """推論ワーカーから呼ばれる。結果を送り返し、保持していた最新のフレームがあれば続けて推論する"""
+        stream.send({
+            "type": "result",
+            "job_id": job.job_id,
+            "status": job.status,
+            "result": job.result,
+            "error": job.error,
+            "latency_ms": round((time.time() - job.created_at) * 1000, 1),
+            "dropped": stream.stats["dropped"],
+        })
+        with self._lock:
+            stream.in_flight = None
+            if stream.closed or stream.pending is None:
+                return
+            data, stream.pending = stream.pending, None
+            next_job = self._new_job(stream, data)
+        self._dispatch(stream, next_job)
+
+    def _count(self, stream: CameraStream, key: str):
+        with self._lock:
+            self._count_locked(stream, key)
+
+    def _count_locked(self, stream: CameraStream, key: str):
+        stream.stats[key] += 1
+        self._stats[key] += 1
+        STREAM_FRAMES_TOTAL.inc(result=key)
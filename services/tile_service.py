@@ -0,0 +1,79 @@
+import os
+from typing import List, Tuple
+
+import cv2
+import numpy as np
+
+from .detections import RawDetections, empty_raw
+
+# --- タイル推論の設定 ---
+# TILE_MODE:
+#   "off"  ... タイル分割しない (デフォルト。画像全体をモデルの入力サイズに縮小して推論)
+#   "auto" ... 長辺が TILE_MIN_SIDE 以上の画像だけタイル分割する
+#   "on"   ... すべての画像をタイル分割する
+TILE_MODE = os.environ.get("TILE_MODE", "off")
+TILE_MIN_SIDE = int(os.environ.get("TILE_MIN_SIDE", "1920"))
+# タイルの一辺 (元画像のピクセル数)。モデルの入力サイズと同じにすると縮小せずに推論できる
+TILE_SIZE = int(os.environ.get("TILE_SIZE", "640"))
+# 隣り合うタイルの重なりの割合 (タイルの境界にかかった小さな害虫を取りこぼさないため)
+TILE_OVERLAP = float(os.environ.get("TILE_OVERLAP", "0.2"))
+# 1回のバッチで推論するタイル数の上限 (入力画像の解像度によらずピークメモリを抑える)
+TILE_MAX_IN_FLIGHT = int(os.environ.get("TILE_MAX_IN_FLIGHT", "8"))
+# タイル間で重複した検出をまとめる NMS の IoU 閾値
+TILE_NMS_IOU = float(os.environ.get("TILE_NMS_IOU", "0.5"))
+# 大きな対象も検出できるよう、タイルに加えて画像全体 (縮小) も推論する
+TILE_INCLUDE_FULL_FRAME = os.environ.get("TILE_INCLUDE_FULL_FRAME", "1") == "1"
+
+def should_tile(shape: Tuple[int, ...], mode: str = TILE_MODE, min_side: int = TILE_MIN_SIDE) -> bool:
+    """この解像度の画像をタイル分割して推論するか"""
+    if mode == "on":
+        return True
+    if mode == "auto":
+        return max(shape[:2]) >= min_side
+    return False
+
+def tile_signature() -> str:
+    """推論結果に影響するタイル推論の設定を表す文字列 (結果キャッシュのキーに含める)"""
+    if TILE_MODE == "off":
+        return "off"
+    return f"{TILE_MODE}:{TILE_MIN_SIDE}:{TILE_SIZE}:{TILE_OVERLAP}:{TILE_NMS_IOU}:{int(TILE_INCLUDE_FULL_FRAME)}"
+
+def tile_windows(shape: Tuple[int, ...], tile_size: int = TILE_SIZE, overlap: float = TILE_OVERLAP) -> np.ndarray:
+    """
+    画像を重なりのあるタイルに分割したときの各タイルの範囲 (K, 4) [x0, y0, x1, y1] を返す。
+    最後の列/行のタイルは画像の端に揃え、すべてのタイルを同じ大きさにする。
+    """
+    h, w = shape[:2]
+    stride = max(1, int(tile_size * (1 - overlap)))
+
+    def starts(length: int) -> np.ndarray:
+        if length <= tile_size:
+            return np.array([0])
+        positions = np.arange(0, length - tile_size, stride)
+        return np.append(positions, length - tile_size)
+
+    ys, xs = np.meshgrid(starts(h), starts(w), indexing='ij')
+    x0 = xs.reshape(-1)
+    y0 = ys.reshape(-1)
+    return np.stack([x0, y0, np.minimum(x0 + tile_size, w), np.minimum(y0 + tile_size, h)], axis=1)
+
+def merge_tile_detections(parts: List[RawDetections], shape: Tuple[int, ...], iou_threshold: float = TILE_NMS_IOU) -> RawDetections:
+    """
+    タイルごとの検出結果 (元画像の座標に変換済み) を連結し、タイルの重なりで生じた重複を
+    クラスごとの NMS でまとめて1回で取り除く。
+    """
+    parts = [part for part in parts if len(part.class_ids)]
+    if not parts:
+        return empty_raw()
+    class_ids = np.concatenate([part.class_ids for part in parts])
+    confidences = np.concatenate([part.confidences for part in parts])
+    h, w = shape[:2]
+    boxes = np.clip(np.concatenate([part.boxes for part in parts]), 0, (w, h, w, h)).astype(np.float32)
+
+    # クラスごとのNMSを1回の呼び出しで行うため、クラスIDに応じて座標を画像の外側へずらす
+    offset = class_ids[:, None].astype(np.float32) * float(max(h, w) + 1)
+    nms_boxes = np.concatenate([boxes[:, :2] + offset, boxes[:, 2:] - boxes[:, :2]], axis=1) # (x, y, w, h)
+    indices = cv2.dnn.NMSBoxes(nms_boxes.tolist(), confidences.tolist(), 0.0, iou_threshold)
+    indices = np.array(indices, dtype=np.int64).reshape(-1)
+    indices = indices[np.argsort(-confidences[indices], kind='stable')]
+    return RawDetections(class_ids[indices], confidences[indices], boxes[indices])
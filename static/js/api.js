@@ -1,5 +1,34 @@
+// 結果を待つときに1回のリクエストでサーバー側で待ってもらう秒数 (ロングポーリング)
+const JOB_WAIT_SECONDS = 20;
+
+/**
+ * 推論ジョブが完了するまで結果の取得を繰り返す。
+ *
+ * @param {string} statusUrl - POST /api/detect-disease が返した status_url
+ * @returns {Promise<object>} - 完了したジョブの結果 (disease, confidence, detections など)
+ */
+export function waitForJobResult(statusUrl) {
+    return fetch(`${statusUrl}?wait=${JOB_WAIT_SECONDS}`)
+    .then(response => {
+        if (!response.ok) {
+            return response.text().then(text => {
+                throw new Error(`HTTP Error! Status: ${response.status}. Detail: ${text}`);
+            });
+        }
+        // 202 はまだ処理中なので、もう一度待つ
+        return response.json().then(data => (response.status === 202 ? waitForJobResult(statusUrl) : data));
+    })
+    .then(data => {
+        if (data.status === 'failed') {
+            throw new Error(`推論に失敗しました: ${data.error}`);
+        }
+        return data;
+    });
+}
+
 /**
- * 画像ファイルをバックエンドのYOLOv8 APIに送信する。
+ * 画像ファイルをバックエンドのYOLOv8 APIに送信し、推論が終わるまで待つ。
+ * サーバーはすぐにジョブIDを返す (202) ので、その後 waitForJobResult で結果を取得する。
  *
  * @param {File} file - アップロードする画像ファイルオブジェクト
  * @returns {Promise<object>} - サーバーから返されたJSONデータを含むPromise
@@ -22,8 +51,9 @@ export function uploadImageToApi(file) {
                 throw new Error(`HTTP Error! Status: ${response.status}. Detail: ${text}`);
             });
         }
-        // 成功した場合、JSON形式で結果を解析して返す
+        // 成功した場合、ジョブIDが返るので結果を待つ
         return response.json();
-    });
+    })
+    .then(job => waitForJobResult(job.status_url));
     // .catch() は呼び出し元 (ui.js の uploadImage 関数) で処理されます
 }
\ No newline at end of file
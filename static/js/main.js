@@ -9,6 +9,19 @@ document.addEventListener('DOMContentLoaded', () => {
     // let capturedBlob;  // キャプチャした画像データを保持 (ウェブカメラ用) // 撮影機能がないので不要
     let autoCaptureIntervalId; // 自動撮影のインターバルIDを保持
 
+    // --- ストリーミング送信 (/stream) の状態 ---
+    // サーバーは推論中に届いたフレームを最新の1枚だけ残して捨てるので、推論の速さを気にせず送ってよい
+    let streamSocket = null;       // WebSocket 接続
+    let frameIntervalMs = 200;     // フレームの送信間隔 (接続時にサーバーから通知される)
+    let frameInFlight = false;     // エンコード/送信中のフレームがあるか
+    const STREAM_RECONNECT_MS = 3000;
+    // サーバーが指定する撮影プロファイル (モデルの入力サイズに合わせた解像度/形式/品質)
+    // 取得できるまでは従来の設定 (縮小なし, JPEG 0.9) で撮影する
+    let captureProfile = { max_side: 0, format: 'image/jpeg', extension: '.jpg', quality: 0.9 };
+    // カメラの識別子 (サーバー側でカメラごとに最新のフレームを管理するのに使う)
+    const cameraId = localStorage.getItem('camera_id') || `browser_${Math.random().toString(36).slice(2, 10)}`;
+    localStorage.setItem('camera_id', cameraId);
+
     // 1. ウェブカメラの起動
     async function startWebcam() {
         try {
@@ -22,22 +35,44 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
-    // 撮影し、サーバーに送信する関数
+    // サーバーから撮影プロファイルを取得する
+    async function loadCaptureProfile() {
+        try {
+            const response = await fetch('/capture-profile');
+            if (response.ok) {
+                captureProfile = await response.json();
+                console.log('撮影プロファイル:', captureProfile);
+            }
+        } catch (error) {
+            console.error('撮影プロファイルの取得に失敗しました:', error);
+        }
+    }
+
+    // 現在のフレームを撮影プロファイルの解像度でキャンバスに描画し、指定の形式の Blob にして callback に渡す
+    function captureFrame(callback) {
+        const context = captureCanvas.getContext('2d');
+        const width = webcamVideo.videoWidth;
+        const height = webcamVideo.videoHeight;
+        // 長辺を max_side に合わせて縮小する (拡大はしない。max_side が 0 なら元の解像度のまま)
+        const scale = captureProfile.max_side > 0 ? Math.min(1, captureProfile.max_side / Math.max(width, height)) : 1;
+        captureCanvas.width = Math.round(width * scale);
+        captureCanvas.height = Math.round(height * scale);
+        context.drawImage(webcamVideo, 0, 0, captureCanvas.width, captureCanvas.height);
+        captureCanvas.toBlob(callback, captureProfile.format, captureProfile.quality);
+    }
+
+    // 撮影し、サーバーに送信する関数 (WebSocket が使えない場合の従来の方法)
     function captureAndUploadImage() {
         if (!currentStream) {
             console.log('ウェブカメラが起動していません。スキップします。');
             return;
         }
 
-        const context = captureCanvas.getContext('2d');
-        captureCanvas.width = webcamVideo.videoWidth;
-        captureCanvas.height = webcamVideo.videoHeight;
-        context.drawImage(webcamVideo, 0, 0, captureCanvas.width, captureCanvas.height);
-
-        captureCanvas.toBlob(async (blob) => {
-            const filename = `webcam_capture_${new Date().toISOString().replace(/[:.]/g, '-')}.jpg`;
+        captureFrame(async (blob) => {
+            const filename = `webcam_capture_${new Date().toISOString().replace(/[:.]/g, '-')}${captureProfile.extension || '.jpg'}`;
             const formData = new FormData();
             formData.append('file', blob, filename);
+            formData.append('camera_id', cameraId);
 
             try {
                 const response = await fetch('/upload-image', {
@@ -54,13 +89,75 @@ document.addEventListener('DOMContentLoaded', () => {
             } catch (error) {
                 console.error('画像アップロード中にエラーが発生しました:', error);
             }
-        }, 'image/jpeg', 0.9);
+        });
+    }
+
+    // 2. サーバーとの WebSocket 接続 (切断されたら再接続する)
+    function openStream() {
+        const protocol = location.protocol === 'https:' ? 'wss:' : 'ws:';
+        const socket = new WebSocket(`${protocol}//${location.host}/stream?camera_id=${encodeURIComponent(cameraId)}`);
+        socket.binaryType = 'arraybuffer';
+
+        socket.onopen = () => {
+            streamSocket = socket;
+            console.log('ストリーミング接続を開始しました。カメラID:', cameraId);
+        };
+        socket.onmessage = (event) => {
+            const message = JSON.parse(event.data);
+            if (message.type === 'hello') {
+                frameIntervalMs = message.frame_interval_ms || frameIntervalMs;
+                // 接続のたびに最新のプロファイルを受け取る (サーバー側でモデルが変わった場合に追従する)
+                if (message.capture_profile) {
+                    captureProfile = message.capture_profile;
+                }
+            } else if (message.type === 'result') {
+                if (message.status === 'done') {
+                    console.log(`推論結果: ${message.result.disease} (${message.result.confidence}) 遅延 ${message.latency_ms}ms, 間引いたフレーム ${message.dropped}`);
+                } else {
+                    console.error('推論エラー:', message.error);
+                }
+            } else if (message.type === 'busy') {
+                console.log('サーバーが混雑しているため、フレームが破棄されました。');
+            } else if (message.type === 'error') {
+                console.error('ストリーミングエラー:', message.error);
+            }
+        };
+        socket.onclose = () => {
+            if (streamSocket === socket) {
+                console.log('ストリーミング接続が切断されました。再接続します。');
+            }
+            streamSocket = null;
+            frameInFlight = false;
+            setTimeout(openStream, STREAM_RECONNECT_MS);
+        };
+    }
+
+    // 3. 一定間隔でフレームを送信する
+    function streamFrames() {
+        // 前のフレームの送信が終わっていない (回線が詰まっている) 間は撮影しない
+        if (currentStream && streamSocket && streamSocket.readyState === WebSocket.OPEN
+                && !frameInFlight && streamSocket.bufferedAmount === 0 && webcamVideo.videoWidth > 0) {
+            frameInFlight = true;
+            captureFrame((blob) => {
+                if (blob && streamSocket && streamSocket.readyState === WebSocket.OPEN) {
+                    streamSocket.send(blob);
+                }
+                frameInFlight = false;
+            });
+        }
+        setTimeout(streamFrames, frameIntervalMs);
     }
 
     // ページロード時にウェブカメラを起動
     console.log("startWebcamを呼び出し");
-    startWebcam().then(() => {
-        // ウェブカメラが正常に起動したら、2分ごとに自動で写真を撮影してアップロードする
+    Promise.all([startWebcam(), loadCaptureProfile()]).then(() => {
+        if ('WebSocket' in window) {
+            // ウェブカメラが正常に起動したら、フレームを連続してサーバーに送る
+            openStream();
+            streamFrames();
+            return;
+        }
+        // WebSocket が使えない場合は、従来どおり2分ごとに写真を撮影してアップロードする
         autoCaptureIntervalId = setInterval(() => {
             if (currentStream) { // カメラがアクティブな場合のみ実行
                 console.log("2分ごとの自動キャプチャとアップロードを開始します。");
@@ -71,4 +168,4 @@ document.addEventListener('DOMContentLoaded', () => {
         }, 120 * 1000); // 2分 (120秒) ごと
         console.log("自動撮影インターバルを開始しました。ID:", autoCaptureIntervalId);
     });
-});
\ No newline at end of file
+});
@@ -92,7 +92,12 @@ function uploadImage() {
             // エラー発生時、サーバーからの詳細なエラーメッセージを取得
             return response.text().then(text => { throw new Error(`HTTP Error! Status: ${response.status}. Detail: ${text}`); });
         }
-        return response.json(); // JSON形式で結果を解析
+        return response.json(); // サーバーはすぐにジョブIDを返す (202)
+    })
+    .then(job => {
+        resultElement.innerHTML = "推論中... ⏳";
+        // 結果の待ち方 (ロングポーリング) は api.js と共通にする
+        return import('./api.js').then(({ waitForJobResult }) => waitForJobResult(job.status_url));
     })
     .then(data => {
         console.log("受信データ:", data);
@@ -0,0 +1,100 @@
+import sqlite3
+
+import pytest
+
+pytest.importorskip("pymysql")
+
+from services.db_service import ConnectionPool, DetectionLogWriter
+
+CREATE_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS detection_logs (
+        image_file TEXT, main_disease TEXT, confidence REAL, detections_data TEXT, detection_time TEXT
+    )
+"""
+
+def _row(index):
+    return (f"img_{index}.jpg", "健康 (検出なし)", 1.0, "[]", "2024-01-01 00:00:00")
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "logs.sqlite3")
+    with sqlite3.connect(path) as connection:
+        connection.execute(CREATE_TABLE_SQL)
+    return path
+
+def _count(db_path):
+    with sqlite3.connect(db_path) as connection:
+        return connection.execute("SELECT COUNT(*) FROM detection_logs").fetchone()[0]
+
+def _writer(pool, tmp_path, **kwargs):
+    kwargs.setdefault("flush_interval", 60.0)
+    kwargs.setdefault("retry_max", 0)
+    return DetectionLogWriter(pool, placeholder="?", spool_path=str(tmp_path / "spool" / "logs.jsonl"), **kwargs)
+
+def test_pool_reuses_connections(db_path):
+    opened = []
+
+    def connect():
+        opened.append(sqlite3.connect(db_path, check_same_thread=False))
+        return opened[-1]
+
+    pool = ConnectionPool(connect, size=1)
+    first = pool.acquire()
+    pool.release(first)
+    assert pool.acquire() is first
+    # 壊れた接続はプールに戻さず、次は新しく接続する
+    pool.release(first, broken=True)
+    assert pool.acquire() is not first
+    assert len(opened) == 2
+    pool.close()
+
+def test_pool_replaces_connection_when_ping_fails():
+    class DeadConnection:
+        closed = False
+
+        def ping(self, reconnect=False):
+            raise OSError("server has gone away")
+
+        def close(self):
+            self.closed = True
+
+    dead = DeadConnection()
+    fresh = object()
+    pool = ConnectionPool(lambda: fresh, size=1)
+    pool.release(dead)
+    # 再接続できない接続は閉じて捨て、新しい接続を返す
+    assert pool.acquire() is fresh
+    assert dead.closed
+
+def test_writer_flushes_rows_with_executemany(db_path, tmp_path):
+    writer = _writer(ConnectionPool(lambda: sqlite3.connect(db_path, check_same_thread=False)), tmp_path, batch_size=10)
+    for index in range(25):
+        writer.append(_row(index))
+    writer.close()
+    assert _count(db_path) == 25
+    assert writer.stats()["written"] == 25
+
+def test_writer_spills_and_replays_in_chunks(db_path, tmp_path):
+    available = [False]
+
+    def connect():
+        if not available[0]:
+            raise sqlite3.OperationalError("database is unavailable")
+        return sqlite3.connect(db_path, check_same_thread=False)
+
+    writer = _writer(ConnectionPool(connect), tmp_path, batch_size=4)
+    for index in range(10):
+        writer.append(_row(index))
+    assert writer.flush() is False
+    assert writer.stats()["spilled"] == 10
+    assert writer.stats()["spool_file_exists"]
+
+    # DBが復旧したら、次の書き込みの後に退避した行が再投入され、退避ファイルは消える
+    available[0] = True
+    writer.append(_row(10))
+    assert writer.flush() is True
+    stats = writer.stats()
+    assert stats["replayed"] == 10
+    assert not stats["spool_file_exists"]
+    assert _count(db_path) == 11
+    writer.close()